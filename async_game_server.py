@@ -0,0 +1,426 @@
+import asyncio
+import itertools
+import logging
+import sys
+from typing import List
+
+from protocol import FrameDecoder, FrameType, ProtocolError, encode_frame
+from registry import ClientRegistry
+from server import Client, Socket_address
+from game_server import TooManyPlayersError
+from rps import RPSEnum, resolve
+logging.basicConfig(level=logging.INFO,
+                    format='%(name)s: %(message)s',
+                    )
+
+
+class AsyncPlayer(Client):
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, address: Socket_address, username: str, decoder: FrameDecoder):
+        super().__init__(writer.get_extra_info("socket"), address, username, decoder)
+        self.reader = reader
+        self.writer = writer
+        self.game: AsyncGame | None = None
+        self.__choice: RPSEnum = RPSEnum.NoChoice
+        self.__score: int = 0
+
+    def getScore(self):
+        return self.__score
+
+    def incrementScore(self):
+        self.__score += 1
+
+    def getChoice(self) -> RPSEnum:
+        return self.__choice
+
+    def setChoice(self, choice: RPSEnum):
+        self.__choice = choice
+
+    def send(self, message: str | bytes, frame_type: FrameType = FrameType.Chat):
+        # writes are buffered by the transport, the event loop never blocks on a slow reader
+        if not self.writer.is_closing():
+            self.writer.write(encode_frame(frame_type, message))
+
+    async def read_frames(self):
+        # frames already buffered, otherwise every frame completed by the next read.
+        # None once the peer closed the connection
+        frames = list(self.getDecoder().frames())
+        if frames:
+            return frames
+        data = await self.reader.read(65536)
+        if not data:
+            return None
+        self.getDecoder().feed(data)
+        return list(self.getDecoder().frames())
+
+
+class AsyncGameServer:
+    """Rock Paper Scissors chatroom running every connection on a single event loop.
+
+    Same chat, kick, `play`/`accept` and game semantics as `GameServer`, without
+    spawning a thread per client or per game round.
+    """
+
+    def __init__(self, server_address, close_event, backlog: int = 1024, handshake_timeout: float = 10.0):
+        self.host = server_address[0]
+        self.port = server_address[1]
+        self.backlog = backlog
+        self.handshake_timeout = handshake_timeout
+        self.close_event = close_event
+        # mutated on the loop thread only, the admin console reads it from its own thread
+        self.players: ClientRegistry[AsyncPlayer] = ClientRegistry()
+        self.games: List[AsyncGame] = list()
+        self.games_requests: list[tuple[str, str]] = []
+        self.logger = logging.getLogger("Game server")
+        self.chat_logger = logging.getLogger("Chat")
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.server: asyncio.Server | None = None
+
+    @property
+    def clients(self) -> ClientRegistry[AsyncPlayer]:
+        return self.players
+
+    def start(self):
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            self._close_server()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, backlog=self.backlog, reuse_address=True)
+        self.logger.info(f"Listening on {self.host}:{self.port}")
+        async with self.server:
+            # the admin thread signals shutdown through the shared close event
+            await self.loop.run_in_executor(None, self.close_event.wait)
+            self.__close_all()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_address = writer.get_extra_info("peername")
+        self.logger.info(
+            f"Connection from client {client_address[0]}:{client_address[1]}")
+        player = None
+        try:
+            try:
+                player = await asyncio.wait_for(
+                    self._request_client_username(reader, writer, client_address), self.handshake_timeout)
+            except asyncio.TimeoutError:
+                self.logger.info(
+                    f"Handshake with {client_address[0]}:{client_address[1]} timed out")
+                # close connection from client side
+                writer.write(encode_frame(FrameType.Control, "close"))
+            if player:
+                await self._handle_client(player)
+        except (ConnectionError, OSError, ProtocolError, UnicodeDecodeError) as e:
+            self.logger.warning(f"Error handling client: {e}")
+        finally:
+            if player and self.players.get(player.getUsername()) is player:
+                # connection dropped without a "close"
+                self.__remove_player(player)
+            writer.close()
+
+    async def _request_client_username(self, reader, writer, client_address) -> AsyncPlayer | None:
+        max_nbr_of_attempts = 3
+        message = "Server << Enter your username:"
+        decoder = FrameDecoder()
+        for nbr_of_attempts in range(max_nbr_of_attempts):
+            writer.write(encode_frame(FrameType.Chat, message))
+            while (frame := decoder.next_frame()) is None:
+                data = await reader.read(2048)
+                if not data:
+                    return None
+                decoder.feed(data)
+            username = frame[1].decode().strip()
+            if not username:
+                message = f"Server << Invalid username. Connection will be closed on no attempts left. {max_nbr_of_attempts - nbr_of_attempts - 1} attempts left. Enter a different username:"
+            elif username in self.players:
+                message = f"Server << Username is already taken. Connection will be closed on no attempts left. {max_nbr_of_attempts - nbr_of_attempts - 1} attempts left. Enter a different username:"
+            else:
+                new_player = AsyncPlayer(
+                    reader,
+                    writer,
+                    address=Socket_address(
+                        ip=client_address[0], port=client_address[1]),
+                    username=username,
+                    decoder=decoder
+                )
+                # no await between the check and the insert, so no lock is needed
+                self.players.add(new_player)
+                new_player.send(f"Server << Welcome {username} :)")
+                self.logger.info(f"{username} joined the chatroom")
+                self._send_all(f"{username} joined the chatroom",
+                               self.__chat_recipients(new_player))
+                return new_player
+        # close client's connection
+        writer.write(encode_frame(FrameType.Control, "close"))
+        return None
+
+    # handle incoming messages for each client
+    async def _handle_client(self, player: AsyncPlayer):
+        while not self.close_event.is_set():
+            frames = await player.read_frames()
+            if frames is None:
+                break
+            for frame_type, payload in frames:
+                self.__dispatch(player, frame_type, payload.decode().strip())
+            # let the transport flush before reading the next message
+            await player.writer.drain()
+
+    def __dispatch(self, player: AsyncPlayer, frame_type: FrameType, message: str):
+        if player.game is not None:
+            player.game.on_message(player, frame_type, message)
+        elif frame_type == FrameType.Control and message == "close":
+            self._disconnect_client(player)
+        elif message.split(" ")[0] == "play":
+            self.__request_game(player, message)
+        elif message.split(" ")[0].startswith("accept"):
+            self.__accept_game(player)
+        elif message.split(" ")[0] == "/msg":
+            self.__send_direct_message(player, message)
+        else:
+            challenger = self.__pop_game_request(player)
+            if challenger:
+                self.chat_logger.info(
+                    f"{player.getUsername()} refused game request from {challenger.getUsername()}")
+                challenger.send(
+                    f"Server << {player.getUsername()} refused your request")
+            else:
+                self.chat_logger.info(
+                    f"{player.getUsername()} << {message}")
+                self._send_all(f"{player.getUsername()} << {message}",
+                               self.__chat_recipients(player))
+
+    def __request_game(self, player: AsyncPlayer, message: str):
+        message_array = message.split(" ")
+        oppenent_username = message_array[1] if len(message_array) > 1 else ""
+        if not oppenent_username or oppenent_username == player.getUsername():
+            player.send("Server << Please enter a valid oppenent's username")
+            return
+        opponent, error_message = self.__get_opponent(oppenent_username)
+        if opponent:
+            self.games_requests.append(
+                (player.getUsername(), oppenent_username))
+            opponent.send(f"Server << {player.getUsername()} is requesting to play Rock Paper Scissors with you. Do you accept ?\n(Enter --> accept) or (Press <Enter> to refuse)")
+        else:
+            player.send(f"Server << {error_message}")
+
+    def __send_direct_message(self, player: AsyncPlayer, message: str):
+        message_array = message.split(" ", 2)
+        if len(message_array) < 3 or not message_array[2].strip():
+            player.send("Server << Usage: /msg <username> <message>")
+            return
+        target = self.players.get(message_array[1])
+        if target is None:
+            player.send(f"Server << Player <{message_array[1]}> not found")
+        elif target is player:
+            player.send("Server << You cannot send a private message to yourself")
+        else:
+            target.send(
+                f"{player.getUsername()} (private) << {message_array[2].strip()}")
+            player.send(f"Server << Message delivered to {message_array[1]}")
+
+    def __accept_game(self, player: AsyncPlayer):
+        for games_request in self.games_requests:
+            if games_request[1] == player.getUsername():
+                opponent, error_message = self.__get_opponent(
+                    games_request[0])
+                if opponent:
+                    self.games_requests.remove(games_request)
+                    new_game = AsyncGame(self)
+                    new_game.addPlayer(player)
+                    new_game.addPlayer(opponent)
+                    self.games.append(new_game)
+                    new_game.start_game()
+                else:
+                    player.send(f"Server << {error_message}")
+                return
+        player.send("Server << No game request to accept")
+
+    def __pop_game_request(self, player: AsyncPlayer) -> AsyncPlayer | None:
+        for games_request in self.games_requests:
+            if games_request[1] == player.getUsername():
+                opponent, _ = self.__get_opponent(games_request[0])
+                if opponent:
+                    self.games_requests.remove(games_request)
+                    return opponent
+        return None
+
+    def __get_opponent(self, oppenent_username: str) -> tuple[AsyncPlayer | None, str | None]:
+        opponent = self.players.get(oppenent_username)
+        if opponent is None:
+            return None, f"Player <{oppenent_username}> not found"
+        if opponent.game is not None:
+            return None, "Player is busy playing another match"
+        return opponent, None
+
+    def __chat_recipients(self, sender: AsyncPlayer) -> List[AsyncPlayer]:
+        return [
+            client for client in self.players
+            if client.game is None and client is not sender
+        ]
+
+    def _send_all(self, message: str | bytes, clients: List[AsyncPlayer]):
+        # the frame is encoded once for every recipient
+        data = encode_frame(FrameType.Chat, message)
+        for client in clients:
+            if not client.writer.is_closing():
+                client.writer.write(data)
+
+    def __remove_player(self, player: AsyncPlayer):
+        self.players.remove(player)
+        self.games_requests = [
+            game_request for game_request in self.games_requests if player.getUsername() not in game_request
+        ]
+        if player.game is not None:
+            player.game.abandon(player)
+
+    def __call_in_loop(self, callback, *args):
+        # the admin console runs on its own thread
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def _broadcast(self, message: str | bytes, clients: List[AsyncPlayer]):
+        self.__call_in_loop(self._send_all, message, list(clients))
+
+    def _kick_client(self, client: AsyncPlayer):
+        def kick():
+            client.send("close", FrameType.Control)
+            self._disconnect_client(client)
+        self.__call_in_loop(kick)
+
+    def _disconnect_client(self, client: AsyncPlayer):
+        client_username = client.getUsername()
+        # close connection with client
+        self.__remove_player(client)
+        self.logger.info(f"{client_username} has disconnected")
+        self._send_all(f"Server << {client_username} has disconnected",
+                       [client_obj for client_obj in self.players if client_obj != client])
+
+    def __close_all(self):
+        for client in self.players:
+            self.logger.warning(
+                f"Informing client {client.getUsername()}...")
+            client.send("close", FrameType.Control)
+            client.writer.close()
+        self.players.clear()
+        if self.server is not None:
+            self.server.close()
+
+    def _close_server(self):
+        self.logger.warning(
+            f"Server is shutting down. Informing clients...")
+        try:
+            if not sys.stdin.closed:
+                sys.stdin.close()
+        except Exception as e:
+            self.logger.error({e})
+        # wakes up _serve, which informs the clients from the loop thread
+        self.close_event.set()
+        self.logger.warning("Server has shut down.")
+
+
+class AsyncGame():
+    ids = itertools.count(1)
+
+    def __init__(self, gameServer: AsyncGameServer):
+        self.gameServer = gameServer
+        self.players: List[AsyncPlayer] = list()
+        self.id = next(AsyncGame.ids)
+        self.exiting_player: AsyncPlayer | None = None
+        self.closed = False
+        self.logger = logging.getLogger("Game")
+
+    def addPlayer(self, player: AsyncPlayer):
+        if len(self.players) < 2:
+            self.players.append(player)
+            player.game = self
+        else:
+            raise TooManyPlayersError("Number of players exceeded")
+
+    def start_game(self):
+        player1, player2 = self.players
+        self.logger.info(
+            f"Game Started {player1.getUsername()} VS {player2.getUsername()}")
+        self.__start_round()
+
+    def __start_round(self):
+        player1, player2 = self.players
+        player1.send(
+            f"Server << You are playing against <{player2.getUsername()}>")
+        player2.send(
+            f"Server << You are playing against <{player1.getUsername()}>")
+        self.gameServer._send_all(
+            "Server << Make your choice...\n1- Rock\n2- Paper\n3- Scissors", self.players)
+
+    def __opponent(self, player: AsyncPlayer) -> AsyncPlayer:
+        return self.players[1] if self.players[0] is player else self.players[0]
+
+    # handle incoming messages for each player, no thread is waiting on them
+    def on_message(self, player: AsyncPlayer, frame_type: FrameType, message: str):
+        if frame_type == FrameType.Control and message == "close":
+            self.gameServer._disconnect_client(player)
+        elif message == "exit":
+            if self.exiting_player is None:
+                self.exiting_player = player
+                self.__opponent(player).send(
+                    f"Server << {player.getUsername()} quit the game. You win :)")
+                player.send(
+                    "Server << Waiting for your oppenent to exit the game...")
+        elif message == "quit":
+            self.close()
+        elif self.exiting_player is not None:
+            player.send(
+                "Server << Waiting for your oppenent to exit the game...")
+        elif message in ["1", "2", "3"]:
+            if player.getChoice() == RPSEnum.NoChoice:
+                player.setChoice(RPSEnum(int(message)))
+                self.gameServer.logger.info(
+                    f"{player.getUsername()} VS {self.__opponent(player).getUsername()} << {player.getUsername()} chose {RPSEnum(int(message)).name}")
+                if all(p.getChoice() != RPSEnum.NoChoice for p in self.players):
+                    self.__finish_round()
+        else:
+            player.send("Server << Please enter a valid choice!")
+
+    def __finish_round(self):
+        player1, player2 = self.players
+        result = resolve(player1.getChoice(), player2.getChoice())
+        if result == 0:
+            self.logger.info(
+                f"{player1.getUsername()} VS {player2.getUsername()} << It's a tie!")
+            self.gameServer._send_all("Server << It's a tie!", self.players)
+        elif result == 1:
+            self.logger.info(
+                f"{player1.getUsername()} VS {player2.getUsername()} << {player1.getUsername()} won!!")
+            player1.send("Server << You win!!")
+            player2.send(f"Server << {player1.getUsername()} wins!")
+            player1.incrementScore()
+        else:
+            self.logger.info(
+                f"{player1.getUsername()} VS {player2.getUsername()} << {player2.getUsername()} won!!")
+            player2.send("Server << You win!!")
+            player1.send("Server << You lost :((")
+            player2.incrementScore()
+        # Reset players for the next round
+        for player in self.players:
+            player.setChoice(RPSEnum.NoChoice)
+        self.__start_round()
+
+    def abandon(self, player: AsyncPlayer):
+        # a player disconnected in the middle of the game
+        if not self.closed:
+            opponent = self.__opponent(player)
+            opponent.send(
+                f"Server << {player.getUsername()} left the game. You win :)")
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for player in self.players:
+            player.setChoice(RPSEnum.NoChoice)
+            player.game = None
+            if self.gameServer.players.get(player.getUsername()) is player:
+                player.send("Server << Welcome back to the chat :)")
+        self.gameServer.games.remove(self)
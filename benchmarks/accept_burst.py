@@ -0,0 +1,102 @@
+"""Connections accepted per second during a burst of new clients.
+
+Run from the repository root:
+
+    python -m benchmarks.accept_burst --clients 5000 --silent 50
+    python -m benchmarks.accept_burst --clients 5000 --backlog 4
+
+Every client connects at once and waits for the username prompt, which the
+server only sends once the connection went through the accept loop and
+reached the handshake stage. `--silent` clients connect first and never
+answer; they must not delay the others. With `--register` every client also
+picks a username and waits for its welcome message.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import resource
+import time
+
+from benchmarks.engines import BenchClient, free_port, run_server
+
+
+async def greet(client: BenchClient, port: int, register: bool) -> bool:
+    if register:
+        return await client.connect(port)
+    client.reader, client.writer = await asyncio.open_connection("127.0.0.1", port)
+    return await client.read_frame() is not None
+
+
+async def timed_greet(client: BenchClient, port: int, register: bool, timeout: float) -> float | None:
+    # seconds until the prompt (or the welcome message) arrived, None on failure
+    start = time.perf_counter()
+    try:
+        if await asyncio.wait_for(greet(client, port, register), timeout):
+            return time.perf_counter() - start
+    except (OSError, asyncio.TimeoutError):
+        pass
+    return None
+
+
+async def run_clients(port: int, nbr_of_clients: int, nbr_of_silent: int, register: bool, timeout: float) -> dict:
+    silent = [BenchClient(f"silent{i}") for i in range(nbr_of_silent)]
+    # connected and greeted, then never send their username
+    await asyncio.gather(*(timed_greet(client, port, False, timeout) for client in silent))
+
+    clients = [BenchClient(f"user{i}") for i in range(nbr_of_clients)]
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(timed_greet(client, port, register, timeout) for client in clients))
+    elapsed = time.perf_counter() - start
+
+    for client in silent + clients:
+        if client.writer is not None:
+            client.writer.close()
+    accepted = sorted(latency for latency in latencies if latency is not None)
+    return {
+        "accepted": f"{len(accepted)}/{nbr_of_clients}",
+        "burst time (s)": f"{elapsed:.2f}",
+        "accepted per second": f"{len(accepted) / elapsed:.0f}",
+        "p50 latency (ms)": f"{accepted[len(accepted) // 2] * 1000:.1f}" if accepted else "-",
+        "p99 latency (ms)": f"{accepted[int(len(accepted) * 0.99)] * 1000:.1f}" if accepted else "-",
+        "max latency (ms)": f"{accepted[-1] * 1000:.1f}" if accepted else "-",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--silent", type=int, default=0,
+                        help="clients connecting before the burst and never answering the prompt")
+    parser.add_argument("--backlog", type=int, default=None,
+                        help="server listen backlog (server default when omitted)")
+    parser.add_argument("--register", action="store_true",
+                        help="complete every handshake instead of stopping at the prompt")
+    parser.add_argument("--timeout", type=float, default=15,
+                        help="seconds a client waits before counting its connection as failed")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    # the client side holds every connection of the burst
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE,
+                       (min(hard, max(soft, 2 * (args.clients + args.silent) + 64)), hard))
+
+    options = {"backlog": args.backlog} if args.backlog is not None else {}
+    port = free_port()
+    server = multiprocessing.Process(
+        target=run_server, args=(args.engine, port), kwargs=options, daemon=True)
+    server.start()
+    time.sleep(1)
+    try:
+        results = asyncio.run(run_clients(
+            port, args.clients, args.silent, args.register, args.timeout))
+    finally:
+        server.kill()
+        server.join()
+    for key, value in results.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Direct message throughput while more and more idle users are connected.
+
+Run from the repository root:
+
+    python -m benchmarks.direct_messages --users 10 100 1000 --messages 5000
+
+For every user count a fresh server is started, that many idle users connect,
+then one user sends `/msg` lines to another one. A direct message is looked
+up by username and written to the recipient's queue only, so the delivery
+rate should stay flat whatever the number of connected users.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import time
+
+from benchmarks.engines import BenchClient, free_port, run_server
+from protocol import FrameType, encode_frame
+
+PRIVATE_MARKER = b"(private) << "
+
+
+async def connect_all(port: int, clients: list[BenchClient], connect_batch: int) -> list[BenchClient]:
+    connected = []
+    for i in range(0, len(clients), connect_batch):
+        batch = clients[i:i + connect_batch]
+        results = await asyncio.gather(*(client.connect(port) for client in batch))
+        connected += [client for client, ok in zip(batch, results) if ok]
+    return connected
+
+
+async def receive_private(client: BenchClient, expected: int):
+    while client.received < expected:
+        frame = await client.read_frame()
+        if frame is None:
+            return
+        if PRIVATE_MARKER in frame[1]:
+            client.received += 1
+
+
+async def run_clients(port: int, nbr_of_users: int, nbr_of_messages: int, connect_batch: int) -> dict:
+    sender, recipient = BenchClient("sender"), BenchClient("recipient")
+    idle = await connect_all(port, [BenchClient(f"user{i}") for i in range(nbr_of_users)], connect_batch)
+    await connect_all(port, [sender, recipient], connect_batch)
+    drains = [asyncio.create_task(client.drain()) for client in idle + [sender]]
+    await asyncio.sleep(0.5)
+
+    frame = encode_frame(FrameType.Command, "/msg recipient bench")
+    start = time.perf_counter()
+    receiving = asyncio.create_task(receive_private(recipient, nbr_of_messages))
+    for _ in range(nbr_of_messages):
+        sender.writer.write(frame)
+        await sender.writer.drain()
+    await asyncio.wait_for(receiving, timeout=60)
+    elapsed = time.perf_counter() - start
+
+    for client in idle + [sender, recipient]:
+        client.writer.close()
+    for task in drains:
+        task.cancel()
+    return {
+        "users connected": len(idle) + 2,
+        "messages delivered": recipient.received,
+        "delivered per second": f"{recipient.received / elapsed:.0f}",
+        "us per message": f"{elapsed / nbr_of_messages * 1e6:.1f}",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 100, 1000],
+                        help="idle users connected besides the sender and the recipient")
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--connect-batch", type=int, default=4,
+                        help="clients connecting concurrently (keep it under the server's listen backlog)")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    for nbr_of_users in args.users:
+        port = free_port()
+        server = multiprocessing.Process(
+            target=run_server, args=(args.engine, port), daemon=True)
+        server.start()
+        time.sleep(1)
+        try:
+            results = asyncio.run(run_clients(
+                port, nbr_of_users, args.messages, args.connect_batch))
+        finally:
+            server.kill()
+            server.join()
+        print(f"{nbr_of_users} idle users:")
+        for key, value in results.items():
+            print(f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
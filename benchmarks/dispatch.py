@@ -0,0 +1,100 @@
+"""Command dispatch microbenchmark: time to route one message to its handler.
+
+Run from the repository root:
+
+    python -m benchmarks.dispatch --messages 200000
+
+chain: the if/elif chain of GameServer before the command router, splitting
+the line again for every test and looking the sender's game requests up
+before deciding a line is chat.
+router: chat frames go straight to the chat handler, commands are parsed once
+and looked up in the dispatch table.
+Every handler is a no-op, only the dispatch itself is measured.
+"""
+import argparse
+import logging
+import threading
+import time
+
+from game_server import GameServer, Player
+from protocol import FrameType
+from server import Client, Socket_address
+
+MESSAGES = {
+    "chat": (FrameType.Chat, b"hello everyone, who wants to play?"),
+    "rooms": (FrameType.Command, b"rooms"),
+    "/msg": (FrameType.Command, b"/msg bob hello there"),
+    "top": (FrameType.Command, b"top 10"),
+    "play": (FrameType.Command, b"play bob"),
+    "accept": (FrameType.Command, b"accept"),
+}
+
+
+def handled(*args):
+    pass
+
+
+def chain_dispatch(server: GameServer, player: Player, frame_type: FrameType, payload: bytes):
+    # GameServer._handle_frame before the command router, with no-op handlers
+    message = payload.decode().strip()
+    game = player.getGame()
+    if game is not None:
+        handled()
+    elif frame_type == FrameType.Control and message == "close":
+        handled()
+    elif message.split(" ")[0] in ("join", "leave", "rooms"):
+        handled(message)
+    elif message.split(" ")[0] == "/msg":
+        handled(payload.strip())
+    elif message == "play any":
+        handled()
+    elif message.split(" ")[0] in ("top", "rank"):
+        handled(message)
+    elif message.split(" ")[0] == "history":
+        handled(message)
+    elif message == "cancel":
+        handled()
+    elif message.split(" ")[0] == "play":
+        message_array = message.split(" ")
+        handled(message_array[1] if len(message_array) > 1 else "")
+    elif message.split(" ")[0].startswith("accept"):
+        handled()
+    else:
+        # every chat line checked for a game request to refuse
+        handled(server.challenges.pop(player.getUsername()))
+
+
+def run(mode: str, nbr_of_messages: int) -> dict:
+    server = GameServer(("127.0.0.1", 0), threading.Event())
+    player = Player(Client(None, Socket_address("127.0.0.1", 0), "alice"))
+    if mode == "router":
+        for name in server.commands.names():
+            server.commands.register(name, handled)
+        server._handle_chat = handled
+        dispatch = server._handle_frame
+    else:
+        def dispatch(player, frame_type, payload):
+            chain_dispatch(server, player, frame_type, payload)
+    results = {}
+    for name, (frame_type, payload) in MESSAGES.items():
+        start = time.perf_counter()
+        for _ in range(nbr_of_messages):
+            dispatch(player, frame_type, payload)
+        results[name] = f"{(time.perf_counter() - start) / nbr_of_messages * 1e9:.0f} ns"
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000,
+                        help="messages dispatched per kind of message")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    for mode in ("chain", "router"):
+        print(f"{mode}:")
+        for key, value in run(mode, args.messages).items():
+            print(f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
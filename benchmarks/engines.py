@@ -0,0 +1,183 @@
+"""Threaded vs asyncio engine: connections held and chat messages delivered per second.
+
+Run from the repository root:
+
+    python -m benchmarks.engines --engine threaded --clients 1000
+    python -m benchmarks.engines --engine asyncio --clients 1000
+
+The server runs in its own process; its thread count and resident memory are
+read from /proc once every client is connected.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import socket
+import threading
+import time
+
+from protocol import FrameDecoder, FrameType, encode_frame
+
+MARKER = b"<< bench"
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_server(engine: str, port: int, **options):
+    logging.disable(logging.CRITICAL)
+    close_event = threading.Event()
+    if engine == "asyncio":
+        from async_game_server import AsyncGameServer
+        server = AsyncGameServer(("127.0.0.1", port), close_event, **options)
+    else:
+        from game_server import GameServer
+        server = GameServer(("127.0.0.1", port), close_event, **options)
+    server.start()
+
+
+def run_cluster(port: int, nbr_of_processes: int, **options):
+    # threaded engine in `nbr_of_processes` worker processes sharing the port
+    logging.disable(logging.CRITICAL)
+    from cluster import Cluster
+    close_event = threading.Event()
+    Cluster(("127.0.0.1", port), close_event, nbr_of_processes, **options).start()
+
+
+def run_node(port: int, node_name: str, federation_port: int, peers: list[tuple[str, int]], **options):
+    # threaded engine linked to other nodes of a federation
+    logging.disable(logging.CRITICAL)
+    from federation import FederatedServer
+    close_event = threading.Event()
+    FederatedServer(("127.0.0.1", port), close_event, node_name,
+                    ("127.0.0.1", federation_port), peers, **options).start()
+
+
+def proc_status(pid: int) -> dict:
+    status = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                status[key] = value.strip()
+    except OSError:
+        pass
+    return status
+
+
+class BenchClient:
+    def __init__(self, username: str):
+        self.username = username
+        self.received = 0
+        self.decoder = FrameDecoder()
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+
+    async def connect(self, port: int) -> bool:
+        try:
+            self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+            await self.read_frame()
+            self.writer.write(encode_frame(FrameType.Chat, self.username))
+            while True:
+                frame = await self.read_frame()
+                if frame is None:
+                    return False
+                if frame[1].startswith(b"Server << Welcome"):
+                    return True
+        except OSError:
+            return False
+
+    async def read_frame(self):
+        while True:
+            while (frame := self.decoder.next_frame()) is None:
+                data = await self.reader.read(65536)
+                if not data:
+                    return None
+                self.decoder.feed(data)
+            if frame != (FrameType.Control, b"ping"):
+                return frame
+            # answered here, idle bots are not disconnected
+            self.writer.write(encode_frame(FrameType.Control, "pong"))
+
+    async def drain(self):
+        while (frame := await self.read_frame()) is not None:
+            if frame[1].endswith(MARKER):
+                self.received += 1
+
+    async def chat(self, rate: float, deadline: float):
+        interval = 1 / rate
+        while time.perf_counter() < deadline:
+            self.writer.write(encode_frame(FrameType.Chat, "bench"))
+            await self.writer.drain()
+            await asyncio.sleep(interval)
+
+
+async def run_clients(port: int, nbr_of_clients: int, nbr_of_senders: int, rate: float, duration: float, connect_batch: int, server_pid: int):
+    clients = [BenchClient(f"user{i}") for i in range(nbr_of_clients)]
+    connected = []
+    start = time.perf_counter()
+    for i in range(0, nbr_of_clients, connect_batch):
+        batch = clients[i:i + connect_batch]
+        results = await asyncio.gather(*(client.connect(port) for client in batch))
+        connected += [client for client, ok in zip(batch, results) if ok]
+    connect_time = time.perf_counter() - start
+    drains = [asyncio.create_task(client.drain()) for client in connected]
+    await asyncio.sleep(1)
+    status = proc_status(server_pid)
+
+    for client in connected:
+        client.received = 0
+    deadline = time.perf_counter() + duration
+    senders = connected[:nbr_of_senders]
+    await asyncio.gather(*(client.chat(rate, deadline) for client in senders))
+    # give in-flight messages a moment to land
+    await asyncio.sleep(1)
+    delivered = sum(client.received for client in connected)
+
+    for client in connected:
+        client.writer.close()
+    for task in drains:
+        task.cancel()
+    return {
+        "connections held": f"{len(connected)}/{nbr_of_clients}",
+        "connect time (s)": f"{connect_time:.2f}",
+        "server threads": status.get("Threads", "?"),
+        "server RSS": status.get("VmRSS", "?"),
+        "messages sent": int(duration * rate) * len(senders),
+        "messages delivered": delivered,
+        "delivered per second": f"{delivered / duration:.0f}",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=20,
+                        help="messages per second per sender")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--connect-batch", type=int, default=4,
+                        help="concurrent connection attempts, keep it within the threaded engine's listen backlog")
+    args = parser.parse_args()
+
+    port = free_port()
+    server_process = multiprocessing.Process(
+        target=run_server, args=(args.engine, port), daemon=True)
+    server_process.start()
+    time.sleep(1)
+    try:
+        results = asyncio.run(run_clients(
+            port, args.clients, args.senders, args.rate, args.duration, args.connect_batch, server_process.pid))
+    finally:
+        server_process.kill()
+    print(f"engine: {args.engine}")
+    for key, value in results.items():
+        print(f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
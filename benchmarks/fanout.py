@@ -0,0 +1,139 @@
+"""Chat fan-out microbenchmark: syscalls and time per chat line in a busy room.
+
+Run from the repository root:
+
+    python -m benchmarks.fanout --recipients 200 --lines 2000
+
+per-recipient: the line is decoded, formatted and encoded again, then sent
+with one blocking `sendall` per recipient (the fan-out before outbound queues).
+vectored: the received bytes are framed once, the same frame is queued for
+every recipient and the outbound writer flushes each socket's pending frames
+with a single `sendmsg`.
+"""
+import argparse
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from protocol import FrameType, encode_frame
+from server import Client, Server, Socket_address
+
+
+class CountingSocket:
+    # socket wrapper counting send syscalls
+    calls = 0
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+
+    def send(self, data, flags=0):
+        CountingSocket.calls += 1
+        return self.sock.send(data, flags)
+
+    def sendall(self, data):
+        CountingSocket.calls += 1
+        return self.sock.sendall(data)
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        CountingSocket.calls += 1
+        return self.sock.sendmsg(buffers, ancdata, flags)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def shutdown(self, how):
+        return self.sock.shutdown(how)
+
+    def close(self):
+        return self.sock.close()
+
+
+class Drain(threading.Thread):
+    # reads every peer socket until the expected number of bytes arrived
+    def __init__(self, peers: list[socket.socket]):
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        for peer in peers:
+            peer.setblocking(False)
+            self.selector.register(peer, selectors.EVENT_READ)
+        self.received = 0
+        self.expected = None
+        self.done = threading.Event()
+
+    def run(self):
+        while self.expected is None or self.received < self.expected:
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    while data := key.fileobj.recv(1 << 20):
+                        self.received += len(data)
+                except BlockingIOError:
+                    pass
+        self.done.set()
+
+
+def run(mode: str, nbr_of_recipients: int, nbr_of_lines: int, size: int) -> dict:
+    server = Server(("127.0.0.1", 0), threading.Event(),
+                    max_queued_frames=nbr_of_lines + 1, max_queued_bytes=1 << 30)
+    sender = Client(None, Socket_address("127.0.0.1", 0), "sender")
+    recipients, peers = [], []
+    for i in range(nbr_of_recipients):
+        sock, peer = socket.socketpair()
+        client = Client(CountingSocket(sock),
+                        Socket_address("127.0.0.1", i), f"user{i}")
+        if mode == "vectored":
+            server.writer.register(client)
+        recipients.append(client)
+        peers.append(peer)
+    drain = Drain(peers)
+    drain.start()
+    if mode == "vectored":
+        server.writer.start()
+
+    payload = (b"x" * size) + b"\n"
+    frame_size = len(sender.chat_frame(payload.strip()))
+    drain.expected = frame_size * nbr_of_lines * nbr_of_recipients
+    CountingSocket.calls = 0
+    start = time.perf_counter()
+    for _ in range(nbr_of_lines):
+        if mode == "vectored":
+            server._broadcast_frame(sender.chat_frame(
+                payload.strip()), recipients, exclude=sender)
+        else:
+            message = payload.decode().strip()
+            frame = encode_frame(
+                FrameType.Chat, f"{sender.getUsername()} << {message}")
+            for client in recipients:
+                client.getSocket().sendall(frame)
+    drain.done.wait()
+    elapsed = time.perf_counter() - start
+    if mode == "vectored":
+        server.writer.stop()
+    for client, peer in zip(recipients, peers):
+        client.getSocket().close()
+        peer.close()
+    return {
+        "send syscalls": CountingSocket.calls,
+        "syscalls per line": f"{CountingSocket.calls / nbr_of_lines:.1f}",
+        "frames per syscall": f"{nbr_of_lines * nbr_of_recipients / CountingSocket.calls:.1f}",
+        "us per line": f"{elapsed / nbr_of_lines * 1e6:.1f}",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipients", type=int, default=200)
+    parser.add_argument("--lines", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=80,
+                        help="chat line length in bytes")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    for mode in ("per-recipient", "vectored"):
+        print(f"{mode}:")
+        for key, value in run(mode, args.recipients, args.lines, args.size).items():
+            print(f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
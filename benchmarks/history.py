@@ -0,0 +1,64 @@
+"""Chat history cost: time added to every chat line, and time to read past messages.
+
+Run from the repository root:
+
+    python -m benchmarks.history --lines 100000 --read 1000
+
+append: `ChatHistory.append` as called after every broadcast (ring buffer plus
+a queue put, the writer thread persists the frame). sync write: the frame
+written to a file and flushed by the broadcasting thread instead. read: the
+last `--read` frames of the room, from the ring buffer and the mapped log,
+as `history` and the replay on join send them.
+"""
+import argparse
+import tempfile
+import time
+
+from history import ChatHistory
+from protocol import FrameType, encode_frame
+
+
+def read(history: ChatHistory, name: str, n: int):
+    start = time.perf_counter()
+    buffers = history.recent("lobby", n)
+    elapsed = time.perf_counter() - start
+    print(f"read {n} from {name}: {elapsed * 1e6:.1f} us, "
+          f"{len(buffers)} buffers, {sum(len(buffer) for buffer in buffers)} bytes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--read", type=int, default=1000)
+    args = parser.parse_args()
+    frames = [encode_frame(FrameType.Chat, f"user{i % 100} << message number {i}")
+              for i in range(args.lines)]
+    with tempfile.TemporaryDirectory() as directory:
+        history = ChatHistory(directory)
+        history.start()
+        start = time.perf_counter()
+        for frame in frames:
+            history.append("lobby", frame)
+        elapsed = time.perf_counter() - start
+        print(f"append: {elapsed / args.lines * 1e6:.2f} us per line")
+        while history.backlog():
+            time.sleep(0.01)
+        read(history, "ring + log", args.read)
+        history.stop()
+        # after a restart the ring buffer is empty, everything comes from the log
+        history = ChatHistory(directory)
+        history.start()
+        read(history, "log", args.read)
+        history.stop()
+
+        with open(f"{directory}/sync.log", "ab") as log:
+            start = time.perf_counter()
+            for frame in frames:
+                log.write(frame)
+                log.flush()
+            elapsed = time.perf_counter() - start
+        print(f"sync write: {elapsed / args.lines * 1e6:.2f} us per line")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Chat fan-out cost while many games are running: time per chat line.
+
+Run from the repository root:
+
+    python -m benchmarks.in_game --users 1000 --games 200 --lines 2000
+
+Every user sits in the lobby and 2 * `--games` of them are playing. rebuild:
+the in-game usernames are gathered from every game and the room is filtered
+against them for each chat line (the former fan-out). incremental: the
+server's `_handle_frame` path, walking the room's cached tuple of members
+not playing a game. Sockets are stand-ins counting the frames they get.
+"""
+import argparse
+import logging
+import threading
+import time
+
+from game_server import Game, GameServer, Player
+from protocol import FrameType
+from server import Client, Socket_address
+
+
+class NullSocket:
+    # counts what would have been sent
+    frames = 0
+
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def sendall(self, data):
+        NullSocket.frames += 1
+
+    def fileno(self):
+        return self.fd
+
+
+def setup(nbr_of_users: int, nbr_of_games: int) -> tuple[GameServer, list[Player]]:
+    server = GameServer(("127.0.0.1", 0), threading.Event())
+    players = []
+    for i in range(nbr_of_users):
+        player = Player(Client(NullSocket(i), Socket_address(
+            "127.0.0.1", i), f"user{i}"))
+        server.clients.add(player)
+        server.rooms.join(player, server.rooms.lobby().name)
+        players.append(player)
+    for i in range(nbr_of_games):
+        game = Game(server)
+        game.addPlayer(players[2 * i])
+        game.addPlayer(players[2 * i + 1])
+        server._start_game(game)
+    return server, players
+
+
+def run(mode: str, server: GameServer, sender: Player, nbr_of_lines: int) -> float:
+    payload = b"hello everyone"
+    start = time.perf_counter()
+    for _ in range(nbr_of_lines):
+        if mode == "rebuild":
+            with server.lock:
+                players_in_game = [
+                    player.getUsername() for game in server.games.values() for player in game.players]
+            server._broadcast_frame(
+                sender.chat_frame(payload),
+                [
+                    client for client in sender.getRoom().snapshot()
+                    if client.getUsername() not in players_in_game
+                ],
+                exclude=sender
+            )
+        else:
+            server._handle_frame(sender, FrameType.Chat, payload)
+    return (time.perf_counter() - start) / nbr_of_lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--games", type=int, default=200)
+    parser.add_argument("--lines", type=int, default=2000)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    server, players = setup(args.users, args.games)
+    # the last user is not playing
+    sender = players[-1]
+    print(f"{args.users} users, {len(server.games)} games, "
+          f"{len(sender.getRoom().recipients())} chat recipients")
+    for mode in ("rebuild", "incremental"):
+        NullSocket.frames = 0
+        elapsed = run(mode, server, sender, args.lines)
+        print(f"{mode}: {elapsed * 1e6:.1f} us per line, "
+              f"{NullSocket.frames // args.lines} frames per line")
+
+
+if __name__ == "__main__":
+    main()
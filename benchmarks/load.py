@@ -0,0 +1,271 @@
+"""End-to-end load test: simulated users chatting and playing over loopback.
+
+Run from the repository root:
+
+    python -m benchmarks.load --engine threaded --users 500 --chatters 50 --rate 2 --players 100
+    python -m benchmarks.load --server-processes 4 --users 2000 --chatters 200
+    python -m benchmarks.load --nodes 3 --users 300 --chatters 30 --players 60
+    python -m benchmarks.load --port 12345 --users 200
+
+Every user is a headless bot: it picks a username, then `--chatters` of them
+send chat lines at `--rate` per second each while `--players` of them (an even
+number) challenge each other, accept and pick random choices round after
+round. Chat lines carry their send time, so every receiving bot measures the
+delivery latency. Bots are spread over `--processes` processes, all sharing
+the system monotonic clock. Without `--port` the server is started in its own
+process with `--engine`, or as a cluster of `--server-processes` worker
+processes sharing the port, or as `--nodes` federated nodes linked to each
+other (users spread over the nodes, so most chat lines and games cross a
+link), otherwise the running server is used.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import random
+import time
+import urllib.request
+
+from benchmarks.engines import BenchClient, free_port, run_cluster, run_node, run_server
+from metrics import Histogram, QUANTILES
+from protocol import FrameType, encode_frame
+
+LOAD_MARKER = b" << load "
+
+
+class Bot(BenchClient):
+    def __init__(self, username: str, opponent: str | None = None, challenger: bool = False):
+        super().__init__(username)
+        # players only: who to play with, and whether this bot sends the request
+        self.opponent = opponent
+        self.challenger = challenger
+        self.playing = False
+        self.sent = 0
+        self.delivered = 0
+        self.rounds = 0
+        self.disconnected = False
+        # server port this bot connects to
+        self.port = 0
+
+    async def run(self, latency: Histogram, deadline: float):
+        # reads until the connection closes, answering the game prompts
+        while (frame := await self.read_frame()) is not None:
+            frame_type, payload = frame
+            if LOAD_MARKER in payload:
+                sent_at = int(payload.rsplit(b" ", 1)[1])
+                latency.record((time.monotonic_ns() - sent_at) / 1e9)
+                self.delivered += 1
+            elif frame_type == FrameType.Control and payload == b"close":
+                break
+            elif self.opponent is None:
+                continue
+            elif b"is requesting to play" in payload:
+                self.send("accept")
+            elif b"Make your choice" in payload:
+                self.playing = True
+                if time.perf_counter() < deadline:
+                    self.send(random.choice(("1", "2", "3")))
+            elif payload.startswith((b"Server << You win", b"Server << You lost", b"Server << It's a tie")):
+                self.rounds += 1
+        else:
+            if time.perf_counter() < deadline:
+                self.disconnected = True
+
+    def send(self, message: str, frame_type: FrameType = FrameType.Command):
+        self.writer.write(encode_frame(frame_type, message))
+
+    async def chat(self, rate: float, deadline: float):
+        interval = 1 / rate
+        # spread the first lines of every chatter over one interval
+        await asyncio.sleep(random.random() * interval)
+        while time.perf_counter() < deadline:
+            self.send(f"load {time.monotonic_ns()}", FrameType.Chat)
+            self.sent += 1
+            await self.writer.drain()
+            await asyncio.sleep(interval)
+
+    async def challenge(self, deadline: float):
+        # the request may reach an opponent still connecting, ask again until the game starts
+        while not self.playing and time.perf_counter() < deadline:
+            self.send(f"play {self.opponent}")
+            await asyncio.sleep(1)
+
+
+async def connect(bot: Bot, port: int, timeout: float) -> float | None:
+    start = time.perf_counter()
+    try:
+        if await asyncio.wait_for(bot.connect(port), timeout):
+            return time.perf_counter() - start
+    except (OSError, asyncio.TimeoutError):
+        pass
+    return None
+
+
+async def run_bots(bots: list[Bot], nbr_of_chatters: int, rate: float, duration: float,
+                   connect_batch: int, timeout: float) -> dict:
+    handshake = Histogram()
+    latency = Histogram()
+    connected = []
+    for i in range(0, len(bots), connect_batch):
+        batch = bots[i:i + connect_batch]
+        results = await asyncio.gather(*(connect(bot, bot.port, timeout) for bot in batch))
+        for bot, elapsed in zip(batch, results):
+            if elapsed is not None:
+                handshake.record(elapsed)
+                connected.append(bot)
+    # every process connects its bots before anyone chats
+    await asyncio.sleep(1)
+    start = time.perf_counter()
+    deadline = start + duration
+    readers = [asyncio.create_task(bot.run(latency, deadline)) for bot in connected]
+    chatters = [bot for bot in connected if bot.opponent is None][:nbr_of_chatters]
+    await asyncio.gather(
+        *(bot.chat(rate, deadline) for bot in chatters),
+        *(bot.challenge(deadline) for bot in connected if bot.challenger),
+    )
+    # give in-flight messages a moment to land
+    await asyncio.sleep(max(0.0, deadline - time.perf_counter()) + 1)
+    for bot in connected:
+        bot.writer.close()
+    for task in readers:
+        task.cancel()
+    return {
+        "users": len(bots),
+        "connected": len(connected),
+        "disconnected": sum(bot.disconnected for bot in connected),
+        "sent": sum(bot.sent for bot in connected),
+        "delivered": sum(bot.delivered for bot in connected),
+        "rounds": sum(bot.rounds for bot in connected) // 2,
+        "handshake": handshake,
+        "latency": latency,
+    }
+
+
+def run_process(ports: list[int], index: int, nbr_of_processes: int, args, results):
+    # bots of this process: every nbr_of_processes-th user, players paired within the process
+    usernames = [f"bot{i}" for i in range(index, args.users, nbr_of_processes)]
+    nbr_of_players = min(args.players * len(usernames) // args.users // 2 * 2, len(usernames))
+    bots = [Bot(username) for username in usernames[nbr_of_players:]]
+    for i in range(0, nbr_of_players, 2):
+        first, second = usernames[i], usernames[i + 1]
+        bots += [Bot(first, second, challenger=True), Bot(second, first)]
+    # users spread over the servers, consecutive ones (the players of a game) on different servers
+    ports_of = {f"bot{i}": ports[i % len(ports)] for i in range(index, args.users, nbr_of_processes)}
+    for bot in bots:
+        bot.port = ports_of[bot.username]
+    chatters = args.chatters * len(usernames) // args.users
+    results.put(asyncio.run(run_bots(
+        bots, chatters, args.rate, args.duration, args.connect_batch, args.timeout)))
+
+
+def scrape(metrics_port: int) -> dict:
+    # counters and gauges of a node, read from its Prometheus endpoint
+    values = {}
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+        for line in response.read().decode().splitlines():
+            if line and not line.startswith("#") and "{" not in line:
+                name, value = line.rsplit(" ", 1)
+                values[name.removeprefix("chatroom_")] = float(value)
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--port", type=int, default=None,
+                        help="load a server already listening on this port instead of starting one")
+    parser.add_argument("--server-processes", type=int, default=1,
+                        help="worker processes of the started server, above 1 they share the port with SO_REUSEPORT (threaded engine)")
+    parser.add_argument("--nodes", type=int, default=1,
+                        help="federated nodes started and linked to each other, above 1 (threaded engine)")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--chatters", type=int, default=50,
+                        help="users sending chat lines")
+    parser.add_argument("--rate", type=float, default=2,
+                        help="chat lines per second per chatter")
+    parser.add_argument("--players", type=int, default=100,
+                        help="users playing Rock Paper Scissors, in pairs")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--connect-batch", type=int, default=16,
+                        help="concurrent connection attempts per process")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="seconds a connection has to be welcomed")
+    args = parser.parse_args()
+
+    ports = [args.port]
+    server_processes = []
+    metrics_ports = []
+    if args.port is None and args.nodes > 1:
+        # every node links to the ones started before it
+        ports = [free_port() for _ in range(args.nodes)]
+        federation_ports = [free_port() for _ in range(args.nodes)]
+        metrics_ports = [free_port() for _ in range(args.nodes)]
+        for i in range(args.nodes):
+            peers = [("127.0.0.1", federation_ports[j]) for j in range(i)]
+            server_processes.append(multiprocessing.Process(
+                target=run_node, args=(ports[i], f"node{i}", federation_ports[i], peers),
+                kwargs={"metrics_port": metrics_ports[i]}, daemon=True))
+    elif args.port is None:
+        ports = [free_port()]
+        if args.server_processes > 1:
+            # the cluster starts its own worker processes, it cannot be a daemon
+            server_processes.append(multiprocessing.Process(
+                target=run_cluster, args=(ports[0], args.server_processes)))
+        else:
+            server_processes.append(multiprocessing.Process(
+                target=run_server, args=(args.engine, ports[0]), daemon=True))
+    for server_process in server_processes:
+        server_process.start()
+    if server_processes:
+        # spawned worker processes import the server again before listening, nodes link up
+        time.sleep(1 if len(server_processes) == 1 and args.server_processes == 1 else 3)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=run_process, args=(ports, i, args.processes, args, results))
+        for i in range(args.processes)
+    ]
+    try:
+        for process in processes:
+            process.start()
+        reports = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        links = [scrape(metrics_port) for metrics_port in metrics_ports]
+    finally:
+        for server_process in server_processes:
+            server_process.kill()
+
+    handshake, latency = Histogram(), Histogram()
+    for report in reports:
+        handshake.merge(report["handshake"])
+        latency.merge(report["latency"])
+    totals = {key: sum(report[key] for report in reports)
+              for key in ("users", "connected", "disconnected", "sent", "delivered", "rounds")}
+    if args.port is not None:
+        print(f"engine: port {args.port}")
+    elif args.nodes > 1:
+        print(f"engine: threaded, {args.nodes} federated nodes")
+    elif args.server_processes > 1:
+        print(f"engine: threaded, {args.server_processes} processes")
+    else:
+        print(f"engine: {args.engine}")
+    print(f"  connected: {totals['connected']}/{totals['users']}, "
+          f"disconnected: {totals['disconnected']}")
+    print(f"  handshake: " + ", ".join(
+        f"p{q * 100:g} {handshake.quantile(q) * 1e3:.1f}ms" for q in QUANTILES))
+    print(f"  chat lines sent: {totals['sent']}, delivered: {totals['delivered']} "
+          f"({totals['delivered'] / args.duration:.0f}/s)")
+    print(f"  delivery latency: " + ", ".join(
+        f"p{q * 100:g} {latency.quantile(q) * 1e3:.2f}ms" for q in QUANTILES)
+        + f", max {latency.max * 1e3:.2f}ms")
+    print(f"  rounds played: {totals['rounds']} ({totals['rounds'] / args.duration:.0f}/s)")
+    if links:
+        messages = sum(link.get("federation_messages_sent_total", 0) for link in links)
+        batches = sum(link.get("federation_batches_sent_total", 0) for link in links)
+        duplicates = sum(link.get("federation_duplicates_total", 0) for link in links)
+        print(f"  federation links: {messages:.0f} messages in {batches:.0f} batches "
+              f"({messages / max(batches, 1):.1f} per batch), {duplicates:.0f} duplicates dropped")
+
+
+if __name__ == "__main__":
+    main()
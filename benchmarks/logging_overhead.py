@@ -0,0 +1,76 @@
+"""Time a chat line spends in the logger: per call p50, p99 and max.
+
+Run from the repository root:
+
+    python -m benchmarks.logging_overhead --lines 100000 --sink-delay 0.001
+
+sync: a stream handler writing in the calling thread, like `basicConfig`.
+queued: `LogPipeline`, the record is queued and written by its thread.
+sampled: the same, logging one chat line out of `--sample`. The sink sleeps
+`--sink-delay` seconds every 100 records, standing in for a slow disk or
+terminal.
+"""
+import argparse
+import io
+import logging
+import time
+
+from logs import TEXT_FORMAT, LogPipeline
+
+
+class SlowSink(io.StringIO):
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+        self.writes = 0
+
+    def write(self, text: str) -> int:
+        self.writes += 1
+        if self.writes % 100 == 0:
+            time.sleep(self.delay)
+        # nothing is kept, the benchmark would otherwise measure memory growth
+        return len(text)
+
+
+def run(logger: logging.Logger, nbr_of_lines: int) -> list[float]:
+    durations = []
+    for i in range(nbr_of_lines):
+        start = time.perf_counter()
+        logger.info("%s << %s", "user", f"message number {i}",
+                    extra={"event": "chat", "user": "user", "room": "lobby"})
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--sink-delay", type=float, default=0.001)
+    parser.add_argument("--sample", type=int, default=100)
+    args = parser.parse_args()
+    logger = logging.getLogger("Chat")
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    for mode in ("sync", "queued", "sampled"):
+        sink = SlowSink(args.sink_delay)
+        if mode == "sync":
+            handler = logging.StreamHandler(sink)
+            handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+            root.handlers = [handler]
+        else:
+            pipeline = LogPipeline(
+                queue_size=args.lines, sample_rates={"chat": args.sample if mode == "sampled" else 1})
+            pipeline.listener.handlers[0].setStream(sink)
+            pipeline.start()
+        durations = run(logger, args.lines)
+        dropped = 0
+        if mode != "sync":
+            pipeline.stop()
+            dropped = pipeline.dropped()
+        print(f"{mode}: p50 {durations[len(durations) // 2] * 1e6:.1f} us, "
+              f"p99 {durations[int(len(durations) * 0.99)] * 1e6:.1f} us, "
+              f"max {durations[-1] * 1e6:.0f} us, {sink.writes} written, {dropped} dropped")
+
+
+if __name__ == "__main__":
+    main()
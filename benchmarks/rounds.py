@@ -0,0 +1,100 @@
+"""Rock Paper Scissors round resolution throughput: rounds resolved per second.
+
+Run from the repository root:
+
+    python -m benchmarks.rounds --rounds 1000000 --batch 1000
+
+branching: one if/elif dispatch per round, like the former rock/paper/scissors
+methods. table: one outcome table lookup per round. batch: `resolve_batch` over
+`--batch` rounds at a time (NumPy when installed, `--no-numpy` to force the
+pure Python path). resolver: `RoundResolver` batches, including the per-game
+callback receiving the pre-encoded result frames.
+"""
+import argparse
+import random
+import time
+
+import rps
+from rps import RoundResolver, RPSEnum, resolve, resolve_batch
+
+
+def branching_winner(choice1: RPSEnum, choice2: RPSEnum) -> int:
+    if choice1 == RPSEnum.Rock:
+        if choice2 == RPSEnum.Rock:
+            return 0
+        elif choice2 == RPSEnum.Paper:
+            return 2
+        elif choice2 == RPSEnum.Scissors:
+            return 1
+    elif choice1 == RPSEnum.Paper:
+        if choice2 == RPSEnum.Rock:
+            return 1
+        elif choice2 == RPSEnum.Paper:
+            return 0
+        elif choice2 == RPSEnum.Scissors:
+            return 2
+    elif choice1 == RPSEnum.Scissors:
+        if choice2 == RPSEnum.Rock:
+            return 2
+        elif choice2 == RPSEnum.Paper:
+            return 1
+        elif choice2 == RPSEnum.Scissors:
+            return 0
+    return 2
+
+
+class StubGame:
+    # receives its round's outcome like Game.on_resolved
+    frames = 0
+
+    def on_resolved(self, outcome: int, frames: tuple[bytes, bytes]):
+        StubGame.frames += len(frames)
+
+
+def run(mode: str, choices1: list[RPSEnum], choices2: list[RPSEnum], batch: int) -> float:
+    start = time.perf_counter()
+    if mode == "branching":
+        for choice1, choice2 in zip(choices1, choices2):
+            branching_winner(choice1, choice2)
+    elif mode == "table":
+        for choice1, choice2 in zip(choices1, choices2):
+            resolve(choice1, choice2)
+    elif mode == "batch":
+        values1 = [choice._value_ for choice in choices1]
+        values2 = [choice._value_ for choice in choices2]
+        for i in range(0, len(values1), batch):
+            resolve_batch(values1[i:i + batch], values2[i:i + batch])
+    else:
+        # flushes are queued instead of handed to the worker pool, one every `batch` rounds
+        scheduled = []
+        resolver = RoundResolver(
+            lambda task: scheduled.append(task) or True)
+        games = [StubGame() for _ in range(batch)]
+        for i, (choice1, choice2) in enumerate(zip(choices1, choices2)):
+            resolver.add(games[i % batch], choice1, choice2)
+            if (i + 1) % batch == 0:
+                scheduled.pop()()
+        for flush in scheduled:
+            flush()
+    return len(choices1) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=1000000)
+    parser.add_argument("--batch", type=int, default=1000,
+                        help="rounds resolved per pass by the batched modes")
+    parser.add_argument("--no-numpy", action="store_true")
+    args = parser.parse_args()
+    if args.no_numpy:
+        rps.OUTCOME_ARRAY = None
+    print(f"numpy: {'yes' if rps.OUTCOME_ARRAY is not None else 'no'}")
+    moves = [RPSEnum.Rock, RPSEnum.Paper, RPSEnum.Scissors]
+    choices1 = random.choices(moves, k=args.rounds)
+    choices2 = random.choices(moves, k=args.rounds)
+    for mode in ("branching", "table", "batch", "resolver"):
+        print(f"{mode}: {run(mode, choices1, choices2, args.batch):,.0f} rounds/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,537 @@
+import itertools
+import json
+import logging
+import os
+import selectors
+import socket
+import struct
+import threading
+from collections import deque
+from enum import IntEnum
+from typing import Callable, Dict
+
+from leaderboard import Leaderboard
+
+# Every message between the workers of a cluster and their hub:
+#   1 byte kind | 4 bytes metadata length | 4 bytes blob length | metadata (JSON) | blob
+# the blob is a frame relayed as it is; a handoff also carries the client's
+# socket, passed as SCM_RIGHTS ancillary data
+BUS_HEADER = struct.Struct("!BII")
+# file descriptors accepted by a single recv
+MAX_FDS = 16
+# seconds a worker waits for the hub to answer a request
+REQUEST_TIMEOUT = 5.0
+# bytes the hub queues for a worker that does not read them, it is cut off beyond
+MAX_QUEUED_BYTES = 64 << 20
+
+
+class BusMessage(IntEnum):
+    Hello = 1
+    Request = 2
+    Reply = 3
+    Release = 4
+    Publish = 5
+    Route = 6
+    Undeliverable = 7
+    Handoff = 8
+    Score = 9
+    Shutdown = 10
+    # every score of the leaderboard, sent by the hub to a worker saying hello
+    Scores = 11
+
+
+def encode_message(kind: IntEnum, meta: dict, blob: bytes = b"") -> bytes:
+    meta_bytes = json.dumps(meta, separators=(",", ":")).encode()
+    return b"".join((BUS_HEADER.pack(kind, len(meta_bytes), len(blob)), meta_bytes, blob))
+
+
+def send_message(sock, data: bytes, fd: int | None = None):
+    if fd is None:
+        sock.sendall(data)
+        return
+    # the descriptor travels with the first bytes of the message
+    sent = socket.send_fds(sock, [data], [fd])
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+class MessageReader:
+    """Incremental parser of the bus messages received on one socket.
+
+    Only Unix sockets carry file descriptors, a TCP socket is read as is.
+    """
+
+    def __init__(self, sock, kinds: type[IntEnum] = BusMessage):
+        # kinds: the message kinds of the protocol spoken on the socket
+        self.sock = sock
+        self.kinds = kinds
+        # worker index, once it said hello
+        self.worker: int | None = None
+        self.__buffer = bytearray()
+        # descriptors received ahead of the handoffs they belong to
+        self.__fds: deque[int] = deque()
+
+    def recv(self) -> list[tuple[IntEnum, dict, bytes, int | None]] | None:
+        # messages completed by one recv, None once the peer closed the connection
+        if self.sock.family == socket.AF_UNIX:
+            data, fds, _, _ = socket.recv_fds(self.sock, 1 << 16, MAX_FDS)
+            self.__fds.extend(fds)
+        else:
+            data = self.sock.recv(1 << 16)
+        if not data:
+            return None
+        self.__buffer += data
+        messages = []
+        offset = 0
+        while len(self.__buffer) - offset >= BUS_HEADER.size:
+            kind, meta_length, blob_length = BUS_HEADER.unpack_from(self.__buffer, offset)
+            meta_start = offset + BUS_HEADER.size
+            blob_start = meta_start + meta_length
+            end = blob_start + blob_length
+            if end > len(self.__buffer):
+                break
+            kind = self.kinds(kind)
+            meta = json.loads(self.__buffer[meta_start:blob_start])
+            fd = self.__fds.popleft() if kind == BusMessage.Handoff and self.__fds else None
+            messages.append((kind, meta, bytes(self.__buffer[blob_start:end]), fd))
+            offset = end
+        del self.__buffer[:offset]
+        return messages
+
+    def close(self):
+        for fd in self.__fds:
+            os.close(fd)
+        self.__fds.clear()
+        self.sock.close()
+
+
+class WorkerLink:
+    """Messages the hub has yet to write to one worker.
+
+    Sends never block: what the socket does not take is queued and written
+    by the hub thread once the worker reads again, so a stalled worker never
+    holds up the others.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        sock.setblocking(False)
+        # [buffer, descriptor] to write in order, the descriptor goes with the first byte of its buffer
+        self.buffers: deque[list] = deque()
+        self.queued = 0
+        self.lock = threading.Lock()
+        # the hub thread watches the socket for writability
+        self.blocked = False
+        # cut off by the hub, nothing is sent to it anymore
+        self.closed = False
+
+    def flush(self) -> bool:
+        # called with the lock held, True once everything was written
+        while self.buffers:
+            buffer, fd = self.buffers[0]
+            if fd is None:
+                sent = self.sock.send(buffer)
+            else:
+                sent = socket.send_fds(self.sock, [buffer], [fd])
+                os.close(fd)
+                self.buffers[0][1] = None
+            self.queued -= sent
+            if sent < len(buffer):
+                self.buffers[0][0] = buffer[sent:]
+                return False
+            self.buffers.popleft()
+        return True
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for _, fd in self.buffers:
+                if fd is not None:
+                    os.close(fd)
+            self.buffers.clear()
+            self.queued = 0
+
+
+class BusHub:
+    """Relays the messages of a cluster's workers, over a Unix socket.
+
+    The hub owns the usernames of every worker's clients and the leaderboard:
+    a worker claims a username before welcoming its client, and whatever is
+    sent to a user is routed to the worker holding its connection. Chat lines
+    are published to every other worker, and scores too: every worker reads
+    its own copy of the leaderboard.
+    """
+
+    def __init__(self, path: str, leaderboard: Leaderboard):
+        self.path = path
+        self.leaderboard = leaderboard
+        self.logger = logging.getLogger("Bus")
+        self.__listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__listener.bind(path)
+        self.__listener.listen()
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__listener, selectors.EVENT_READ)
+        # worker index -> its connection
+        self.__workers: Dict[int, WorkerLink] = dict()
+        # links with messages the socket did not take, to watch for writability
+        self.__blocked: list[WorkerLink] = []
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+        self.__selector.register(self.__wakeup_reader, selectors.EVENT_READ)
+        # username -> index of the worker holding the client
+        self.__owners: Dict[str, int] = dict()
+        self.__lock = threading.Lock()
+        self.relayed = 0
+        self.__shutting_down = False
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(
+            target=self.__run, name="Bus hub", daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.__thread.is_alive():
+            self.__thread.join()
+        for key in list(self.__selector.get_map().values()):
+            if isinstance(key.data, MessageReader):
+                key.data.close()
+        for link in list(self.__workers.values()):
+            link.close()
+        self.__selector.close()
+        self.__listener.close()
+        self.__wakeup_reader.close()
+        self.__wakeup_writer.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def workers(self) -> int:
+        return len(self.__workers)
+
+    def get(self, username: str) -> str | None:
+        # the username when a worker holds such a client
+        with self.__lock:
+            return username if username in self.__owners else None
+
+    def snapshot(self) -> tuple[str, ...]:
+        with self.__lock:
+            return tuple(self.__owners)
+
+    def __len__(self) -> int:
+        return len(self.__owners)
+
+    def kick(self, username: str):
+        self.__route({"to": username, "kind": "kick"}, b"", None)
+
+    def broadcast(self, frame: bytes):
+        # to every client of every worker
+        data = encode_message(BusMessage.Publish, {"room": None}, frame)
+        for worker in list(self.__workers):
+            self.__send(worker, data)
+
+    def shutdown(self):
+        self.__shutting_down = True
+        data = encode_message(BusMessage.Shutdown, {})
+        for worker in list(self.__workers):
+            self.__send(worker, data)
+
+    def __send(self, worker: int, data: bytes, fd: int | None = None) -> bool:
+        # never blocks, from the hub or the console thread. The descriptor belongs to the link
+        # from now on, closed once sent or when the message cannot be
+        link = self.__workers.get(worker)
+        if link is None or link.closed:
+            if fd is not None:
+                os.close(fd)
+            return False
+        with link.lock:
+            if link.closed:
+                if fd is not None:
+                    os.close(fd)
+                return False
+            if link.queued + len(data) > MAX_QUEUED_BYTES:
+                if fd is not None:
+                    os.close(fd)
+                self.logger.error(f"Worker {worker} does not read its messages, cutting it off")
+                self.__cut_off(link)
+                return False
+            link.buffers.append([memoryview(data), fd])
+            link.queued += len(data)
+            try:
+                blocked = not link.blocked and not link.flush()
+            except OSError as e:
+                self.logger.warning(f"Cannot reach worker {worker}: {e}")
+                self.__cut_off(link)
+                return False
+            if blocked:
+                link.blocked = True
+        if blocked:
+            with self.__lock:
+                self.__blocked.append(link)
+            self.__wakeup()
+        self.relayed += 1
+        return True
+
+    def __cut_off(self, link: WorkerLink):
+        # the hub thread sees the connection end and drops the worker
+        link.closed = True
+        try:
+            link.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def __wakeup(self):
+        try:
+            self.__wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def __watch_blocked(self):
+        with self.__lock:
+            blocked, self.__blocked = self.__blocked, []
+        for link in blocked:
+            try:
+                key = self.__selector.get_key(link.sock)
+                self.__selector.modify(link.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, key.data)
+            except (KeyError, ValueError):
+                # dropped meanwhile
+                pass
+
+    def __on_writable(self, reader: MessageReader):
+        link = self.__workers.get(reader.worker)
+        if link is None or link.sock is not reader.sock or link.closed:
+            return
+        with link.lock:
+            try:
+                done = link.flush()
+            except OSError as e:
+                self.logger.warning(f"Cannot reach worker {reader.worker}: {e}")
+                self.__cut_off(link)
+                return
+            if done:
+                link.blocked = False
+                self.__selector.modify(link.sock, selectors.EVENT_READ, reader)
+
+    def __run(self):
+        while not self.__stop_event.is_set():
+            for key, events in self.__selector.select(0.5):
+                if key.fileobj is self.__listener:
+                    connection, _ = self.__listener.accept()
+                    self.__selector.register(
+                        connection, selectors.EVENT_READ, MessageReader(connection))
+                    continue
+                if key.fileobj is self.__wakeup_reader:
+                    try:
+                        while self.__wakeup_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                reader: MessageReader = key.data
+                if events & selectors.EVENT_WRITE:
+                    self.__on_writable(reader)
+                if not events & selectors.EVENT_READ:
+                    continue
+                try:
+                    messages = reader.recv()
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    messages = None
+                if messages is None:
+                    self.__drop(reader)
+                    continue
+                for kind, meta, blob, fd in messages:
+                    try:
+                        self.__handle(reader, kind, meta, blob, fd)
+                    except Exception as e:
+                        self.logger.error(f"Error handling {kind.name} from worker {reader.worker}: {e}")
+            self.__watch_blocked()
+
+    def __drop(self, reader: MessageReader):
+        # the worker is gone, and its clients with it
+        self.__selector.unregister(reader.sock)
+        reader.close()
+        if reader.worker is None:
+            return
+        with self.__lock:
+            link = self.__workers.get(reader.worker)
+            if link is not None and link.sock is reader.sock:
+                del self.__workers[reader.worker]
+                link.close()
+            for username in [username for username, worker in self.__owners.items() if worker == reader.worker]:
+                del self.__owners[username]
+        if not self.__shutting_down:
+            self.logger.warning(f"Worker {reader.worker} left the bus")
+
+    def __handle(self, reader: MessageReader, kind: BusMessage, meta: dict, blob: bytes, fd: int | None):
+        if kind == BusMessage.Publish:
+            data = encode_message(kind, meta, blob)
+            for worker in list(self.__workers):
+                if worker != reader.worker:
+                    self.__send(worker, data)
+        elif kind == BusMessage.Route:
+            self.__route(meta, blob, reader)
+        elif kind == BusMessage.Undeliverable:
+            # a worker lost the user meanwhile, the sender is told
+            with self.__lock:
+                sender = self.__owners.get(meta.get("sender"))
+            if sender is not None:
+                self.__send(sender, encode_message(kind, meta))
+        elif kind == BusMessage.Request:
+            result = self.__answer(reader.worker, meta["request"], meta["args"])
+            self.__send(reader.worker, encode_message(
+                BusMessage.Reply, {"id": meta["id"], "result": result}))
+        elif kind == BusMessage.Release:
+            with self.__lock:
+                if self.__owners.get(meta["username"]) == reader.worker:
+                    del self.__owners[meta["username"]]
+        elif kind == BusMessage.Handoff:
+            self.__hand_over(meta, blob, fd)
+        elif kind == BusMessage.Score:
+            self.leaderboard.record(meta["username"], meta["score"])
+            # every worker keeps a copy of the leaderboard
+            data = encode_message(kind, meta)
+            for worker in list(self.__workers):
+                if worker != reader.worker:
+                    self.__send(worker, data)
+        elif kind == BusMessage.Hello:
+            reader.worker = meta["worker"]
+            with self.__lock:
+                self.__workers[reader.worker] = WorkerLink(reader.sock)
+            # sent before anything else, the worker's leaderboard is up to date before its first claim is answered
+            self.__send(reader.worker, encode_message(
+                BusMessage.Scores, {"scores": self.leaderboard.scores()}))
+
+    def __route(self, meta: dict, blob: bytes, reader: MessageReader | None = None):
+        with self.__lock:
+            owner = self.__owners.get(meta["to"])
+        if owner is not None and self.__send(owner, encode_message(BusMessage.Route, meta, blob)):
+            return
+        if reader is not None:
+            self.__send(reader.worker, encode_message(BusMessage.Undeliverable, meta))
+
+    def __hand_over(self, meta: dict, blob: bytes, fd: int | None):
+        # the client's connection moves to another worker, and its username with it
+        if fd is None:
+            self.logger.error(f"Handoff of {meta['username']} without its socket")
+            return
+        with self.__lock:
+            self.__owners[meta["username"]] = meta["worker"]
+        # the descriptor is closed once the receiving worker got its own copy
+        if not self.__send(meta["worker"], encode_message(BusMessage.Handoff, meta, blob), fd):
+            with self.__lock:
+                if self.__owners.get(meta["username"]) == meta["worker"]:
+                    del self.__owners[meta["username"]]
+
+    def __answer(self, worker: int, request: str, args: list):
+        if request == "claim":
+            # username accepted if not already taken, checked and inserted atomically
+            with self.__lock:
+                if args[0] in self.__owners:
+                    return False
+                self.__owners[args[0]] = worker
+                return True
+        raise ValueError(f"Unknown request {request}")
+
+
+class BusClient:
+    """Connection of a worker process to the hub of its cluster.
+
+    Messages are sent from any thread; a reader thread hands the received
+    ones to `on_message`, except the replies to `request_async`.
+    """
+
+    def __init__(self, path: str, worker: int):
+        self.path = path
+        self.worker = worker
+        self.logger = logging.getLogger("Bus")
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__send_lock = threading.Lock()
+        self.__on_message: Callable[[BusMessage, dict, bytes, int | None], None] | None = None
+        self.__ids = itertools.count()
+        # request id -> callback of the reply
+        self.__pending: Dict[int, Callable[[object], None]] = dict()
+        self.__closed = False
+        self.__thread = threading.Thread(
+            target=self.__run, name="Bus", daemon=True)
+
+    def connect(self, on_message: Callable[[BusMessage, dict, bytes, int | None], None]):
+        self.__on_message = on_message
+        self.__sock.connect(self.path)
+        self.send(BusMessage.Hello, {"worker": self.worker})
+        self.__thread.start()
+
+    def close(self):
+        self.__closed = True
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.__sock.close()
+
+    def send(self, kind: BusMessage, meta: dict, blob: bytes = b"", fd: int | None = None):
+        data = encode_message(kind, meta, blob)
+        try:
+            with self.__send_lock:
+                send_message(self.__sock, data, fd)
+        except OSError as e:
+            if not self.__closed:
+                self.logger.error(f"Cannot reach the bus hub: {e}")
+
+    def request_async(self, on_reply: Callable[[object], None], request: str, *args) -> int:
+        # on_reply(result) runs on the reader thread once the hub answers, unless cancelled first
+        request_id = next(self.__ids)
+        self.__pending[request_id] = on_reply
+        self.send(BusMessage.Request, {"id": request_id, "request": request, "args": args})
+        return request_id
+
+    def cancel(self, request_id: int) -> bool:
+        # False when the reply already came, its callback ran or is running
+        return self.__pending.pop(request_id, None) is not None
+
+    def publish(self, room_name: str, frame: bytes, history: bool = True):
+        # history: the other workers add the frame to the room's history
+        self.send(BusMessage.Publish, {"room": room_name, "history": history}, frame)
+
+    def route(self, username: str, kind: str, blob: bytes = b"", **meta):
+        # to the worker holding this user's connection
+        self.send(BusMessage.Route, {"to": username, "kind": kind, **meta}, blob)
+
+    def release(self, username: str):
+        self.send(BusMessage.Release, {"username": username})
+
+    def hand_over(self, meta: dict, buffered: bytes, sock: socket.socket):
+        self.send(BusMessage.Handoff, meta, buffered, sock.fileno())
+
+    def __run(self):
+        reader = MessageReader(self.__sock)
+        while True:
+            try:
+                messages = reader.recv()
+            except OSError:
+                messages = None
+            if messages is None:
+                break
+            for kind, meta, blob, fd in messages:
+                if kind == BusMessage.Reply:
+                    on_reply = self.__pending.pop(meta["id"], None)
+                    if on_reply is not None:
+                        try:
+                            on_reply(meta["result"])
+                        except Exception as e:
+                            self.logger.error(f"Error handling the reply to request {meta['id']}: {e}")
+                    continue
+                try:
+                    self.__on_message(kind, meta, blob, fd)
+                except Exception as e:
+                    self.logger.error(f"Error handling {kind.name} from the bus: {e}")
+        if not self.__closed:
+            # the hub is gone, so is the cluster
+            self.logger.warning("Lost the connection to the bus hub")
+            self.__on_message(BusMessage.Shutdown, {}, b"", None)
@@ -0,0 +1,96 @@
+from typing import Callable, Dict
+
+from locks import new_lock
+from timers import Timer, TimerQueue
+
+
+class Challenge:
+    def __init__(self, challenger, target):
+        self.challenger = challenger
+        self.target = target
+        self.timer: Timer | None = None
+
+
+class ChallengeStore:
+    """Pending game requests indexed by challenger and by target.
+
+    A challenger has at most one pending request, a new one replaces it, so
+    the store never holds more requests than connected players. Every request
+    expires after `ttl` seconds.
+    """
+
+    def __init__(self, timers: TimerQueue, on_expire: Callable[[Challenge], None], ttl: float = 60.0):
+        self.timers = timers
+        self.on_expire = on_expire
+        self.ttl = ttl
+        self.__by_challenger: Dict[str, Challenge] = dict()
+        # target username -> challenger username -> request, oldest first
+        self.__by_target: Dict[str, Dict[str, Challenge]] = dict()
+        self.__lock = new_lock("ChallengeStore.lock")
+        self.expired = 0
+
+    def add(self, challenger, target) -> Challenge | None:
+        # new pending request, returns the one it replaced
+        challenge = Challenge(challenger, target)
+        with self.__lock:
+            replaced = self.__remove(
+                self.__by_challenger.get(challenger.getUsername()))
+            self.__by_challenger[challenger.getUsername()] = challenge
+            self.__by_target.setdefault(target.getUsername(), dict())[
+                challenger.getUsername()] = challenge
+            challenge.timer = self.timers.call_later(
+                self.ttl, self.__expire, challenge)
+        return replaced
+
+    def get(self, target_username: str) -> Challenge | None:
+        # oldest pending request sent to this player
+        challenges = self.__by_target.get(target_username)
+        if not challenges:
+            return None
+        try:
+            return next(iter(challenges.values()))
+        except (StopIteration, RuntimeError):
+            # emptied or changed by another thread meanwhile
+            return None
+
+    def pop(self, target_username: str) -> Challenge | None:
+        # oldest pending request sent to this player, no longer pending
+        with self.__lock:
+            challenges = self.__by_target.get(target_username)
+            if not challenges:
+                return None
+            return self.__remove(next(iter(challenges.values())))
+
+    def cancel(self, username: str) -> list[Challenge]:
+        # drop every request sent or received by this player
+        with self.__lock:
+            cancelled = [self.__remove(
+                self.__by_challenger.get(username))]
+            for challenge in list(self.__by_target.get(username, dict()).values()):
+                cancelled.append(self.__remove(challenge))
+        return [challenge for challenge in cancelled if challenge is not None]
+
+    def __remove(self, challenge: Challenge | None) -> Challenge | None:
+        if challenge is None:
+            return None
+        challenger_username = challenge.challenger.getUsername()
+        target_username = challenge.target.getUsername()
+        if self.__by_challenger.get(challenger_username) is not challenge:
+            return None
+        del self.__by_challenger[challenger_username]
+        challenges = self.__by_target[target_username]
+        del challenges[challenger_username]
+        if not challenges:
+            del self.__by_target[target_username]
+        challenge.timer.cancel()
+        return challenge
+
+    def __expire(self, challenge: Challenge):
+        with self.__lock:
+            if self.__remove(challenge) is None:
+                return
+            self.expired += 1
+        self.on_expire(challenge)
+
+    def __len__(self) -> int:
+        return len(self.__by_challenger)
@@ -4,6 +4,8 @@ import sys
 import select
 import logging
 
+from protocol import FrameDecoder, FrameType, ProtocolError, classify, send_frame
+
 logging.basicConfig(level=logging.INFO,
                     format='%(name)s: %(message)s',
                     )
@@ -15,6 +17,7 @@ class Client:
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.close_event = close_event
+        self.decoder = FrameDecoder()
         self.logger = logging.getLogger("Socket")
         self.messages_logger = logging.getLogger("Chat")
 
@@ -36,15 +39,34 @@ class Client:
                     sockets_list, [], [])
                 for socks in read_sockets:
                     if socks == self.server_socket:
-                        message = socks.recv(2048)
-                        decoded_message = message.decode()
-                        if (decoded_message == "close"):
+                        frames = self.decoder.recv_frames(socks)
+                        if frames is None:
                             self._close_connection_from_server()
-                        else:
-                            self.messages_logger.info(message.decode().strip())
+                            break
+                        for frame_type, payload in frames:
+                            if frame_type == FrameType.Control and payload == b"ping":
+                                # the server checks the connection is still alive
+                                send_frame(self.server_socket, FrameType.Control, "pong")
+                                continue
+                            try:
+                                # a malformed frame is shown as best it can, it never stops the loop
+                                self._handle_message(frame_type, payload.decode(errors="replace"))
+                            except Exception as e:
+                                self.logger.error(f"Error handling a message from the server: {e!r}")
+            except ProtocolError as e:
+                # the stream cannot be framed anymore, nothing after it can be read
+                self.logger.error(f"Invalid data from the server: {e}")
+                self._close_connection_from_server()
+                break
             except socket.error as e:
                 self.logger.error(f"Error connecting to the server: {e}")
 
+    def _handle_message(self, frame_type: FrameType, message: str):
+        if frame_type == FrameType.Control and message == "close":
+            self._close_connection_from_server()
+        else:
+            self.messages_logger.info(message.strip())
+
     def send_message(self):
         while not self.close_event.is_set() and not sys.stdin.closed:
             try:
@@ -53,7 +75,9 @@ class Client:
                     if message.strip() == "close":
                         self._close_connection_from_client()
                     else:
-                        self.server_socket.send(message.encode())
+                        message = message.strip()
+                        send_frame(self.server_socket,
+                                   classify(message), message)
                 sys.stdin.flush()
             except Exception as e:
                 if {e} == "I/O operation on closed file":
@@ -69,7 +93,7 @@ class Client:
     def _close_connection_from_client(self):
         self.logger.warning("Closing connection...")
         try:
-            self.server_socket.send("close".encode())
+            send_frame(self.server_socket, FrameType.Control, "close")
         except socket.error as e:
             self.logger.error(f"Error connecting to the server{e}")
             pass
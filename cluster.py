@@ -0,0 +1,493 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+from typing import Dict, Iterable, override
+
+import locks
+from bus import REQUEST_TIMEOUT, BusClient, BusHub, BusMessage
+from challenges import Challenge
+from game_server import Game, GameServer, Player
+from leaderboard import Leaderboard
+from locks import new_lock
+from logs import LogPipeline
+from metrics import Metrics
+from protocol import FrameDecoder, FrameType, encode_frame
+from server import Client, Socket_address
+from timers import Timer
+
+# seconds a player who accepted a request from another worker's player waits for its connection
+HANDOFF_TIMEOUT = 5.0
+
+
+class RemotePlayer:
+    """A player connected to another worker, as seen by the game requests of this one.
+
+    What is sent to it, and releasing its busy flag, goes over the bus to
+    the worker holding its connection.
+    """
+
+    def __init__(self, bus: BusClient, username: str):
+        self.__bus = bus
+        self.__username = username
+
+    def getUsername(self):
+        return self.__username
+
+    def send_frame(self, frame: bytes):
+        self.__bus.route(self.__username, "message", frame)
+
+    def send(self, message: str | bytes, frame_type: FrameType = FrameType.Chat):
+        self.send_frame(encode_frame(frame_type, message))
+
+    def is_locked(self):
+        # a player who sent a request is busy until it is answered
+        return True
+
+    def do_unlock(self):
+        self.__bus.route(self.__username, "unlock")
+
+
+class RemoteLeaderboard:
+    """Copy of the hub's leaderboard, kept by every worker of the cluster.
+
+    The hub sends every score to every worker, so reading the leaderboard
+    never waits on the bus.
+    """
+
+    def __init__(self, bus: BusClient):
+        self.__bus = bus
+        self.__copy = Leaderboard()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def load(self, scores: dict[str, int]):
+        # every score, sent by the hub when the worker joined the bus
+        for username, score in scores.items():
+            self.__copy.record(username, score)
+
+    def update(self, username: str, score: int):
+        # a score recorded by another worker
+        self.__copy.record(username, score)
+
+    def score(self, username: str) -> int:
+        return self.__copy.score(username)
+
+    def record(self, username: str, score: int):
+        self.__copy.record(username, score)
+        self.__bus.send(BusMessage.Score, {"username": username, "score": score})
+
+    def top(self, n: int) -> list[tuple[str, int]]:
+        return self.__copy.top(n)
+
+    def rank(self, username: str) -> tuple[int, int] | None:
+        return self.__copy.rank(username)
+
+    def __len__(self) -> int:
+        return len(self.__copy)
+
+
+class ClusterWorker(GameServer):
+    """Game server process of a cluster, serving the connections the kernel gives it.
+
+    Every worker listens on the same port with SO_REUSEPORT. Usernames are
+    claimed from the hub; chat lines are published to the other workers, and
+    private messages, game requests and kicks are routed to the worker of
+    their target. When a request between two workers' players is accepted,
+    the challenger's connection is handed over to the worker of the player
+    who accepted it, so that every game is played within one process.
+    """
+
+    def __init__(self, server_address, close_event, bus: BusClient, **kwargs):
+        super().__init__(server_address, close_event, reuse_port=True, **kwargs)
+        self.bus = bus
+        self.logger = logging.getLogger(f"Game server {bus.worker}")
+        self.leaderboard = RemoteLeaderboard(bus)
+        # usernames are claimed from the hub without blocking the handshake thread
+        self.handshakes.claim = self._claim_username
+        self.handshakes.release = bus.release
+        # challenger username -> (player who accepted its request, timeout), until its connection arrives
+        self.__handoffs: Dict[str, tuple[Player, Timer]] = dict()
+        self.__handoffs_lock = new_lock("ClusterWorker.handoffs")
+        self.handoffs_sent = self.metrics.counter(
+            "handoffs_sent", "Connections handed over to another worker for a game")
+        self.handoffs_received = self.metrics.counter(
+            "handoffs_received", "Connections handed over by another worker for a game")
+
+    @override
+    def start(self):
+        self.bus.connect(self._on_bus_message)
+        super().start()
+
+    @override
+    def _close_server(self):
+        super()._close_server()
+        self.bus.close()
+
+    def _claim_username(self, username: str, on_claimed):
+        # the username must be free on every worker, on_claimed(granted) runs on the bus or the timer thread
+        def on_reply(granted):
+            on_claimed(bool(granted))
+
+        def on_timeout():
+            if self.bus.cancel(request_id):
+                # the hub may still grant the claim, the release reaches it after the claim
+                self.logger.warning(f"No answer from the bus hub to the claim of {username}")
+                self.bus.release(username)
+                on_claimed(False)
+        request_id = self.bus.request_async(on_reply, "claim", username)
+        self.timers.call_later(REQUEST_TIMEOUT, on_timeout)
+
+    @override
+    def _register_client(self, client_socket, client_address, username: str, decoder: FrameDecoder) -> Player | None:
+        # called once the hub granted the username
+        player = super()._register_client(client_socket, client_address, username, decoder)
+        if player is None:
+            self.bus.release(username)
+            return None
+        self.bus.publish(player.getRoom().name, encode_frame(
+            FrameType.Chat, f"{username} joined the chatroom"), history=False)
+        return player
+
+    @override
+    def _client_removed(self, player: Player):
+        self.bus.release(player.getUsername())
+        # a hand-over waiting for the connection to be released is refused, its player freed
+        self.dispatcher.forget(player)
+
+    @override
+    def _disconnect_client(self, player: Player):
+        room = player.getRoom()
+        super()._disconnect_client(player)
+        if room is not None:
+            self.bus.publish(room.name, encode_frame(
+                FrameType.Chat, f"Server << {player.getUsername()} has disconnected"), history=False)
+
+    @override
+    def _broadcast_chat(self, player: Player, room, frame: bytes):
+        super()._broadcast_chat(player, room, frame)
+        self.bus.publish(room.name, frame)
+
+    @override
+    def _send_direct_message(self, player: Player, payload: bytes):
+        message_array = payload.split(b" ", 2)
+        if len(message_array) < 3 or not message_array[2].strip() or message_array[1].decode() in self.clients:
+            super()._send_direct_message(player, payload)
+            return
+        self.bus.route(message_array[1].decode(), "direct",
+                       player.direct_frame(message_array[2].strip()), sender=player.getUsername())
+
+    @override
+    def _challenge(self, player: Player, oppenent_username: str):
+        if oppenent_username in self.clients:
+            super()._challenge(player, oppenent_username)
+            return
+        # the opponent's worker keeps the request, unknown users come back undeliverable
+        self.bus.route(oppenent_username, "challenge", sender=player.getUsername())
+        player.do_lock()
+
+    @override
+    def _accept_challenge(self, player: Player, challenge: Challenge | None):
+        if challenge is None or not isinstance(challenge.challenger, RemotePlayer):
+            super()._accept_challenge(player, challenge)
+            return
+        # the game is played here, the challenger's connection is asked for
+        challenger_username = challenge.challenger.getUsername()
+        timer = self.timers.call_later(
+            HANDOFF_TIMEOUT, self.__on_handoff_timeout, challenger_username, player)
+        with self.__handoffs_lock:
+            previous = self.__handoffs.get(challenger_username)
+            self.__handoffs[challenger_username] = (player, timer)
+        if previous is not None:
+            previous[1].cancel()
+        self.bus.route(challenger_username, "handoff",
+                       sender=player.getUsername(), worker=self.bus.worker)
+
+    def _on_bus_message(self, kind: BusMessage, meta: dict, blob: bytes, fd: int | None):
+        # called from the bus reader thread, anything that may send to the bus goes to the pool
+        if kind == BusMessage.Publish:
+            self.__deliver(meta.get("room"), blob, meta.get("history", False))
+        elif kind == BusMessage.Route:
+            self.__run_task(self.__on_route, meta, blob)
+        elif kind == BusMessage.Undeliverable:
+            self.__run_task(self.__on_undeliverable, meta)
+        elif kind == BusMessage.Handoff:
+            self.__run_task(self.__adopt, meta, blob, fd)
+        elif kind == BusMessage.Score:
+            self.leaderboard.update(meta["username"], meta["score"])
+        elif kind == BusMessage.Scores:
+            self.leaderboard.load(meta["scores"])
+        elif kind == BusMessage.Shutdown:
+            if not self.close_event.is_set():
+                self._close_server()
+
+    def __run_task(self, task, *args):
+        # a saturated pool must not lose bus messages, they are then handled right away
+        if not self.pool.submit(task, *args):
+            task(*args)
+
+    def __deliver(self, room_name: str | None, frame: bytes, history: bool):
+        # a frame published by another worker, None stands for every client
+        if room_name is None:
+            self._broadcast_frame(frame, self.clients.snapshot())
+            return
+        room = self.rooms.get(room_name)
+        if room is not None:
+            self._broadcast_frame(frame, room.recipients())
+        if history:
+            self.history.append(room_name, frame)
+
+    def __on_route(self, meta: dict, blob: bytes):
+        kind = meta["kind"]
+        player = self.clients.get(meta["to"])
+        if player is None:
+            # the user left, or moved, since the hub routed the message
+            self.bus.send(BusMessage.Undeliverable, meta)
+        elif kind == "message":
+            player.send_frame(blob)
+        elif kind == "direct":
+            player.send_frame(blob)
+            self.bus.route(meta["sender"], "message", encode_frame(
+                FrameType.Chat, f"Server << Message delivered to {meta['to']}"))
+        elif kind == "unlock":
+            if player.is_locked():
+                player.do_unlock()
+        elif kind == "challenge":
+            challenger = RemotePlayer(self.bus, meta["sender"])
+            if player.getUsername() in self.players_in_game:
+                challenger.send("Server << Player is busy playing another match")
+                challenger.do_unlock()
+            else:
+                self._request_game(challenger, player)
+        elif kind == "handoff":
+            self.__hand_over(player, meta["worker"], meta["sender"])
+        elif kind == "handoff_refused":
+            pending = self.__pop_handoff(meta["sender"], player)
+            if pending is not None:
+                player.send(f"Server << {meta['reason']}")
+        elif kind == "kick":
+            self._kick_client(player)
+
+    def __on_undeliverable(self, meta: dict):
+        # nobody to deliver the message to, the sender is told
+        player = self.clients.get(meta.get("sender", ""))
+        if player is None:
+            return
+        kind = meta["kind"]
+        if kind in ("challenge", "direct"):
+            player.send(f"Server << Player <{meta['to']}> not found")
+            if kind == "challenge" and player.is_locked():
+                player.do_unlock()
+        elif kind == "handoff":
+            if self.__pop_handoff(meta["to"], player) is not None:
+                player.send(f"Server << Player <{meta['to']}> not found")
+
+    def __pop_handoff(self, challenger_username: str, player: Player) -> tuple[Player, Timer] | None:
+        with self.__handoffs_lock:
+            pending = self.__handoffs.get(challenger_username)
+            if pending is None or pending[0] is not player:
+                return None
+            del self.__handoffs[challenger_username]
+        pending[1].cancel()
+        return pending
+
+    def __on_handoff_timeout(self, challenger_username: str, player: Player):
+        # called from the timer thread
+        if self.__pop_handoff(challenger_username, player) is not None:
+            player.send(f"Server << {challenger_username} did not join the game")
+
+    def __hand_over(self, player: Player, worker: int, opponent_username: str):
+        # no game may start while the connection moves
+        username = player.getUsername()
+        with self.lock:
+            busy = username in self.players_in_game
+            if not busy:
+                self.players_in_game.add(username)
+        if busy:
+            self.bus.route(opponent_username, "handoff_refused", sender=username,
+                           reason="Player is busy playing another match")
+            return
+        # the socket is handed over once no worker reads it anymore
+        self.dispatcher.release(
+            player, lambda player: self.__send_handoff(player, worker, opponent_username))
+
+    def __send_handoff(self, player: Player, worker: int, opponent_username: str):
+        username = player.getUsername()
+        try:
+            if self.clients.get(username) is not player:
+                self.bus.route(opponent_username, "handoff_refused", sender=username,
+                               reason=f"{username} left")
+                return
+            self.matchmaking.remove(username)
+            for challenge in self.challenges.cancel(username):
+                other = challenge.target if challenge.challenger is player else challenge.challenger
+                other.send(
+                    f"Server << {username} started another game, the request was cancelled")
+                if challenge.challenger is not player and other.is_locked():
+                    other.do_unlock()
+            self.clients.remove(player)
+            room = self.rooms.leave(player)
+            # what was already queued reaches the client before it moves
+            outbound = player.getOutbound()
+            if outbound is not None:
+                outbound.join(1.0)
+            self.writer.unregister(player)
+            address = player.getAddress()
+            self.bus.hand_over({
+                "username": username,
+                "worker": worker,
+                "opponent": opponent_username,
+                "room": room.name if room is not None else self.rooms.lobby().name,
+                "score": player.getScore(),
+                "address": [address.getIp(), address.getPort()],
+            }, player.getDecoder().take_buffered(), player.getSocket())
+            # the other worker holds its own descriptor, the connection stays open
+            player.getSocket().close()
+            self.handoffs_sent.inc()
+            self.logger.info(f"{username} moved to worker {worker} to play {opponent_username}",
+                             extra={"event": "handoff", "user": username})
+        finally:
+            with self.lock:
+                self.players_in_game.discard(username)
+
+    def __adopt(self, meta: dict, buffered: bytes, fd: int | None):
+        # a connection handed over by another worker, for a game with one of this worker's players
+        username = meta["username"]
+        if fd is None:
+            return
+        decoder = FrameDecoder()
+        decoder.feed(buffered)
+        player = Player(
+            Client(
+                socket=socket.socket(fileno=fd),
+                address=Socket_address(*meta["address"]),
+                username=username,
+                decoder=decoder
+            )
+        )
+        player.setScore(meta["score"])
+        self.writer.register(player)
+        if not self.clients.add(player):
+            # cannot happen while the hub owns the username
+            self.writer.unregister(player)
+            player.getSocket().close()
+            return
+        self.rooms.join(player, meta["room"])
+        self.handoffs_received.inc()
+        with self.__handoffs_lock:
+            pending = self.__handoffs.get(username)
+        opponent = pending[0] if pending is not None else None
+        if opponent is None or self.__pop_handoff(username, opponent) is None:
+            player.send(f"Server << {meta['opponent']} left, welcome back to the chat :)")
+        elif self.clients.get(opponent.getUsername()) is not opponent:
+            player.send(f"Server << Player <{opponent.getUsername()}> not found")
+        else:
+            new_game = Game(self)
+            with new_game.lock:
+                new_game.addPlayer(opponent)
+                new_game.addPlayer(player)
+            if not self._start_game(new_game):
+                opponent.send(f"Server << Player is busy playing another match")
+                player.send(f"Server << {opponent.getUsername()} is busy playing another match")
+        self._start_client_handler(player)
+
+
+def run_worker(index: int, server_address, bus_path: str, options: dict, log_options: dict | None, profile_locks: bool):
+    # entry point of a worker process
+    if profile_locks:
+        locks.enable()
+    log_pipeline = None
+    if log_options is None:
+        logging.disable(logging.CRITICAL)
+    else:
+        log_pipeline = LogPipeline(**log_options)
+        log_pipeline.start()
+    close_event = threading.Event()
+    server = ClusterWorker(server_address, close_event,
+                           BusClient(bus_path, index), **options)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if log_pipeline is not None:
+            log_pipeline.stop()
+
+
+class Cluster:
+    """Runs `nbr_of_workers` game server processes on one port, and the bus between them.
+
+    The console works on the whole cluster: usernames are looked up on the
+    hub, kicks and messages are relayed to the workers.
+    """
+
+    def __init__(self, server_address, close_event, nbr_of_workers: int, data_dir: str | None = None,
+                 metrics_port: int | None = None, log_options: dict | None = None, profile_locks: bool = False,
+                 **options):
+        self.server_address = server_address
+        self.close_event = close_event
+        self.logger = logging.getLogger("Cluster")
+        self.__directory = tempfile.mkdtemp(prefix="chatroom-")
+        bus_path = os.path.join(self.__directory, "bus")
+        # one leaderboard for the whole cluster, kept by the hub
+        self.leaderboard = Leaderboard(
+            os.path.join(data_dir, "leaderboard") if data_dir else None)
+        self.hub = BusHub(bus_path, self.leaderboard)
+        self.clients = self.hub
+        self.metrics = Metrics()
+        self.metrics.gauge("workers", "Worker processes on the bus", self.hub.workers)
+        self.metrics.gauge("clients", "Registered clients", lambda: len(self.hub))
+        self.metrics.counter("bus_messages_relayed", "Messages relayed by the bus hub",
+                             lambda: self.hub.relayed)
+        context = multiprocessing.get_context("spawn")
+        self.processes = []
+        for index in range(nbr_of_workers):
+            worker_options = dict(options)
+            # every worker keeps its own copy of the chat history, the metrics on the next ports
+            if data_dir:
+                worker_options["data_dir"] = os.path.join(data_dir, f"worker{index}")
+            if metrics_port is not None:
+                worker_options["metrics_port"] = metrics_port + index
+            self.processes.append(context.Process(
+                target=run_worker, name=f"Worker {index}", daemon=True,
+                args=(index, server_address, bus_path, worker_options, log_options, profile_locks)))
+
+    def start(self):
+        self.leaderboard.start()
+        self.hub.start()
+        for process in self.processes:
+            process.start()
+        self.logger.info(
+            f"Listening on {self.server_address[0]}:{self.server_address[1]} with {len(self.processes)} worker processes")
+        self.close_event.wait()
+
+    def _kick_client(self, username: str):
+        self.hub.kick(username)
+
+    def _broadcast(self, message: str | bytes, usernames: Iterable[str], exclude=None):
+        # the hub sends it to every worker, for all of their clients
+        self.hub.broadcast(encode_frame(FrameType.Chat, message))
+
+    def _close_server(self):
+        self.logger.warning("Cluster is shutting down. Stopping the workers...")
+        self.hub.shutdown()
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                self.logger.error(f"{process.name} did not stop, terminating it")
+                process.terminate()
+        self.hub.stop()
+        self.leaderboard.stop()
+        shutil.rmtree(self.__directory, ignore_errors=True)
+        if not sys.stdin.closed:
+            sys.stdin.close()
+        self.close_event.set()
+        self.logger.warning("Cluster has shut down.")
@@ -0,0 +1,41 @@
+from typing import Callable, Dict
+
+
+class Command:
+    """A command line sent by a client, parsed once: its first word and the rest of the line."""
+
+    __slots__ = ("name", "args", "payload")
+
+    def __init__(self, name: str, args: str, payload: bytes):
+        self.name = name
+        self.args = args
+        # the stripped bytes received, for handlers forwarding them without re-encoding
+        self.payload = payload
+
+
+class CommandRouter:
+    """Dispatch table of the commands clients send, by their first word.
+
+    Handlers are registered by the server and its subclasses, a command word
+    registered again replaces the previous handler. Chat lines never reach
+    the router, they are told apart by their frame type.
+    """
+
+    def __init__(self):
+        self.__handlers: Dict[str, Callable[[object, Command], None]] = dict()
+
+    def register(self, name: str, handler: Callable[[object, Command], None]):
+        self.__handlers[name] = handler
+
+    def names(self) -> list[str]:
+        return list(self.__handlers)
+
+    def dispatch(self, client, payload: bytes) -> bool:
+        # runs the handler of the command, False when its first word is not a command
+        message = payload.decode()
+        name, _, args = message.partition(" ")
+        handler = self.__handlers.get(name)
+        if handler is None:
+            return False
+        handler(client, Command(name, args.strip(), payload))
+        return True
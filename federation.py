@@ -0,0 +1,604 @@
+import itertools
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Callable, Dict, override
+
+from bus import MessageReader, encode_message
+from challenges import Challenge
+from game_server import Game, GameServer, Player
+from leaderboard import Leaderboard
+from protocol import FrameDecoder, FrameType, encode_frame
+from rps import RPSEnum
+
+# seconds a link waits for more messages before writing a batch
+LINK_BATCH_DELAY = 0.002
+# a batch is written right away once this many bytes are queued
+MAX_BATCH_BYTES = 64 * 1024
+# ids of the last messages seen, copies arriving over another path are dropped
+SEEN_IDS = 65536
+# seconds between two attempts to reach a peer
+RECONNECT_INTERVAL = 1.0
+
+
+class LinkMessage(IntEnum):
+    Hello = 1
+    Join = 2
+    Leave = 3
+    Publish = 4
+    Route = 5
+    Score = 6
+
+
+class SeenIds:
+    """Ids of the last `capacity` messages received, oldest forgotten first."""
+
+    def __init__(self, capacity: int = SEEN_IDS):
+        self.capacity = capacity
+        self.__ids: set[str] = set()
+        self.__order: deque[str] = deque()
+        self.__lock = threading.Lock()
+
+    def add(self, message_id: str) -> bool:
+        # False when the id was already seen
+        with self.__lock:
+            if message_id in self.__ids:
+                return False
+            self.__ids.add(message_id)
+            self.__order.append(message_id)
+            if len(self.__order) > self.capacity:
+                self.__ids.discard(self.__order.popleft())
+            return True
+
+
+class Link:
+    """TCP connection to another node of the federation.
+
+    Messages are queued by any thread and written by the link's writer
+    thread, every message queued during `batch_delay` in one syscall; a
+    reader thread hands the received ones to `on_message`.
+    """
+
+    def __init__(self, sock: socket.socket, on_message: Callable[["Link", LinkMessage, dict, bytes], None],
+                 on_closed: Callable[["Link"], None], batch_delay: float = LINK_BATCH_DELAY):
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # name of the node at the other end, once it said hello
+        self.node: str | None = None
+        self.on_message = on_message
+        self.on_closed = on_closed
+        self.batch_delay = batch_delay
+        self.logger = logging.getLogger("Federation")
+        self.__queue: list[bytes] = []
+        self.__queued_bytes = 0
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.messages_sent = 0
+        self.batches_sent = 0
+        self.__reader = threading.Thread(target=self.__read, name="Link reader", daemon=True)
+        self.__writer = threading.Thread(target=self.__write, name="Link writer", daemon=True)
+
+    def start(self):
+        self.__reader.start()
+        self.__writer.start()
+
+    def send(self, data: bytes):
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__queue.append(data)
+            self.__queued_bytes += len(data)
+            if len(self.__queue) == 1 or self.__queued_bytes >= MAX_BATCH_BYTES:
+                self.__condition.notify()
+
+    def close(self):
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__condition.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def __write(self):
+        while True:
+            with self.__condition:
+                while not self.__queue and not self.__closed:
+                    self.__condition.wait()
+                if self.__closed:
+                    break
+                # the first message waits a little for the ones following it
+                if self.__queued_bytes < MAX_BATCH_BYTES:
+                    self.__condition.wait(self.batch_delay)
+                batch, self.__queue = self.__queue, []
+                self.__queued_bytes = 0
+            try:
+                self.sock.sendall(b"".join(batch))
+            except OSError as e:
+                self.logger.warning(f"Link to {self.node} failed: {e}")
+                break
+            self.messages_sent += len(batch)
+            self.batches_sent += 1
+        self.close()
+
+    def __read(self):
+        reader = MessageReader(self.sock, LinkMessage)
+        while True:
+            try:
+                messages = reader.recv()
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Link to {self.node} failed: {e}")
+                messages = None
+            if messages is None:
+                break
+            for kind, meta, blob, _ in messages:
+                try:
+                    self.on_message(self, kind, meta, blob)
+                except Exception as e:
+                    self.logger.error(f"Error handling {kind.name} from {self.node}: {e}")
+        self.close()
+        self.__writer.join()
+        self.sock.close()
+        self.on_closed(self)
+
+
+class FederatedLeaderboard(Leaderboard):
+    """Local leaderboard whose updates are sent to the other nodes too."""
+
+    def __init__(self, server: "FederatedServer", path: str | None = None):
+        super().__init__(path)
+        self.server = server
+
+    @override
+    def record(self, username: str, score: int):
+        super().record(username, score)
+        self.server.flood(LinkMessage.Score, {"username": username, "score": score})
+
+    def record_remote(self, username: str, score: int):
+        super().record(username, score)
+
+
+class RemotePlayer:
+    """A player connected to another node, as seen by the requests and games of this one.
+
+    Whatever is sent to it goes over the links to its node. It plays in the
+    games of this node like a local player, its own node forwards its
+    messages to the game.
+    """
+
+    def __init__(self, server: "FederatedServer", username: str, node: str, score: int):
+        self.__server = server
+        self.__username = username
+        self.node = node
+        self.__score = score
+        self.__choice = RPSEnum.NoChoice
+        self.__game = None
+        # a player who sent a request is busy until it is answered
+        self.__locked = True
+
+    def getUsername(self):
+        return self.__username
+
+    def getScore(self):
+        return self.__score
+
+    def incrementScore(self):
+        self.__score += 1
+
+    def getChoice(self) -> RPSEnum:
+        return self.__choice
+
+    def setChoice(self, choice: RPSEnum):
+        self.__choice = choice
+
+    def getGame(self):
+        return self.__game
+
+    def setGame(self, game):
+        self.__game = game
+        if game is None:
+            # the player is back to the chat of its node
+            self.__server.route(self.node, self.__username, "game_over", score=self.__score)
+
+    def getRoom(self):
+        return None
+
+    def getClient(self):
+        return self
+
+    def send_frame(self, frame: bytes):
+        self.__server.route(self.node, self.__username, "message", frame)
+
+    def send(self, message: str | bytes, frame_type: FrameType = FrameType.Chat):
+        self.send_frame(encode_frame(frame_type, message))
+
+    def is_locked(self):
+        return self.__locked
+
+    def do_unlock(self):
+        self.__locked = False
+        self.__server.route(self.node, self.__username, "unlock")
+
+
+class RemoteGame:
+    """Stand-in for a game of another node, forwarding the local player's messages to it."""
+
+    def __init__(self, server: "FederatedServer", node: str, game_id: int):
+        self.server = server
+        self.node = node
+        self.id = game_id
+
+    def on_message(self, player: Player, frame_type: FrameType, message: str):
+        if frame_type == FrameType.Control and message == "close":
+            # the connection is this node's, so is its closing
+            self.server._disconnect_client(player)
+            return
+        self.server.route(self.node, player.getUsername(), "game_message", game=self.id,
+                          sender=player.getUsername(), sender_node=self.server.node_name,
+                          frame_type=int(frame_type), message=message)
+
+    def abandon(self, player: Player):
+        self.server.route(self.node, player.getUsername(), "abandon", game=self.id,
+                          sender=player.getUsername())
+
+
+class FederatedServer(GameServer):
+    """Game server linked to other nodes, each holding its own clients.
+
+    Every message between nodes is flooded over the links with a unique id,
+    relayed by each node to its other links, and dropped where it was
+    already seen, so any connected topology works. The nodes share a
+    directory of usernames, the chat of every room, presence notices and
+    scores; private messages and game requests are routed to the target's
+    node. A game between two nodes' players is played on the node of the
+    player who accepted the request.
+    """
+
+    def __init__(self, server_address, close_event, node_name: str, federation_address: tuple[str, int],
+                 peers: list[tuple[str, int]], batch_delay: float = LINK_BATCH_DELAY, data_dir: str | None = None,
+                 **kwargs):
+        if data_dir:
+            # nodes started from the same directory keep their history and leaderboard apart
+            data_dir = os.path.join(data_dir, re.sub(r"[^\w-]", "_", node_name))
+        super().__init__(server_address, close_event, data_dir=data_dir, **kwargs)
+        self.node_name = node_name
+        self.federation_address = federation_address
+        self.peers = peers
+        self.batch_delay = batch_delay
+        self.logger = logging.getLogger(f"Node {node_name}")
+        self.leaderboard = FederatedLeaderboard(self, self.leaderboard.path)
+        self.federation_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__links: list[Link] = []
+        self.__links_lock = threading.Lock()
+        # username -> node holding the client, for the other nodes' clients
+        self.directory: Dict[str, str] = dict()
+        self.__directory_lock = threading.Lock()
+        self.__seen = SeenIds()
+        self.__ids = itertools.count()
+        self.duplicates = 0
+        self.metrics.gauge("federation_links", "Links to other nodes", lambda: len(self.__links))
+        self.metrics.gauge("federation_remote_users", "Users of the other nodes", lambda: len(self.directory))
+        self.metrics.counter("federation_messages_sent", "Messages written to the links",
+                             lambda: sum(link.messages_sent for link in list(self.__links)))
+        self.metrics.counter("federation_batches_sent", "Batches of messages written to the links",
+                             lambda: sum(link.batches_sent for link in list(self.__links)))
+        self.metrics.counter("federation_duplicates", "Messages received again over another path",
+                             lambda: self.duplicates)
+
+    @override
+    def start(self):
+        self.federation_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.federation_socket.bind(self.federation_address)
+        self.federation_socket.listen()
+        threading.Thread(target=self.__accept_links, name="Federation", daemon=True).start()
+        for peer in self.peers:
+            threading.Thread(target=self.__dial, args=(peer,), name=f"Federation {peer[0]}:{peer[1]}",
+                             daemon=True).start()
+        self.logger.info(
+            f"Federation link on {self.federation_address[0]}:{self.federation_address[1]}, peers: {self.peers}")
+        super().start()
+
+    @override
+    def _close_server(self):
+        super()._close_server()
+        try:
+            self.federation_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.federation_socket.close()
+        for link in list(self.__links):
+            link.close()
+
+    # links
+
+    def __accept_links(self):
+        while not self.close_event.is_set():
+            try:
+                sock, address = self.federation_socket.accept()
+            except OSError:
+                break
+            self.__open_link(sock)
+
+    def __dial(self, peer: tuple[str, int]):
+        # keeps a link to the peer, reconnecting when it drops
+        while not self.close_event.is_set():
+            try:
+                sock = socket.create_connection(peer, timeout=RECONNECT_INTERVAL)
+                sock.settimeout(None)
+            except OSError:
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+            link = self.__open_link(sock)
+            while link in self.__links and not self.close_event.is_set():
+                time.sleep(RECONNECT_INTERVAL)
+
+    def __open_link(self, sock: socket.socket) -> Link:
+        link = Link(sock, self.__on_link_message, self.__on_link_closed, self.batch_delay)
+        with self.__links_lock:
+            self.__links.append(link)
+        link.start()
+        link.send(encode_message(LinkMessage.Hello, {"node": self.node_name}))
+        return link
+
+    def __on_link_closed(self, link: Link):
+        with self.__links_lock:
+            if link in self.__links:
+                self.__links.remove(link)
+            still_linked = any(other.node == link.node for other in self.__links)
+        if link.node is None or still_linked or self.close_event.is_set():
+            return
+        # the node's users cannot be reached anymore
+        with self.__directory_lock:
+            for username in [username for username, node in self.directory.items() if node == link.node]:
+                del self.directory[username]
+        self.logger.warning(f"Lost the link to node {link.node}")
+
+    def flood(self, kind: LinkMessage, meta: dict, blob: bytes = b"", exclude: Link | None = None):
+        # to every linked node, each relays it further
+        if "id" not in meta:
+            meta["id"] = f"{self.node_name}:{next(self.__ids)}"
+            self.__seen.add(meta["id"])
+        data = encode_message(kind, meta, blob)
+        for link in list(self.__links):
+            if link is not exclude and link.node is not None:
+                link.send(data)
+
+    def route(self, node: str, username: str, kind: str, blob: bytes = b"", **meta):
+        # for the user `username` of `node`, the other nodes only relay it
+        self.flood(LinkMessage.Route, {"node": node, "to": username, "kind": kind, **meta}, blob)
+
+    def __on_link_message(self, link: Link, kind: LinkMessage, meta: dict, blob: bytes):
+        # called from the link's reader thread, in the order the messages were sent
+        if kind == LinkMessage.Hello:
+            link.node = meta["node"]
+            self.logger.info(f"Linked to node {link.node}")
+            self.__sync(link)
+            return
+        if not self.__seen.add(meta["id"]):
+            self.duplicates += 1
+            return
+        self.flood(kind, meta, blob, exclude=link)
+        if kind == LinkMessage.Publish:
+            self.__deliver(meta["room"], blob)
+        elif kind == LinkMessage.Route:
+            if meta["node"] == self.node_name:
+                self.__on_route(meta, blob)
+        elif kind == LinkMessage.Join:
+            self.__on_join(meta)
+        elif kind == LinkMessage.Leave:
+            self.__on_leave(meta)
+        elif kind == LinkMessage.Score:
+            self.leaderboard.record_remote(meta["username"], meta["score"])
+
+    def __sync(self, link: Link):
+        # a new link learns every user this node knows of, without presence notices
+        with self.__directory_lock:
+            users = list(self.directory.items())
+        users += [(player.getUsername(), self.node_name) for player in self.clients.snapshot()]
+        for username, node in users:
+            meta = {"id": f"{self.node_name}:{next(self.__ids)}", "username": username,
+                    "node": node, "room": None}
+            self.__seen.add(meta["id"])
+            link.send(encode_message(LinkMessage.Join, meta))
+
+    # directory and presence
+
+    def __on_join(self, meta: dict):
+        username, node = meta["username"], meta["node"]
+        local = self.clients.get(username)
+        if local is not None:
+            if node > self.node_name:
+                # the other node drops its client when it hears of this one
+                return
+            # the same username picked on two nodes at once, the smallest node name keeps it
+            local.send(f"Server << Username <{username}> is already taken on node {node}")
+            self._kick_client(local)
+        with self.__directory_lock:
+            known = self.directory.get(username)
+            if known is not None and known < node:
+                return
+            self.directory[username] = node
+        if meta["room"] is not None:
+            room = self.rooms.get(meta["room"])
+            if room is not None:
+                self._broadcast(f"{username} joined the chatroom", room.recipients())
+
+    def __on_leave(self, meta: dict):
+        username = meta["username"]
+        with self.__directory_lock:
+            if self.directory.get(username) != meta["node"]:
+                return
+            del self.directory[username]
+        room = self.rooms.get(meta["room"]) if meta["room"] is not None else None
+        if room is not None:
+            self._broadcast(f"Server << {username} has disconnected", room.snapshot())
+
+    @override
+    def _register_client(self, client_socket, client_address, username: str, decoder: FrameDecoder) -> Player | None:
+        # taken when a linked node holds a client with this username
+        if username in self.directory:
+            return None
+        player = super()._register_client(client_socket, client_address, username, decoder)
+        if player is not None:
+            self.flood(LinkMessage.Join, {"username": username, "node": self.node_name,
+                                          "room": player.getRoom().name})
+        return player
+
+    @override
+    def _client_removed(self, player: Player):
+        room = player.getRoom()
+        self.flood(LinkMessage.Leave, {"username": player.getUsername(), "node": self.node_name,
+                                       "room": room.name if room is not None else None})
+
+    # chat
+
+    @override
+    def _broadcast_chat(self, player: Player, room, frame: bytes):
+        super()._broadcast_chat(player, room, frame)
+        self.flood(LinkMessage.Publish, {"room": room.name}, frame)
+
+    def __deliver(self, room_name: str, frame: bytes):
+        room = self.rooms.get(room_name)
+        if room is not None:
+            self._broadcast_frame(frame, room.recipients())
+        self.history.append(room_name, frame)
+
+    @override
+    def _send_direct_message(self, player: Player, payload: bytes):
+        message_array = payload.split(b" ", 2)
+        node = self.directory.get(message_array[1].decode()) if len(message_array) == 3 else None
+        if node is None or not message_array[2].strip():
+            super()._send_direct_message(player, payload)
+            return
+        self.route(node, message_array[1].decode(), "direct", player.direct_frame(message_array[2].strip()),
+                   sender=player.getUsername(), sender_node=self.node_name)
+
+    # games
+
+    @override
+    def _challenge(self, player: Player, oppenent_username: str):
+        node = self.directory.get(oppenent_username)
+        if node is None:
+            super()._challenge(player, oppenent_username)
+            return
+        self.route(node, oppenent_username, "challenge", sender=player.getUsername(),
+                   sender_node=self.node_name, score=player.getScore())
+        player.do_lock()
+
+    @override
+    def _accept_challenge(self, player: Player, challenge: Challenge | None):
+        challenger = challenge.challenger if challenge is not None else None
+        if not isinstance(challenger, RemotePlayer):
+            super()._accept_challenge(player, challenge)
+            return
+        # played on this node, the challenger's node forwards its messages
+        new_game = Game(self)
+        with new_game.lock:
+            new_game.addPlayer(player)
+            new_game.addPlayer(challenger)
+        self.route(challenger.node, challenger.getUsername(), "game_started", game=new_game.id,
+                   game_node=self.node_name)
+        if not self._start_game(new_game):
+            player.send(f"Server << Player is busy playing another match")
+            challenger.setGame(None)
+
+    @override
+    def _handle_frame(self, player: Player, frame_type: FrameType, payload: bytes):
+        if isinstance(player, RemotePlayer):
+            # a message that reached the game after it ended, it belongs to the player's node
+            self.route(player.node, player.getUsername(), "replay",
+                       frame_type=int(frame_type), message=payload.decode())
+            return
+        super()._handle_frame(player, frame_type, payload)
+
+    def __game_player(self, game_id: int, username: str) -> tuple[Game | None, RemotePlayer | None]:
+        game = self.games.get(game_id)
+        if game is None:
+            return None, None
+        for player in game.players:
+            if isinstance(player, RemotePlayer) and player.getUsername() == username:
+                return game, player
+        return None, None
+
+    def __on_route(self, meta: dict, blob: bytes):
+        kind = meta["kind"]
+        # messages about a remote player of one of this node's games
+        if kind in ("game_message", "abandon"):
+            game, player = self.__game_player(meta["game"], meta["sender"])
+            if game is None:
+                if kind == "game_message":
+                    self.route(meta["sender_node"], meta["sender"], "replay",
+                               frame_type=meta["frame_type"], message=meta["message"])
+            elif kind == "game_message":
+                game.on_message(player, FrameType(meta["frame_type"]), meta["message"])
+            else:
+                game.abandon(player)
+            return
+        player = self.clients.get(meta["to"])
+        if player is None:
+            if kind in ("direct", "challenge"):
+                self.route(meta["sender_node"], meta["sender"], "message", encode_frame(
+                    FrameType.Chat, f"Server << Player <{meta['to']}> not found"))
+                if kind == "challenge":
+                    self.route(meta["sender_node"], meta["sender"], "unlock")
+            elif kind == "game_started":
+                self.route(meta["game_node"], meta["to"], "abandon", game=meta["game"], sender=meta["to"])
+            return
+        if kind == "message":
+            player.send_frame(blob)
+        elif kind == "direct":
+            player.send_frame(blob)
+            self.route(meta["sender_node"], meta["sender"], "message", encode_frame(
+                FrameType.Chat, f"Server << Message delivered to {meta['to']}"))
+        elif kind == "unlock":
+            if player.is_locked():
+                player.do_unlock()
+        elif kind == "challenge":
+            challenger = RemotePlayer(self, meta["sender"], meta["sender_node"], meta["score"])
+            if player.getUsername() in self.players_in_game:
+                challenger.send("Server << Player is busy playing another match")
+                challenger.do_unlock()
+            else:
+                self._request_game(challenger, player)
+        elif kind == "game_started":
+            self.__on_game_started(player, meta["game_node"], meta["game"])
+        elif kind == "game_over":
+            self.__on_game_over(player, meta["score"])
+        elif kind == "replay":
+            if player.getGame() is None:
+                self._handle_frame(player, FrameType(meta["frame_type"]), meta["message"].encode())
+
+    def __on_game_started(self, player: Player, game_node: str, game_id: int):
+        username = player.getUsername()
+        with self.lock:
+            busy = username in self.players_in_game or player.getGame() is not None
+            if not busy:
+                self.players_in_game.add(username)
+        if busy:
+            self.route(game_node, username, "abandon", game=game_id, sender=username)
+            return
+        player.setGame(RemoteGame(self, game_node, game_id))
+        self.matchmaking.remove(username)
+        room = player.getRoom()
+        if room is not None:
+            room.set_busy(player, True)
+
+    def __on_game_over(self, player: Player, score: int):
+        if not isinstance(player.getGame(), RemoteGame):
+            return
+        player.setGame(None)
+        player.setScore(score)
+        with self.lock:
+            self.players_in_game.discard(player.getUsername())
+        room = player.getRoom()
+        if room is not None:
+            room.set_busy(player, False)
+        if player.is_locked():
+            player.do_unlock()
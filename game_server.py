@@ -1,17 +1,39 @@
+import argparse
+import itertools
 from enum import Enum
+import os
 import socket
 import threading
+import time
 import logging
-from time import sleep
-from typing import List, override
-
+from typing import Dict, List, override
+
+from challenges import Challenge, ChallengeStore
+from commands import Command
+from leaderboard import Leaderboard
+import locks
+from locks import new_lock
+from logs import LogPipeline
+from matchmaking import MatchmakingQueue
+from metrics import TimedLock
+from outbound import OverflowPolicy
+from ratelimit import RateLimitPolicy
+from protocol import FrameDecoder, FrameType
+from registry import ClientRegistry
+from rooms import InvalidRoomName
+from rps import PLAYER1_WINS, TIE, RoundResolver, RPSEnum
 from server import Client
 from server import Server, Socket_address, UserInputHandler
+from timers import Timer
 logging.basicConfig(level=logging.INFO,
                     format='%(name)s: %(message)s',
                     )
 
 
+# seconds between two passes of the matchmaking queue
+MATCHMAKING_INTERVAL = 0.5
+
+
 class TooManyPlayersError(Exception):
     pass
 
@@ -24,23 +46,22 @@ class InvalideInput(Exception):
     pass
 
 
-class RPSEnum(Enum):
-    NoChoice = 0
-    Rock = 1
-    Paper = 2
-    Scissors = 3
-
-
 class Player(Client):
     def __init__(self, client: Client, busy: bool = True):
-        super().__init__(client.getSocket(), client.getAddress(), client.getUsername())
+        super().__init__(client.getSocket(), client.getAddress(),
+                         client.getUsername(), client.getDecoder())
         self.__choice: RPSEnum = RPSEnum.NoChoice
         self.__score: int = 0
-        self.__lock = threading.Lock()
+        self.__game: Game | None = None
+        # a busy flag, released by whichever thread ends the player's game or request
+        self.__lock = new_lock("Player.lock", ownerless=True)
 
     def getScore(self):
         return self.__score
 
+    def setScore(self, score: int):
+        self.__score = score
+
     def incrementScore(self):
         self.__score += 1
 
@@ -50,11 +71,22 @@ class Player(Client):
     def setChoice(self, choice: RPSEnum):
         self.__choice = choice
 
+    def getGame(self):
+        return self.__game
+
+    def setGame(self, game):
+        self.__game = game
+
     def getClient(self):
-        return Client(self.getSocket(), self.getAddress(), self.getUsername())
+        client = Client(self.getSocket(), self.getAddress(),
+                        self.getUsername(), self.getDecoder())
+        # messages sent to the copy keep their place in the player's outbound queue
+        client.setOutbound(self.getOutbound())
+        return client
 
     def do_lock(self):
-        self.__lock.acquire()
+        # only marks the player as busy, a worker must never wait on it
+        self.__lock.acquire(blocking=False)
 
     def do_unlock(self):
         self.__lock.release()
@@ -64,391 +96,592 @@ class Player(Client):
 
 
 class GameServer(Server):
-    def __init__(self, server_address, close_event):
-        super().__init__(server_address, close_event)
-        self.games: List[Game] = list()
-        self.clients: List[Player] = list()
+    def __init__(self, server_address, close_event, challenge_ttl: float = 60.0, **kwargs):
+        super().__init__(server_address, close_event, **kwargs)
+        self.games: Dict[int, Game] = dict()
+        # usernames of the players in a game, kept up to date as games start and end
+        self.players_in_game: set[str] = set()
+        self.clients: ClientRegistry[Player] = ClientRegistry()
         self.logger = logging.getLogger("Game server")
         self.chat_logger = logging.getLogger("Chat")
-        self.games_requests: list[tuple(str, str)] = []
-        self.games_requests_lock = threading.Lock()
+        # pending game requests, dropped after `challenge_ttl` seconds
+        self.challenges = ChallengeStore(
+            self.timers, self._on_challenge_expired, challenge_ttl)
+        # every game's finished rounds are resolved in batches on the worker pool
+        self.resolver = RoundResolver(self.pool.submit)
+        # players who typed "play any", paired by rating
+        self.matchmaking = MatchmakingQueue()
+        # every player's wins, kept across restarts when a data directory is given
+        self.leaderboard = Leaderboard(
+            os.path.join(self.data_dir, "leaderboard") if self.data_dir else None)
+        self.round_resolution = self.metrics.histogram(
+            "round_resolution_seconds", "Time from the second choice of a round to its result")
+        self.game_lock_wait = self.metrics.histogram(
+            "game_lock_wait_seconds", "Time spent waiting for a game's lock")
+        self.metrics.gauge("games", "Games being played", lambda: len(self.games))
+        self.metrics.counter("rounds_resolved", "Rounds resolved",
+                             lambda: self.resolver.rounds)
+        self.metrics.counter("round_batches", "Batches of rounds resolved",
+                             lambda: self.resolver.batches)
+        self.metrics.gauge("matchmaking_waiting", "Players in the matchmaking queue",
+                           lambda: len(self.matchmaking))
+        self.metrics.counter("matches_formed", "Games started by matchmaking",
+                             lambda: self.matchmaking.matches_formed)
+        self.metrics.gauge("matches_per_second", "Games started by matchmaking per second, recently",
+                           self.matchmaking.matches_per_second)
+        self.metrics.histogram("matchmaking_wait_seconds", "Time players waited in the matchmaking queue",
+                               self.matchmaking.wait_time)
+        self.metrics.gauge("challenges_pending", "Game requests waiting for an answer",
+                           lambda: len(self.challenges))
+        self.metrics.counter("challenges_expired", "Game requests that got no answer",
+                             lambda: self.challenges.expired)
 
     @override
     def start(self):
-        self.server_socket.setsockopt(
-            socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(4)
-        self.logger.info(f"Listening on {self.host}:{self.port}")
+        self.leaderboard.start()
+        self.timers.call_later(MATCHMAKING_INTERVAL, self.__on_matchmaking_tick)
+        super().start()
 
-        while not self.close_event.is_set():
-            try:
-                client_socket, client_address = self.server_socket.accept()
-                self.logger.info(
-                    f"Connection from client {client_address[0]}:{client_address[1]}")
-
-                new_player = self._request_client_username(
-                    client_socket, client_address, "Server << Enter your username:", 0)
-                if new_player:
-                    # assign a thread for each new subscribed client
-                    client_handler = threading.Thread(
-                        target=self._handle_client, args=(new_player,))
-                    client_handler.start()
-            except KeyboardInterrupt:
-                self._close_server()
-            except socket.error as e:
-                if 'bad file descriptor' in str(e):
-                    self.logger.error(
-                        "Server socket is closed or shutdown..!")
-                else:
-                    self.logger.error(
-                        f"Error accepting or handling new connections: {e}")
+    @override
+    def _close_server(self):
+        super()._close_server()
+        # the last scores are written before exiting
+        self.leaderboard.stop()
 
     @override
-    def _request_client_username(self, client_socket, client_address, message, nbr_of_attempts):
-        max_nbr_of_attempts = 3
-        if nbr_of_attempts >= max_nbr_of_attempts:
-            # close client's connection
-            client_socket.send(
-                "close".encode())
+    def _register_client(self, client_socket, client_address, username: str, decoder: FrameDecoder) -> Player | None:
+        new_player = Player(
+            Client(
+                socket=client_socket,
+                address=Socket_address(
+                    ip=client_address[0],
+                    port=client_address[1]
+                ),
+                username=username,
+                decoder=decoder
+            )
+        )
+        new_player.setScore(self.leaderboard.score(username))
+        self.writer.register(new_player)
+        # username accepted if not already taken, checked and inserted atomically
+        if not self.clients.add(new_player):
+            self.writer.unregister(new_player)
+            return None
+        new_player.send(f"Server << Welcome {username} :)")
+        self.logger.info(f"{username} joined the chatroom",
+                         extra={"event": "connect", "user": username})
+        # every player starts in the lobby, inform its members
+        lobby = self.rooms.join(new_player, self.rooms.lobby().name)
+        self._broadcast(f"{username} joined the chatroom", lobby.recipients())
+        self._replay_history(new_player, lobby)
+        return new_player
+
+    # handle one frame sent by a player, on a worker thread
+    @override
+    def _handle_frame(self, player: Player, frame_type: FrameType, payload: bytes):
+        game = player.getGame()
+        # players in a match only talk to their game
+        if game is not None:
+            game.on_message(player, frame_type, payload.decode().strip())
         else:
-            # request username
-            client_socket.send(message.encode())
-            # wait for client's response
-            username = client_socket.recv(2048).decode().strip()
-
-            if len(username) > 0:
-                # block access to self.clients variable
-                self.lock.acquire()
-                # check if username is not already taken
-                if username not in [client.getUsername() for client in self.clients]:
-                    new_player = Player(
-                        Client(
-                            socket=client_socket,
-                            address=Socket_address(
-                                ip=client_address[0],
-                                port=client_address[1]
-                            ),
-                            username=username
-                        )
-                    )
-                    # username accepted
-                    self.clients.append(
-                        new_player
-                    )
-                    # permet access to self.clients variable
-                    self.lock.release()
-                    client_socket.send(
-                        f"Server << Welcome {username} :)".encode())
-                    self.logger.info(f"{username} joined the chatroom")
-                    # inform other clients
-                    with self.lock:
-                        players_list = [player.getUsername(
-                        ) for game in self.games for player in game.players]
-
-                        self._broadcast(
-                            f"{username} joined the chatroom".encode(),
-                            [
-                                client for client in self.clients
-                                if client.getUsername()
-                                not in players_list
-                                and new_player.getUsername() not in players_list
-                            ]
-                        )
-                    return new_player
-                else:
-                    # permet access to self.clients variable if first condition not satisfied.
-                    # Preventing undefinete block of access to self.clients
-                    self.lock.release()
-
-                    # request another username
-                    self._request_client_username(
-                        client_socket, client_address, f"Server << Username is already taken. Connection will be closed on no attempts left. {3 - nbr_of_attempts - 1} attempts left. Enter a different username:", nbr_of_attempts + 1)
-            else:
-                # invalide username format
-                self._request_client_username(
-                    client_socket, client_address, f"Server << Invalid username. Connection will be closed on no attempts left. {3 - nbr_of_attempts - 1} attempts left. Enter a different username:", nbr_of_attempts + 1)
+            super()._handle_frame(player, frame_type, payload)
 
-    # handle incoming messages for each client
+    @override
+    def _register_commands(self):
+        super()._register_commands()
+        # client moving between chat rooms
+        for name in ("join", "leave", "rooms"):
+            self.commands.register(name, self._handle_room_command)
+        # private message, only written to the target's queue
+        self.commands.register("/msg", self._handle_direct_message_command)
+        for name in ("top", "rank"):
+            self.commands.register(name, self._handle_leaderboard_command)
+        # client requesting a match with an oppenent, or with anyone of its level
+        self.commands.register("play", self._handle_play_command)
+        self.commands.register("accept", self._handle_accept_command)
+        self.commands.register("cancel", self._handle_cancel_command)
+
+    @override
+    def _handle_chat(self, player: Player, payload: bytes):
+        # an empty line refuses the oldest game request, only then are the requests looked up
+        challenge = self.challenges.pop(player.getUsername()) if not payload else None
+        if challenge is not None:
+            opponent = challenge.challenger
+            self.chat_logger.info(
+                f"{player.getUsername()} refused game request from {opponent.getUsername()}")
+            opponent.send(
+                f"Server << {player.getUsername()} refused your request")
+            if opponent.is_locked():
+                opponent.do_unlock()
+            return
+        # checked before anyone receives it, invalid UTF-8 is a protocol error
+        message = payload.decode()
+        # the received bytes are framed as they are, never re-encoded,
+        # and only reach the room's members not playing a game
+        room = player.getRoom()
+        if room is None:
+            # left the chatroom earlier in the same batch of frames
+            return
+        self._broadcast_chat(
+            player, room, player.chat_frame(payload))
+        # logged once delivered, the log writer thread formats the line
+        self.chat_logger.info("%s << %s", player.getUsername(), message,
+                              extra={"event": "chat", "user": player.getUsername(), "room": room.name})
+        if player.is_locked():
+            player.do_unlock()
+
+    def _handle_direct_message_command(self, player: Player, command: Command):
+        self._send_direct_message(player, command.payload)
+
+    def _handle_play_command(self, player: Player, command: Command):
+        oppenent_username = command.args
+        if oppenent_username == "any":
+            self._enqueue_player(player)
+        elif not oppenent_username or oppenent_username == player.getUsername():
+            player.send(
+                f"Server << Please enter a valid oppenent's username")
+            if player.is_locked():
+                player.do_unlock()
+        else:
+            self._challenge(player, oppenent_username)
+
+    def _handle_accept_command(self, player: Player, command: Command):
+        # oldest request sent to this player, it is no longer pending once answered
+        self._accept_challenge(
+            player, self.challenges.pop(player.getUsername()))
+
+    def _handle_cancel_command(self, player: Player, command: Command):
+        if self.matchmaking.remove(player.getUsername()):
+            player.send("Server << You left the matchmaking queue")
+        else:
+            player.send("Server << You are not in the matchmaking queue")
+
+    def _challenge(self, player: Player, oppenent_username: str):
+        # check if client exists
+        oppenent_exists, opponent, error_message = self.__get_opponent(
+            oppenent_username)
+        if oppenent_exists:
+            # replaces the player's previous request, if any
+            self._request_game(player, opponent)
+            # lock the requesting player here,
+            # until the game ends
+            player.do_lock()
+        else:
+            player.send(
+                f"Server << {error_message}"
+            )
+            if player.is_locked():
+                player.do_unlock()
+
+    def _request_game(self, challenger, opponent: Player):
+        self.challenges.add(challenger, opponent)
+        opponent.send(f"Server << {challenger.getUsername(
+        )} is requesting to play Rock Paper Scissors with you. Do you accept ?\n(Enter --> accept) or (Press <Enter> to refuse)"
+        )
+
+    def _accept_challenge(self, player: Player, challenge: Challenge | None):
+        if challenge is None:
+            player.send("Server << No game request to accept")
+            return
+        # check if the challenger is still there and available
+        oppenent_exists, opponent, error_message = self.__get_opponent(
+            challenge.challenger.getUsername())
+        if oppenent_exists:
+            new_game = Game(self)
+            with new_game.lock:
+                new_game.addPlayer(player)
+                new_game.addPlayer(opponent)
+            # the game is driven by the players' messages, no thread waits for it
+            if not self._start_game(new_game):
+                player.send(
+                    f"Server << Player is busy playing another match")
+        else:
+            player.send(
+                f"Server << {error_message}")
 
     @override
-    def _handle_client(self, player: Player):
+    def _disconnect_client(self, player: Player):
+        game = player.getGame()
+        if game is not None:
+            # the opponent wins by forfeit and goes back to the chat
+            game.abandon(player)
+        self.matchmaking.remove(player.getUsername())
+        for challenge in self.challenges.cancel(player.getUsername()):
+            challenger = challenge.challenger
+            if challenger is not player:
+                challenger.send(
+                    f"Server << {player.getUsername()} has disconnected, your request was cancelled")
+                if challenger.is_locked():
+                    challenger.do_unlock()
+        super()._disconnect_client(player)
+
+    def _on_challenge_expired(self, challenge: Challenge):
+        # called from the timer thread
+        challenger = challenge.challenger
+        self.logger.info(
+            f"Game request from {challenger.getUsername()} to {challenge.target.getUsername()} expired")
+        challenger.send(
+            f"Server << {challenge.target.getUsername()} did not answer your request")
+        if challenger.is_locked():
+            challenger.do_unlock()
+
+    def _start_game(self, game: "Game") -> bool:
+        # both players are claimed atomically, False if one of them is already playing
+        usernames = [player.getUsername() for player in game.players]
+        with self.lock:
+            if any(username in self.players_in_game for username in usernames):
+                return False
+            self.players_in_game.update(usernames)
+            self.games[game.id] = game
+        for username in usernames:
+            self.matchmaking.remove(username)
+        for player in game.players:
+            room = player.getRoom()
+            # a player of another node has no room here
+            if room is not None:
+                room.set_busy(player, True)
+        game.start_game()
+        return True
+
+    def _enqueue_player(self, player: Player):
+        if player.getUsername() in self.matchmaking:
+            player.send("Server << You are already looking for an opponent")
+            return
+        pair = self.matchmaking.add(player, player.getScore())
+        if pair is not None:
+            self._start_match(*pair)
+        else:
+            player.send(
+                f"Server << Looking for an opponent... ({len(self.matchmaking)} waiting, type cancel to stop)")
+
+    def _start_match(self, player1: Player, player2: Player):
+        new_game = Game(self)
+        with new_game.lock:
+            new_game.addPlayer(player1)
+            new_game.addPlayer(player2)
+        if not self._start_game(new_game):
+            # one of them started another game meanwhile, the other one keeps waiting
+            for player in (player1, player2):
+                if player.getUsername() not in self.players_in_game and self.clients.get(player.getUsername()) is player:
+                    self._enqueue_player(player)
+
+    def __on_matchmaking_tick(self):
+        # runs on the timer thread, the matching itself goes to the worker pool
+        if self.close_event.is_set():
+            return
+        if len(self.matchmaking) > 1:
+            self.pool.submit(self.__run_matchmaking)
+        self.timers.call_later(MATCHMAKING_INTERVAL,
+                               self.__on_matchmaking_tick)
+
+    def __run_matchmaking(self):
+        pairs = self.matchmaking.match()
+        for player1, player2 in pairs:
+            self._start_match(player1, player2)
+        if pairs:
+            self.logger.info(f"Matchmaking formed {len(pairs)} games")
+
+    def _end_game(self, game: "Game"):
+        # remove the game from the list of games
+        with self.lock:
+            self.games.pop(game.id, None)
+            self.players_in_game.difference_update(
+                player.getUsername() for player in game.players)
+        for player in game.players:
+            room = player.getRoom()
+            if room is not None:
+                room.set_busy(player, False)
+
+    def _send_direct_message(self, player: Player, payload: bytes):
+        message_array = payload.split(b" ", 2)
+        if len(message_array) < 3 or not message_array[2].strip():
+            player.send("Server << Usage: /msg <username> <message>")
+            return
+        target_username = message_array[1].decode()
+        target = self.clients.get(target_username)
+        if target is None:
+            player.send(f"Server << Player <{target_username}> not found")
+        elif target is player:
+            player.send("Server << You cannot send a private message to yourself")
+        else:
+            target.send_frame(player.direct_frame(message_array[2].strip()))
+            player.send(f"Server << Message delivered to {target_username}")
+
+    def _handle_leaderboard_command(self, player: Player, command: Command):
+        if command.name == "top":
+            try:
+                n = int(command.args) if command.args else 10
+            except ValueError:
+                player.send("Server << Usage: top [n]")
+                return
+            ranking = "\n".join(
+                f"{rank}. {username} ({score})" for rank, (username, score) in enumerate(self.leaderboard.top(max(n, 0)), 1))
+            player.send(f"Server << Top players:\n{ranking}" if ranking else "Server << No games played yet")
+            return
+        username = command.args or player.getUsername()
+        rank = self.leaderboard.rank(username)
+        if rank is None:
+            player.send(f"Server << {username} has not won any game yet")
+        else:
+            player.send(
+                f"Server << {username} is ranked #{rank[0]} of {len(self.leaderboard)} with {rank[1]} wins")
+
+    def _handle_room_command(self, player: Player, command: Command):
+        if command.name == "rooms":
+            rooms = ", ".join(
+                f"{name} ({count})" for name, count in self.rooms.list())
+            player.send(f"Server << Rooms: {rooms}")
+            return
+        if command.name == "join":
+            if not command.args or " " in command.args:
+                player.send("Server << Usage: join <room>")
+                return
+            room_name = command.args
+        else:
+            room_name = self.rooms.lobby().name
+        old_room = player.getRoom()
+        if old_room is not None and old_room.name == room_name:
+            player.send(f"Server << You are already in <{room_name}>")
+            return
         try:
-            while not self.close_event.is_set():
-                data = player.getSocket().recv(1024)
-                if not data:
-                    break
-                else:
-                    message = data.decode().strip()
-                    # client requesting closing connection
-                    if message == "close":
-                        self._disconnect_client(player)
-                    # client requesting starting a match with an oppenent
-                    elif message.split(" ")[0] == "play":
-                        # check if client exists
-                        oppenent_username = message.split(" ")[1]
-                        oppenent_exists, opponent, error_message = self.__get_opponent(
-                            oppenent_username)
-                        if oppenent_username == player.getUsername():
-                            player.getSocket().send(
-                                f"Server << Please enter a valid oppenent's username".encode())
-                            if player.is_locked():
-                                player.do_unlock()
-
-                        else:
-                            if oppenent_exists:
-                                self.games_requests.append(
-                                    (player.getUsername(), oppenent_username)
-                                )
-                                opponent.getSocket().send(f"Server << {player.getUsername(
-                                )} is requesting to play Rock Paper Scissors with you. Do you accept ?\n(Enter --> accept) or (Press <Enter> to refuse)".encode()
-                                )
-                                # lock the requesting player here,
-                                # until the game ends
-                                player.do_lock()
-
-                            else:
-                                player.getSocket().send(
-                                    f"Server << {error_message}".encode()
-                                )
-                                if player.is_locked():
-                                    player.do_unlock()
-
-                    elif message.split(" ")[0].startswith("accept"):
-                        oppenent_exists, opponent, error_message = self.__get_game_request(
-                            player
-                        )
-                        if oppenent_exists:
-                            with self.games_requests_lock:
-                                self.games_requests = [game_request for game_request in self.games_requests if game_request != (
-                                    opponent.getUsername(), player.getUsername())
-                                ]
-                            new_game = Game(self)
-                            with new_game.lock:
-                                new_game.addPlayer(player)
-                                new_game.addPlayer(opponent)
-                            with self.lock:
-                                self.games.append(new_game)
-                            game_thread = threading.Thread(
-                                target=new_game.start_game
-                            )
-                            game_thread.start()
-                            # end of game
-                            game_thread.join()
-                            # release opponenet lock
-                            # if player.is_locked():
-                            #     player.do_unlock()
-                            # # inform opponent
-                            # remove the game from the list of games
-                            with self.lock:
-                                self.games = [
-                                    game for game in self.games if game.id != new_game.id
-                                ]
-                        else:
-                            player.getSocket().send(
-                                f"Server << {error_message}".encode())
-                    else:
-                        oppenent_exists, opponent, error_message = self.__get_game_request(
-                            player
-                        )
-                        if oppenent_exists:
-                            with self.games_requests_lock:
-                                self.games_requests = [game_request for game_request in self.games_requests if game_request != (
-                                    opponent.getUsername(), player.getUsername())
-                                ]
-                            self.chat_logger.info(
-                                f"{player.getUsername()} refused game request from {opponent.getUsername()}")
-                            opponent.getSocket().send(
-                                f"Server << {player.getUsername()} refused your request".encode())
-                        else:
-                            client_username = player.getUsername()
-                            self.chat_logger.info(
-                                f"{client_username} << {message}"
-                            )
-                            with self.lock:
-                                players_list = [player.getUsername(
-                                ) for game in self.games for player in game.players]
-
-                                self._broadcast(
-                                    f"{client_username} << {message}".encode(),
-                                    [
-                                        client for client in self.clients
-                                        if client.getUsername()
-                                        not in players_list
-                                        and client_username != client.getUsername()
-                                    ]
-                                )
-                            if player.is_locked():
-                                player.do_unlock()
-        except KeyboardInterrupt:
-            self._close_server()
-        except socket.error as e:
-            # send a close signal to client's socket when ERROR
-            self.logger.warning(f"Error handling client: {e}")
-            # close connection with client on ERROR
-            with self.lock:
-                self.clients.remove(player)
-
-    def __get_game_request(self, oppenent: Player) -> (bool, Player | None):
-        with self.games_requests_lock:
-            error_message = ""
-            # check if the request exists
-            for games_request in self.games_requests:
-                if games_request[1] == oppenent.getUsername():
-                    # check if the oppenent exists
-                    oppenent_exists, oppenent, message = self.__get_opponent(
-                        games_request[0]
-                    )
-                    error_message = message
-                    if oppenent_exists:
-                        return True, oppenent, None
-        return False, None, error_message
+            new_room = self.rooms.join(player, room_name)
+        except InvalidRoomName as e:
+            player.send(f"Server << {e}")
+            return
+        self.chat_logger.info(
+            f"{player.getUsername()} moved to room <{new_room.name}>",
+            extra={"event": "room", "user": player.getUsername(), "room": new_room.name})
+        if old_room is not None:
+            self._broadcast(
+                f"Server << {player.getUsername()} left <{old_room.name}>", old_room.snapshot())
+        self._broadcast(
+            f"Server << {player.getUsername()} joined <{new_room.name}>", new_room.snapshot(), exclude=player)
+        player.send(f"Server << You are now in <{new_room.name}>")
+        self._replay_history(player, new_room)
 
     def __get_opponent(self, oppenent_username: str) -> (bool, Player | None, str | None):
-        with self.lock:
-            player_busy = [player for game in self.games for player in game.players if player.getUsername(
-            ) == oppenent_username]
-            if len(player_busy) > 0:
-                return False, None, "Player is busy playing another match"
+        if oppenent_username in self.players_in_game:
+            return False, None, "Player is busy playing another match"
+
+        opponent = self.clients.get(oppenent_username)
+        if opponent is not None:
+            return True, opponent, None
+        return False, None, f"Player <{oppenent_username}> not found"
+
+
+class GameState(Enum):
+    WaitingForChoices = "waiting-for-choices"
+    # both choices are in, the next round starts after a short pause
+    Resolved = "resolved"
+    # a player typed "exit" and waits for the opponent to "quit"
+    Exiting = "exiting"
+    Closed = "closed"
+
 
-            for client in self.clients:
-                if client.getUsername() == oppenent_username:
-                    return True, client, None
-            return False, None, f"Player <{oppenent_username}> not found"
+# seconds between the end of a round and the next one
+ROUND_PAUSE = 0.5
+# how often the exiting player is reminded that the opponent has to quit
+EXIT_REMINDER_INTERVAL = 5.0
+# the game is closed anyway if the opponent never quits
+EXIT_TIMEOUT = 30.0
 
 
 class Game():
-    id = 0
+    """Rock Paper Scissors match between two players, as an explicit state machine.
+
+    Transitions are triggered by the players' messages, handed over by the
+    workers reading their sockets, and by timers. A match holds no thread and
+    never sleeps, it costs nothing but this object between two events.
+    """
+    # next() on a count is atomic, games are created from several worker threads
+    ids = itertools.count(1)
 
     def __init__(self, gameServer: GameServer):
         self.gameServer = gameServer
         self.players: List[Player] = list()
-        self.lock = threading.Lock()
-        self.game_close_event = threading.Event()
+        # reentrant, a "close" disconnects the player which abandons the game
+        self.lock = TimedLock(gameServer.game_lock_wait, new_lock("Game.lock", reentrant=True))
+        self.state = GameState.WaitingForChoices
+        self.exiting_player: Player | None = None
+        self.round_finished_at = 0.0
+        self.timers: list[Timer] = []
         self.logger = logging.getLogger("Game")
-        Game.id += 1
+        self.id = next(Game.ids)
 
     def start_game(self):
-        # Start the rock-paper-scissors game logic here
-        player1, player2 = self.players
-
-        while not self.game_close_event.is_set():
-            self.logger.info(
-                f"Game Started {player1.getUsername()} VS {
-                    player2.getUsername()}"
-            )
-            player1.getSocket().send(
-                f"Server << You are playing against <{
-                    player2.getUsername()}>".encode()
-            )
-            player2.getSocket().send(
-                f"Server << You are playing against <{
-                    player1.getUsername()}>".encode()
-            )
+        with self.lock:
+            for player in self.players:
+                player.setGame(self)
+            self.__start_round()
 
-            self.gameServer._broadcast("Server << Make your choice...\n1- Rock\n2- Paper\n3- Scissors".encode(),
-                                       [player1.getClient(), player2.getClient()]
-                                       )
-            # assign a thread for each new subscribed client
-            player1_handler = threading.Thread(
-                target=self.__handle_client, args=(player1,), daemon=True)
-            player2_handler = threading.Thread(
-                target=self.__handle_client, args=(player2,), daemon=True)
-            player1_handler.start()
-            player2_handler.start()
-
-            player1_handler.join()
-            player2_handler.join()
-            if self.game_close_event.is_set():
-                # Reset players for the next round
-                with self.lock:
-                    for player in self.players:
-                        player.setChoice(RPSEnum.NoChoice)
-                break
-            result = self.__determine_winner(RPSEnum(player1.getChoice(
-            )), RPSEnum(player2.getChoice()))
-
-            if result == 0:
-                self.logger.info(
-                    f"{player1.getUsername()} VS {player2.getUsername()} << It's a tie!")
-                self.server._broadcast("Server << It's a tie!".encode(), [
-                    player1.getClient(), player2.getClient()])
-            elif result == 1:
+    def __start_round(self):
+        player1, player2 = self.players
+        self.state = GameState.WaitingForChoices
+        self.logger.info(
+            f"Game Started {player1.getUsername()} VS {
+                player2.getUsername()}",
+            extra={"event": "game_start", "game": self.id}
+        )
+        player1.send(
+            f"Server << You are playing against <{
+                player2.getUsername()}>"
+        )
+        player2.send(
+            f"Server << You are playing against <{
+                player1.getUsername()}>"
+        )
+
+        self.gameServer._broadcast("Server << Make your choice...\n1- Rock\n2- Paper\n3- Scissors",
+                                   [player1.getClient(), player2.getClient()]
+                                   )
+
+    def __finish_round(self):
+        player1, player2 = self.players
+        self.state = GameState.Resolved
+        self.round_finished_at = time.perf_counter()
+        self.gameServer.resolver.add(
+            self, player1.getChoice(), player2.getChoice())
+        # Reset players for the next round
+        for player in self.players:
+            player.setChoice(RPSEnum.NoChoice)
+
+    def on_resolved(self, outcome: int, frames: tuple[bytes, bytes]):
+        # called by the resolver with the round's outcome and each player's result frame
+        with self.lock:
+            if self.state != GameState.Resolved:
+                # a player left before the round was resolved
+                return
+            self.gameServer.round_resolution.record(
+                time.perf_counter() - self.round_finished_at)
+            player1, player2 = self.players
+            player1.send_frame(frames[0])
+            player2.send_frame(frames[1])
+            if outcome == TIE:
                 self.logger.info(
-                    f"{player1.getUsername()} VS {player2.getUsername()} << {player1.getUsername()} won!!")
-                player1.getSocket().send("Server << You win!!".encode())
-                self.gameServer._broadcast(f"Server << {player1.getUsername()} wins!".encode(), [
-                    player2.getClient()])
-                player1.incrementScore()
+                    "%s VS %s << It's a tie!", player1.getUsername(), player2.getUsername(),
+                    extra={"event": "round", "game": self.id})
             else:
+                winner = player1 if outcome == PLAYER1_WINS else player2
                 self.logger.info(
-                    f"{player1.getUsername()} VS {player2.getUsername()} << {player2.getUsername()} won!!")
-                player2.getSocket().send("Server << You win!!".encode())
-                self.gameServer._broadcast(f"Server << You lost :((".encode(), [
-                    player1.getClient()])
-                player2.incrementScore()
-
-            # Reset players for the next round
-            with self.lock:
-                for player in self.players:
-                    player.setChoice(RPSEnum.NoChoice)
-
-    # handle incoming messages for each client
-    def __handle_client(self, player: Player):
-        while not self.game_close_event.is_set() and player.getChoice() == RPSEnum.NoChoice:
-            data = player.getSocket().recv(1024)
-            if not data:
-                player.setChoice(RPSEnum.NoChoice)
+                    "%s VS %s << %s won!!", player1.getUsername(), player2.getUsername(), winner.getUsername(),
+                    extra={"event": "round", "game": self.id, "user": winner.getUsername()})
+                winner.incrementScore()
+                self.gameServer.leaderboard.record(
+                    winner.getUsername(), winner.getScore())
+            self.__schedule(ROUND_PAUSE, self.__on_round_pause)
+
+    def __opponent(self, player: Player) -> Player:
+        return self.players[1] if self.players[0] is player else self.players[0]
+
+    def __schedule(self, delay: float, callback, *args):
+        self.timers.append(
+            self.gameServer.timers.call_later(delay, callback, *args))
+
+    def __cancel_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
+
+    # handle a message sent by one of the players
+    def on_message(self, player: Player, frame_type: FrameType, message: str):
+        with self.lock:
+            if self.state == GameState.Closed:
+                # the game ended while the message was on its way, it belongs to the chat
+                if player.getGame() is None and message != "quit":
+                    self.gameServer._handle_frame(
+                        player, frame_type, message.encode())
+                return
+            if frame_type == FrameType.Control and message == "close":
+                self.gameServer._disconnect_client(player)
+            elif message == "quit":
+                self.__close()
+                if player is not self.exiting_player:
+                    player.send(f"Server << Welcome back to the chat :)")
+            elif self.state == GameState.Exiting:
+                self.__on_exiting_message(player)
+            elif message == "exit":
+                self.__exit(player)
+            elif message in ["1", "2", "3"]:
+                self.__on_choice(player, RPSEnum(int(message)))
             else:
-                message = data.decode().strip()
-                if message == "close":
-                    self.server._disconnect_client(player.getClient())
-                else:
-                    player_username = player.getClient().getUsername()
-                    with self.lock:
-                        opponent = [
-                            other_player for other_player in self.players if other_player.getUsername() != player_username
-                        ][0]
-                    if message in ["1", "2", "3"]:
-                        player.setChoice(RPSEnum(int(message)))
-                        self.gameServer.logger.info(
-                            f"{player_username} VS {opponent.getUsername()} << {player_username} chose {RPSEnum(int(message)).name}")
-                    elif message == "exit":
-                        opponent = [opponent for oppenent in self.players if opponent.getUsername(
-                        ) != player_username
-                        ]
-                        if len(opponent) > 0:
-                            opponent[0].getSocket().send(f"Server << {player_username} quit the game. You win :)".encode()
-                                                         )
-                            while not self.game_close_event.is_set():
-                                player.getSocket().send(
-                                    f"Server << Waiting for your oppenent to exit the game...".encode())
-                                sleep(1)
-
-                            player.getSocket().send(
-                                f"Server << Welcome back to the chat :)".encode())
-                            if player.is_locked():
-                                player.do_unlock()
-                            return
-                    elif message == "quit":
-                        self.game_close_event.set()
-                        player.getSocket().send(f"Server << Welcome back to the chat :)".encode())
-                        if player.is_locked():
-                            player.do_unlock()
-                        return
-                    else:
-                        if not self.game_close_event.is_set():
-                            player.getSocket().send("Server << Please enter a valid choice!".encode())
-
-    def __determine_winner(self, choice1: RPSEnum, choice2: RPSEnum):
-        if choice1 == RPSEnum.Rock:
-            return self.rock(choice2)
-        elif choice1 == RPSEnum.Paper:
-            return self.paper(choice2)
-        elif choice1 == RPSEnum.Scissors:
-            return self.scissors(choice2)
+                player.send("Server << Please enter a valid choice!")
+
+    def __on_choice(self, player: Player, choice: RPSEnum):
+        opponent = self.__opponent(player)
+        if self.state == GameState.Resolved:
+            player.send(f"Server << The next round is about to start...")
+        elif player.getChoice() != RPSEnum.NoChoice:
+            player.send(
+                f"Server << Waiting for <{opponent.getUsername()}> to choose...")
         else:
-            return 2
+            player.setChoice(choice)
+            self.gameServer.logger.info(
+                "%s VS %s << %s chose %s", player.getUsername(), opponent.getUsername(), player.getUsername(), choice.name,
+                extra={"event": "choice", "user": player.getUsername(), "game": self.id})
+            if opponent.getChoice() != RPSEnum.NoChoice:
+                self.__finish_round()
+
+    def __on_exiting_message(self, player: Player):
+        if player is self.exiting_player:
+            player.send(
+                f"Server << Waiting for your oppenent to exit the game...")
+        else:
+            player.send(
+                f"Server << {self.exiting_player.getUsername()} quit the game. You win :)")
+
+    def __exit(self, player: Player):
+        self.__cancel_timers()
+        self.state = GameState.Exiting
+        self.exiting_player = player
+        self.__opponent(player).send(
+            f"Server << {player.getUsername()} quit the game. You win :)")
+        player.send(
+            f"Server << Waiting for your oppenent to exit the game...")
+        self.__schedule(EXIT_REMINDER_INTERVAL, self.__on_exit_reminder)
+        self.__schedule(EXIT_TIMEOUT, self.__on_exit_timeout)
+
+    def __on_round_pause(self):
+        with self.lock:
+            if self.state == GameState.Resolved:
+                self.__start_round()
+
+    def __on_exit_reminder(self):
+        with self.lock:
+            if self.state == GameState.Exiting:
+                self.exiting_player.send(
+                    f"Server << Waiting for your oppenent to exit the game...")
+                self.__schedule(EXIT_REMINDER_INTERVAL,
+                                self.__on_exit_reminder)
+
+    def __on_exit_timeout(self):
+        with self.lock:
+            if self.state == GameState.Exiting:
+                opponent = self.__opponent(self.exiting_player)
+                opponent.send(f"Server << Welcome back to the chat :)")
+                self.__close()
+
+    def abandon(self, player: Player):
+        # the player disconnected in the middle of the game
+        with self.lock:
+            if self.state == GameState.Closed:
+                return
+            opponent = self.__opponent(player)
+            opponent.send(
+                f"Server << {player.getUsername()} left the game. Welcome back to the chat :)")
+            self.exiting_player = None
+            self.__close()
+
+    def __close(self):
+        self.__cancel_timers()
+        self.state = GameState.Closed
+        for player in self.players:
+            player.setChoice(RPSEnum.NoChoice)
+            player.setGame(None)
+            if player.is_locked():
+                player.do_unlock()
+        if self.exiting_player is not None:
+            self.exiting_player.send(f"Server << Welcome back to the chat :)")
+        self.gameServer._end_game(self)
 
     def addPlayer(self, player: Player):
         if len(self.players) < 2:
@@ -456,35 +689,130 @@ class Game():
         else:
             raise TooManyPlayersError("Number of players exceeded")
 
-    def rock(self, other_choice):
-        if other_choice == 'rock':
-            return 0  # Tie
-        elif other_choice == 'paper':
-            return 2  # Player 2 wins
-        elif other_choice == 'scissors':
-            return 1  # Player 1 wins
-
-    def paper(self, other_choice):
-        if other_choice == 'rock':
-            return 1  # Player 1 wins
-        elif other_choice == 'paper':
-            return 0  # Tie
-        elif other_choice == 'scissors':
-            return 2  # Player 2 wins
-
-    def scissors(self, other_choice):
-        if other_choice == 'rock':
-            return 2  # Player 2 wins
-        elif other_choice == 'paper':
-            return 1  # Player 1 wins
-        elif other_choice == 'scissors':
-            return 0  # Tie
-
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rock Paper Scissors chatroom server")
+    parser.add_argument("--port", type=int, default=12345,
+                        help="port the clients connect to")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="threaded: a fixed pool of worker threads (default), asyncio: single event loop")
+    parser.add_argument("--overflow-policy", choices=[policy.value for policy in OverflowPolicy], default=OverflowPolicy.DropOldest.value,
+                        help="what to do when a client's outbound queue is full (threaded engine)")
+    parser.add_argument("--max-queued-frames", type=int, default=1024,
+                        help="outbound queue size per client (threaded engine)")
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN,
+                        help="pending connections the kernel queues before accept")
+    parser.add_argument("--handshake-timeout", type=float, default=10.0,
+                        help="seconds a new connection has to pick a username")
+    parser.add_argument("--heartbeat-interval", type=float, default=15.0,
+                        help="seconds of silence before a client is pinged, 0 disables the heartbeats (threaded engine)")
+    parser.add_argument("--idle-timeout", type=float, default=45.0,
+                        help="seconds of silence before a client is disconnected (threaded engine)")
+    parser.add_argument("--rate-limit", type=float, default=20.0,
+                        help="messages per second a client may send, 0 does not limit them (threaded engine)")
+    parser.add_argument("--byte-rate-limit", type=float, default=64 * 1024,
+                        help="bytes per second a client may send, 0 does not limit them (threaded engine)")
+    parser.add_argument("--rate-limit-burst", type=float, default=2.0,
+                        help="seconds of traffic at the full rate a client may send at once (threaded engine)")
+    parser.add_argument("--rate-limit-policy", choices=[policy.value for policy in RateLimitPolicy], default=RateLimitPolicy.Drop.value,
+                        help="what to do with a client going beyond its rate limit: drop its messages, delay reading them, or kick it (threaded engine)")
+    parser.add_argument("--challenge-ttl", type=float, default=60.0,
+                        help="seconds a game request waits for an answer (threaded engine)")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="threads handling every client's messages (threaded engine)")
+    parser.add_argument("--max-clients", type=int, default=10000,
+                        help="connections refused beyond this number of clients (threaded engine)")
+    parser.add_argument("--data-dir", default="data",
+                        help="directory where the leaderboard and the chat history are saved (threaded engine)")
+    parser.add_argument("--replay-on-join", type=int, default=0,
+                        help="past messages of a room sent to whoever joins it (threaded engine)")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text",
+                        help="text lines, or one JSON object per line with the user, room, game and event of each record")
+    parser.add_argument("--log-file", default=None,
+                        help="file the logs are written to, stderr by default")
+    parser.add_argument("--log-queue-size", type=int, default=10000,
+                        help="log records waiting to be written, newer ones are dropped beyond it")
+    parser.add_argument("--log-sample-chat", type=int, default=1,
+                        help="log one chat line out of this many")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve the metrics in Prometheus text format on http://127.0.0.1:<port>/metrics (threaded engine)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port with SO_REUSEPORT, relaying to each other over a local bus (threaded engine)")
+    parser.add_argument("--federation-port", type=int, default=None,
+                        help="link this server to other nodes, which connect to this port (threaded engine)")
+    parser.add_argument("--federation-host", default="127.0.0.1",
+                        help="address the federation port listens on, 0.0.0.0 for nodes on other hosts")
+    parser.add_argument("--peer", action="append", default=[],
+                        help="host:port of another node's federation port to link to, may be repeated")
+    parser.add_argument("--node-name", default=None,
+                        help="name of this node in the federation, 127.0.0.1:<port> by default")
+    parser.add_argument("--profile-locks", action="store_true",
+                        help="record the wait and hold times of the server's locks, reported by the 'locks' command (threaded engine)")
+    args = parser.parse_args()
+    if args.federation_port is not None and args.processes > 1:
+        parser.error("--federation-port and --processes cannot be combined")
+    if args.profile_locks:
+        locks.enable()
     close_event = threading.Event()
-
-    server = GameServer(("127.0.0.1", 12345), close_event)
+    # loggers only queue their records, a single thread formats and writes them
+    log_options = dict(format=args.log_format, path=args.log_file, queue_size=args.log_queue_size,
+                       sample_rates={"chat": args.log_sample_chat})
+    log_pipeline = LogPipeline(**log_options)
+    log_pipeline.start()
+
+    if args.engine == "asyncio":
+        from async_game_server import AsyncGameServer
+        server = AsyncGameServer(("127.0.0.1", args.port), close_event,
+                                 backlog=args.backlog,
+                                 handshake_timeout=args.handshake_timeout)
+    elif args.processes > 1:
+        from cluster import Cluster
+        server = Cluster(("127.0.0.1", args.port), close_event, args.processes,
+                         data_dir=args.data_dir,
+                         metrics_port=args.metrics_port,
+                         log_options=log_options,
+                         profile_locks=args.profile_locks,
+                         overflow_policy=OverflowPolicy(args.overflow_policy),
+                         max_queued_frames=args.max_queued_frames,
+                         backlog=args.backlog,
+                         handshake_timeout=args.handshake_timeout,
+                         heartbeat_interval=args.heartbeat_interval,
+                         idle_timeout=args.idle_timeout,
+                         message_rate=args.rate_limit,
+                         byte_rate=args.byte_rate_limit,
+                         rate_limit_burst=args.rate_limit_burst,
+                         rate_limit_policy=RateLimitPolicy(args.rate_limit_policy),
+                         challenge_ttl=args.challenge_ttl,
+                         nbr_of_workers=args.workers,
+                         max_clients=args.max_clients,
+                         replay_on_join=args.replay_on_join)
+    else:
+        options = dict(overflow_policy=OverflowPolicy(args.overflow_policy),
+                       max_queued_frames=args.max_queued_frames,
+                       backlog=args.backlog,
+                       handshake_timeout=args.handshake_timeout,
+                       heartbeat_interval=args.heartbeat_interval,
+                       idle_timeout=args.idle_timeout,
+                       message_rate=args.rate_limit,
+                       byte_rate=args.byte_rate_limit,
+                       rate_limit_burst=args.rate_limit_burst,
+                       rate_limit_policy=RateLimitPolicy(args.rate_limit_policy),
+                       challenge_ttl=args.challenge_ttl,
+                       nbr_of_workers=args.workers,
+                       max_clients=args.max_clients,
+                       data_dir=args.data_dir,
+                       replay_on_join=args.replay_on_join,
+                       metrics_port=args.metrics_port)
+        if args.federation_port is not None:
+            from federation import FederatedServer
+            peers = [(peer.rsplit(":", 1)[0], int(peer.rsplit(":", 1)[1])) for peer in args.peer]
+            server = FederatedServer(("127.0.0.1", args.port), close_event,
+                                     args.node_name or f"127.0.0.1:{args.port}",
+                                     (args.federation_host, args.federation_port), peers, **options)
+        else:
+            server = GameServer(("127.0.0.1", args.port), close_event, **options)
+        server.metrics.counter("log_records_dropped", "Log records dropped by a full log queue",
+                               log_pipeline.dropped)
     start_thread = threading.Thread(target=server.start)
 
     user_input_handler = UserInputHandler(server, close_event)
@@ -503,3 +831,6 @@ if __name__ == "__main__":
         user_input_handler.stop()
         user_input_thread.join()
         logging.info(f"Exiting...")
+        if log_pipeline.dropped():
+            logging.warning(f"{log_pipeline.dropped()} log records were dropped")
+        log_pipeline.stop()
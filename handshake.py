@@ -0,0 +1,240 @@
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+from typing import Callable
+
+from metrics import Histogram
+from outbound import MSG_DONTWAIT
+from protocol import FrameDecoder, FrameType, ProtocolError, encode_frame, send_frame
+
+MAX_NBR_OF_ATTEMPTS = 3
+CLOSE_FRAME = encode_frame(FrameType.Control, "close")
+
+
+class PendingConnection:
+    # an accepted socket that has not picked a username yet
+    def __init__(self, client_socket, client_address, deadline: float):
+        self.socket = client_socket
+        self.address = client_address
+        self.decoder = FrameDecoder()
+        self.deadline = deadline
+        self.accepted_at = time.monotonic()
+        self.attempts = 0
+        self.done = False
+        # waiting for its username to be claimed, not read meanwhile
+        self.claiming = False
+
+
+class HandshakeStage:
+    """Single thread asking every new connection for its username.
+
+    The accept loop only hands sockets over, so a client that never answers
+    holds nothing but its own slot until its deadline expires. Each connection
+    is a small state machine advanced by the frames it sends.
+    """
+
+    def __init__(self, register: Callable[[socket.socket, tuple, str, FrameDecoder], object | None], on_ready: Callable[[object], None], timeout: float = 10.0,
+                 claim: Callable[[str, Callable[[bool], None]], None] | None = None, release: Callable[[str], None] | None = None):
+        # register: username taken -> None, otherwise the registered client.
+        # claim: asks for a username from elsewhere, its callback may run on any thread later on;
+        # release: gives back a claimed username whose connection was closed meanwhile
+        self.register = register
+        self.on_ready = on_ready
+        self.timeout = timeout
+        self.claim = claim
+        self.release = release
+        self.logger = logging.getLogger("Handshake")
+        self.__selector = selectors.DefaultSelector()
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+        self.__selector.register(self.__wakeup_reader, selectors.EVENT_READ)
+        self.__incoming: list[PendingConnection] = []
+        # (connection, username, granted) of the answered claims
+        self.__claimed: list[tuple[PendingConnection, str, bool]] = []
+        self.__incoming_lock = threading.Lock()
+        # (deadline, sequence, connection), stale entries are skipped when popped
+        self.__deadlines: list[tuple[float, int, PendingConnection]] = []
+        self.__sequence = itertools.count()
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(
+            target=self.__run, name="Handshake", daemon=True)
+        # accept to registration, for the connections that got a username
+        self.latency = Histogram()
+        self.completed = 0
+        self.timed_out = 0
+        self.rejected = 0
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        self.__wakeup()
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def add(self, client_socket, client_address):
+        # called from the accept loop, never blocks on the client
+        pending = PendingConnection(
+            client_socket, client_address, time.monotonic() + self.timeout)
+        with self.__incoming_lock:
+            self.__incoming.append(pending)
+            wakeup = len(self.__incoming) == 1
+        if wakeup:
+            self.__wakeup()
+
+    def pending(self) -> int:
+        return len(self.__selector.get_map()) - 1
+
+    def __wakeup(self):
+        try:
+            self.__wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def __run(self):
+        while not self.__stop_event.is_set():
+            timeout = None
+            if self.__deadlines:
+                timeout = max(0, self.__deadlines[0][0] - time.monotonic())
+            for key, _ in self.__selector.select(timeout):
+                if key.fileobj is self.__wakeup_reader:
+                    try:
+                        while self.__wakeup_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.__receive(key.data)
+            with self.__incoming_lock:
+                incoming, self.__incoming = self.__incoming, []
+                claimed, self.__claimed = self.__claimed, []
+            for pending in incoming:
+                self.__begin(pending)
+            for pending, username, granted in claimed:
+                self.__on_claimed(pending, username, granted)
+            self.__expire(time.monotonic())
+        for key in list(self.__selector.get_map().values()):
+            if key.fileobj is not self.__wakeup_reader:
+                self.__close(key.data)
+        self.__selector.close()
+        self.__wakeup_reader.close()
+        self.__wakeup_writer.close()
+
+    def __begin(self, pending: PendingConnection):
+        try:
+            self.__selector.register(
+                pending.socket, selectors.EVENT_READ, pending)
+            heapq.heappush(self.__deadlines,
+                           (pending.deadline, next(self.__sequence), pending))
+            send_frame(pending.socket, FrameType.Chat,
+                       "Server << Enter your username:")
+        except (OSError, ValueError) as e:
+            self.logger.warning(
+                f"Error greeting {pending.address[0]}:{pending.address[1]}: {e}")
+            self.__close(pending)
+
+    def __receive(self, pending: PendingConnection):
+        try:
+            frames = pending.decoder.recv_frames(pending.socket)
+            if frames is None:
+                self.__close(pending)
+                return
+            for _, payload in frames:
+                self.__on_username(pending, payload.decode().strip())
+                if pending.done or pending.claiming:
+                    return
+        except (OSError, UnicodeDecodeError, ProtocolError) as e:
+            self.logger.warning(
+                f"Error during handshake with {pending.address[0]}:{pending.address[1]}: {e}")
+            self.__close(pending)
+
+    def __on_username(self, pending: PendingConnection, username: str):
+        if len(username) == 0:
+            self.__retry(pending, "Invalid username")
+            return
+        # stop watching first, the client's own thread reads the socket from now on
+        self.__selector.unregister(pending.socket)
+        if self.claim is None:
+            self.__register(pending, username)
+            return
+        # the handshake thread does not wait for the answer, other connections go on meanwhile
+        pending.claiming = True
+        self.claim(username, lambda granted: self.__answer_claim(pending, username, granted))
+
+    def __answer_claim(self, pending: PendingConnection, username: str, granted: bool):
+        # called from any thread, the claim is handled on the handshake thread
+        with self.__incoming_lock:
+            self.__claimed.append((pending, username, granted))
+        self.__wakeup()
+
+    def __on_claimed(self, pending: PendingConnection, username: str, granted: bool):
+        pending.claiming = False
+        if pending.done:
+            # timed out while waiting
+            if granted and self.release is not None:
+                self.release(username)
+            return
+        try:
+            if granted:
+                self.__register(pending, username)
+            else:
+                self.__watch_again(pending, "Username is already taken")
+        except (OSError, ValueError) as e:
+            self.logger.warning(
+                f"Error during handshake with {pending.address[0]}:{pending.address[1]}: {e}")
+            self.__close(pending)
+
+    def __register(self, pending: PendingConnection, username: str):
+        client = self.register(
+            pending.socket, pending.address, username, pending.decoder)
+        if client is not None:
+            pending.done = True
+            self.completed += 1
+            self.latency.record(time.monotonic() - pending.accepted_at)
+            self.on_ready(client)
+            return
+        self.__watch_again(pending, "Username is already taken")
+
+    def __watch_again(self, pending: PendingConnection, reason: str):
+        self.__selector.register(
+            pending.socket, selectors.EVENT_READ, pending)
+        self.__retry(pending, reason)
+
+    def __retry(self, pending: PendingConnection, reason: str):
+        pending.attempts += 1
+        if pending.attempts >= MAX_NBR_OF_ATTEMPTS:
+            self.rejected += 1
+            self.__close(pending, notify=True)
+        else:
+            send_frame(pending.socket, FrameType.Chat,
+                       f"Server << {reason}. Connection will be closed on no attempts left. {MAX_NBR_OF_ATTEMPTS - pending.attempts} attempts left. Enter a different username:")
+
+    def __expire(self, now: float):
+        while self.__deadlines and self.__deadlines[0][0] <= now:
+            _, _, pending = heapq.heappop(self.__deadlines)
+            if pending.done:
+                continue
+            self.timed_out += 1
+            self.logger.info(
+                f"Handshake with {pending.address[0]}:{pending.address[1]} timed out")
+            self.__close(pending, notify=True)
+
+    def __close(self, pending: PendingConnection, notify: bool = False):
+        pending.done = True
+        try:
+            self.__selector.unregister(pending.socket)
+        except (KeyError, ValueError):
+            pass
+        try:
+            if notify:
+                # close connection from client side
+                pending.socket.send(CLOSE_FRAME, MSG_DONTWAIT)
+        except OSError:
+            pass
+        pending.socket.close()
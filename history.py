@@ -0,0 +1,273 @@
+import bisect
+import logging
+import mmap
+import os
+import queue
+import shutil
+import threading
+import time
+from array import array
+from collections import deque
+from typing import Deque, Dict
+
+from protocol import HEADER
+
+# recent frames of every room kept in memory
+RING_SIZE = 256
+# bytes of every log segment, a segment is mapped once and filled in place
+SEGMENT_SIZE = 4 << 20
+# oldest segments are deleted beyond this many per room
+MAX_SEGMENTS = 16
+# rooms with a history, the one idle the longest is forgotten beyond this many
+MAX_ROOMS = 1024
+
+
+class Segment:
+    def __init__(self, path: str, size: int):
+        self.path = path
+        # created zero filled, a frame type of 0 marks the end of the written frames
+        with open(path, "a+b") as f:
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), size)
+        self.end = 0
+
+    def scan(self) -> list[int]:
+        # offsets of the frames written by a previous run
+        offsets = []
+        while self.end + HEADER.size <= len(self.map):
+            length, frame_type = HEADER.unpack_from(self.map, self.end)
+            if frame_type == 0 or self.end + HEADER.size + length > len(self.map):
+                break
+            offsets.append(self.end)
+            self.end += HEADER.size + length
+        return offsets
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            # frames still queued for a client, unmapped once they are written
+            pass
+
+
+class MessageLog:
+    """Append-only log of a room's chat frames, split in memory-mapped segments.
+
+    Frames are stored exactly as they were broadcast, so reading past messages
+    is slicing the mapped segment: a run of consecutive frames is handed to
+    the outbound queues as a single memoryview, never copied nor re-encoded.
+    The offset index holds the position of every frame,
+    segment number * segment size + offset.
+    """
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE, max_segments: int = MAX_SEGMENTS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.__segments: Dict[int, Segment] = dict()
+        self.__index = array("Q")
+        # sequence number of the first indexed frame
+        self.first = 0
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        numbers = sorted(int(name.split(".")[0])
+                         for name in os.listdir(directory) if name.endswith(".log"))
+        for number in numbers:
+            segment = self.__open(number)
+            self.__index.extend(
+                number * segment_size + offset for offset in segment.scan())
+        if not self.__segments:
+            self.__open(0)
+
+    def __len__(self) -> int:
+        return self.first + len(self.__index)
+
+    def append(self, frame: bytes):
+        with self.__lock:
+            if not self.__segments:
+                # closed, the room was dropped
+                return
+            number = max(self.__segments)
+            segment = self.__segments[number]
+            if segment.end + len(frame) > self.segment_size:
+                number += 1
+                segment = self.__open(number)
+                self.__retain()
+            segment.map[segment.end:segment.end + len(frame)] = frame
+            self.__index.append(number * self.segment_size + segment.end)
+            segment.end += len(frame)
+
+    def read(self, start: int, stop: int) -> list[memoryview]:
+        # frames with sequence numbers in [start, stop), one memoryview per segment they span
+        with self.__lock:
+            if not self.__segments:
+                return []
+            start = max(start, self.first) - self.first
+            stop = min(stop, len(self)) - self.first
+            views = []
+            index = start
+            while index < stop:
+                number, offset = divmod(self.__index[index], self.segment_size)
+                segment = self.__segments[number]
+                # first frame of the range past this segment, positions are sorted
+                following = bisect.bisect_left(
+                    self.__index, (number + 1) * self.segment_size, index, stop)
+                if following < stop:
+                    end = segment.end
+                elif stop < len(self.__index) and self.__index[stop] // self.segment_size == number:
+                    end = self.__index[stop] % self.segment_size
+                else:
+                    end = segment.end
+                views.append(memoryview(segment.map)[offset:end])
+                index = following
+            return views
+
+    def close(self):
+        with self.__lock:
+            for segment in self.__segments.values():
+                segment.close()
+            self.__segments.clear()
+
+    def __open(self, number: int) -> Segment:
+        segment = Segment(os.path.join(
+            self.directory, f"{number:08d}.log"), self.segment_size)
+        self.__segments[number] = segment
+        return segment
+
+    def __retain(self):
+        while len(self.__segments) > self.max_segments:
+            number = min(self.__segments)
+            segment = self.__segments.pop(number)
+            dropped = 0
+            while dropped < len(self.__index) and self.__index[dropped] // self.segment_size == number:
+                dropped += 1
+            del self.__index[:dropped]
+            self.first += dropped
+            segment.close()
+            os.remove(segment.path)
+
+
+class RoomHistory:
+    def __init__(self, ring_size: int, log: MessageLog | None):
+        self.log = log
+        # sequence number of the next frame, continues the log of a previous run
+        self.total = len(log) if log is not None else 0
+        self.ring: Deque[bytes] = deque(maxlen=ring_size)
+        self.lock = threading.Lock()
+        self.appended_at = time.monotonic()
+
+
+class ChatHistory:
+    """Recent chat frames of every room.
+
+    The last frames of a room are kept in a ring buffer, appended to right
+    after the broadcast. Persisting them is the job of a writer thread fed by
+    a queue, the broadcasting worker never touches the disk. Older frames are
+    read back from the room's `MessageLog`. A room gets a history with its
+    first message; beyond `max_rooms` of them, the history of the room idle
+    the longest is deleted.
+    """
+
+    def __init__(self, directory: str | None = None, ring_size: int = RING_SIZE,
+                 segment_size: int = SEGMENT_SIZE, max_segments: int = MAX_SEGMENTS, max_rooms: int = MAX_ROOMS):
+        # directory: one sub directory of log segments per room, None keeps the history in memory
+        self.directory = directory
+        self.ring_size = ring_size
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.max_rooms = max_rooms
+        self.logger = logging.getLogger("History")
+        self.__rooms: Dict[str, RoomHistory] = dict()
+        self.__lock = threading.Lock()
+        self.__queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.__thread = threading.Thread(
+            target=self.__run, name="History", daemon=True)
+
+    def start(self):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # logs of a previous run are indexed now rather than by the first message of the room,
+        # anything else in the directory is left alone
+        for name in os.listdir(self.directory):
+            if not os.path.isdir(os.path.join(self.directory, name)):
+                continue
+            try:
+                room_name = bytes.fromhex(name).decode()
+            except ValueError:
+                continue
+            self.__room(room_name)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread.is_alive():
+            self.__queue.put(None)
+            self.__thread.join()
+        with self.__lock:
+            for room in self.__rooms.values():
+                if room.log is not None:
+                    room.log.close()
+
+    def append(self, room_name: str, frame: bytes):
+        room = self.__room(room_name)
+        with room.lock:
+            room.ring.append(frame)
+            room.total += 1
+            room.appended_at = time.monotonic()
+        if room.log is not None:
+            self.__queue.put((room, frame))
+
+    def backlog(self) -> int:
+        # frames not persisted yet
+        return self.__queue.qsize()
+
+    def recent(self, room_name: str, n: int) -> list[bytes | memoryview]:
+        # the last n frames of the room, oldest first
+        room = self.__rooms.get(room_name)
+        if room is None:
+            return []
+        with room.lock:
+            ring = list(room.ring)[-n:] if n > 0 else []
+            start = room.total - n
+            stop = room.total - len(ring)
+        if start >= stop or room.log is None:
+            return ring
+        # frames older than the ring come from the log, missing if the writer is that far behind
+        return room.log.read(start, stop) + ring
+
+    def __room(self, room_name: str) -> RoomHistory:
+        room = self.__rooms.get(room_name)
+        if room is None:
+            with self.__lock:
+                room = self.__rooms.get(room_name)
+                if room is None:
+                    if len(self.__rooms) >= self.max_rooms:
+                        self.__drop_idlest()
+                    log = None
+                    if self.directory is not None:
+                        # room names may hold any character but a space
+                        log = MessageLog(os.path.join(self.directory, room_name.encode().hex()),
+                                         self.segment_size, self.max_segments)
+                    room = self.__rooms[room_name] = RoomHistory(
+                        self.ring_size, log)
+        return room
+
+    def __drop_idlest(self):
+        # called with the lock held, a room writing again later starts a new history
+        room_name = min(self.__rooms, key=lambda name: self.__rooms[name].appended_at)
+        room = self.__rooms.pop(room_name)
+        if room.log is not None:
+            room.log.close()
+            shutil.rmtree(room.log.directory, ignore_errors=True)
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            room, frame = item
+            try:
+                room.log.append(frame)
+            except (OSError, ValueError) as e:
+                self.logger.error(f"Error writing chat history: {e}")
@@ -0,0 +1,217 @@
+import heapq
+import json
+import logging
+import os
+import threading
+from typing import Dict
+
+
+class ScoreTree:
+    """Number of players at each score, as a Fenwick tree over the scores 0 to `size` - 1.
+
+    Adding a player and counting the players up to a score are O(log size);
+    the tree doubles when a higher score comes in.
+    """
+
+    def __init__(self, size: int = 64):
+        # size: a power of two, the node at index i counts the scores i - (i & -i) to i - 1
+        self.__tree = [0] * (size + 1)
+
+    def add(self, score: int, delta: int):
+        if score < 0:
+            raise ValueError(f"Negative score {score}")
+        while score + 1 >= len(self.__tree):
+            self.__grow()
+        index = score + 1
+        while index < len(self.__tree):
+            self.__tree[index] += delta
+            index += index & -index
+
+    def count_at_most(self, score: int) -> int:
+        index = min(score + 1, len(self.__tree) - 1)
+        count = 0
+        while index > 0:
+            count += self.__tree[index]
+            index -= index & -index
+        return count
+
+    def find(self, k: int) -> int:
+        # lowest score with at least k players up to it, for 1 <= k <= number of players
+        position = 0
+        step = len(self.__tree) - 1
+        while step:
+            if position + step < len(self.__tree) and self.__tree[position + step] < k:
+                position += step
+                k -= self.__tree[position]
+            step >>= 1
+        return position
+
+    def __grow(self):
+        # the nodes above the old size count nothing but the last one, which counts everything
+        size = len(self.__tree) - 1
+        self.__tree.extend([0] * size)
+        self.__tree[2 * size] = self.__tree[size]
+
+
+class Leaderboard:
+    """Total number of wins of every player, ranked and persisted.
+
+    Players are counted by score in a Fenwick tree, so updating a score and
+    reading a rank are O(log S) for the highest score S, and the top N walks
+    down the scores that some player holds. Every update is appended
+    to a log by a background thread that fsyncs once per batch; at start up
+    the compacted snapshot and the log are replayed, then compacted again.
+    """
+
+    def __init__(self, path: str | None = None, fsync_interval: float = 1.0, compact_after: int = 100000):
+        # path: files are <path>.snapshot and <path>.log, None keeps the leaderboard in memory
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+        self.logger = logging.getLogger("Leaderboard")
+        self.__scores: Dict[str, int] = dict()
+        # score -> usernames of the players holding it, and how many players hold each score
+        self.__players: Dict[int, set[str]] = dict()
+        self.__counts = ScoreTree()
+        self.__lock = threading.Lock()
+        # updates waiting to be written by the writer thread
+        self.__pending: list[tuple[str, int]] = []
+        self.__condition = threading.Condition()
+        self.__stopped = False
+        self.__log = None
+        self.__log_entries = 0
+        self.__thread = threading.Thread(
+            target=self.__run, name="Leaderboard", daemon=True)
+
+    def start(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__load()
+        self.__compact()
+        self.__log = open(f"{self.path}.log", "a", encoding="utf-8")
+        self.__thread.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        if self.__thread.is_alive():
+            self.__thread.join()
+
+    def score(self, username: str) -> int:
+        return self.__scores.get(username, 0)
+
+    def record(self, username: str, score: int):
+        # never touches the disk, the writer thread persists the update later
+        with self.__lock:
+            self.__set(username, score)
+        if self.path is not None:
+            with self.__condition:
+                self.__pending.append((username, score))
+
+    def top(self, n: int) -> list[tuple[str, int]]:
+        # ties are ordered by username
+        top = []
+        with self.__lock:
+            # players with a score up to the one being listed
+            remaining = len(self.__scores)
+            while len(top) < n and remaining > 0:
+                score = self.__counts.find(remaining)
+                players = self.__players[score]
+                top.extend((username, score) for username in heapq.nsmallest(n - len(top), players))
+                remaining -= len(players)
+        return top
+
+    def rank(self, username: str) -> tuple[int, int] | None:
+        # (rank, score), players with the same score share the same rank
+        with self.__lock:
+            score = self.__scores.get(username)
+            if score is None:
+                return None
+            return len(self.__scores) - self.__counts.count_at_most(score) + 1, score
+
+    def scores(self) -> Dict[str, int]:
+        with self.__lock:
+            return dict(self.__scores)
+
+    def __len__(self) -> int:
+        return len(self.__scores)
+
+    def __set(self, username: str, score: int):
+        previous = self.__scores.get(username)
+        if previous is not None:
+            players = self.__players[previous]
+            players.discard(username)
+            if not players:
+                del self.__players[previous]
+            self.__counts.add(previous, -1)
+        self.__scores[username] = score
+        self.__players.setdefault(score, set()).add(username)
+        self.__counts.add(score, 1)
+
+    def __load(self):
+        scores = dict()
+        try:
+            with open(f"{self.path}.snapshot", encoding="utf-8") as snapshot:
+                scores = json.load(snapshot)
+        except FileNotFoundError:
+            pass
+        try:
+            with open(f"{self.path}.log", encoding="utf-8") as log:
+                for line in log:
+                    try:
+                        username, score = json.loads(line)
+                    except ValueError:
+                        # the last line may have been cut by a crash
+                        continue
+                    scores[username] = score
+        except FileNotFoundError:
+            pass
+        with self.__lock:
+            self.__scores = dict()
+            self.__players = dict()
+            self.__counts = ScoreTree()
+            for username, score in scores.items():
+                self.__set(username, score)
+        self.logger.info(f"Loaded {len(scores)} scores")
+
+    def __compact(self):
+        # snapshot of every score, then an empty log
+        with self.__lock:
+            scores = dict(self.__scores)
+        temporary_path = f"{self.path}.snapshot.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as snapshot:
+            json.dump(scores, snapshot)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary_path, f"{self.path}.snapshot")
+        if self.__log is not None:
+            self.__log.close()
+        self.__log = open(f"{self.path}.log", "w", encoding="utf-8")
+        self.__log_entries = 0
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                # updates are grouped, one write and one fsync per interval
+                if not self.__stopped:
+                    self.__condition.wait(self.fsync_interval)
+                pending, self.__pending = self.__pending, []
+                stopped = self.__stopped
+            if pending:
+                try:
+                    self.__log.write("".join(json.dumps(
+                        update) + "\n" for update in pending))
+                    self.__log.flush()
+                    os.fsync(self.__log.fileno())
+                    self.__log_entries += len(pending)
+                    if self.__log_entries >= self.compact_after:
+                        self.__compact()
+                except OSError as e:
+                    self.logger.error(f"Error persisting scores: {e}")
+            if stopped:
+                self.__log.close()
+                return
@@ -0,0 +1,198 @@
+import os
+import sys
+import threading
+import time
+from typing import Dict
+
+# files skipped when looking for the code that takes a lock
+_INTERNAL_FILES = (__file__, threading.__file__, os.path.join(
+    os.path.dirname(__file__), "metrics.py"))
+
+_enabled = False
+# thread id -> instrumented locks it holds
+_held: Dict[int, list] = dict()
+_held_lock = threading.Lock()
+_stats: Dict[str, "LockStats"] = dict()
+_stats_lock = threading.Lock()
+
+
+def enable():
+    # opt-in, only the locks created afterwards are instrumented
+    global _enabled
+    _enabled = True
+
+
+def new_lock(name: str, reentrant: bool = False, ownerless: bool = False):
+    """Lock, or RLock, instrumented under `name` when profiling is enabled.
+
+    Every lock created with the same name shares its statistics (all the
+    games' locks are reported together). ownerless: the lock is a flag taken
+    by one thread and released by another, it is never reported as held
+    across blocking I/O.
+    """
+    if not _enabled:
+        return threading.RLock() if reentrant else threading.Lock()
+    with _stats_lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = LockStats(name)
+    return InstrumentedLock(stats, reentrant, ownerless)
+
+
+def blocking_io(operation: str):
+    # called before a blocking socket operation, records the instrumented locks held meanwhile
+    if not _enabled:
+        return
+    held = _held.get(threading.get_ident())
+    if held:
+        site = _call_site()
+        for lock in list(held):
+            lock.stats.on_blocking_io(site, operation)
+
+
+def _call_site() -> str:
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename in _INTERNAL_FILES:
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} ({frame.f_code.co_name})"
+
+
+class SiteStats:
+    def __init__(self):
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait = 0.0
+        self.hold = 0.0
+
+
+class LockStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.acquisitions = 0
+        self.contended = 0
+        # non-blocking attempts that found the lock taken
+        self.failed = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.hold = 0.0
+        self.max_hold = 0.0
+        self.sites: Dict[str, SiteStats] = dict()
+        # (site of the I/O, operation) -> times the lock was held meanwhile
+        self.blocking_io: Dict[tuple[str, str], int] = dict()
+        self.__lock = threading.Lock()
+
+    def on_acquired(self, site: str, wait: float, contended: bool):
+        with self.__lock:
+            self.acquisitions += 1
+            self.contended += contended
+            self.wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            site_stats = self.sites.get(site)
+            if site_stats is None:
+                site_stats = self.sites[site] = SiteStats()
+            site_stats.acquisitions += 1
+            site_stats.contended += contended
+            site_stats.wait += wait
+
+    def on_failed(self):
+        with self.__lock:
+            self.failed += 1
+
+    def on_released(self, site: str, hold: float):
+        with self.__lock:
+            self.hold += hold
+            self.max_hold = max(self.max_hold, hold)
+            self.sites[site].hold += hold
+
+    def on_blocking_io(self, site: str, operation: str):
+        with self.__lock:
+            key = (site, operation)
+            self.blocking_io[key] = self.blocking_io.get(key, 0) + 1
+
+
+class InstrumentedLock:
+    """Lock recording its acquisitions, wait and hold times and who took it."""
+
+    def __init__(self, stats: LockStats, reentrant: bool = False, ownerless: bool = False):
+        self.stats = stats
+        self.reentrant = reentrant
+        self.ownerless = ownerless
+        self.__lock = threading.RLock() if reentrant else threading.Lock()
+        self.__owner: int | None = None
+        self.__depth = 0
+        self.__acquired_at = 0.0
+        self.__site = ""
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        site = _call_site()
+        start = time.perf_counter()
+        contended = not self.__lock.acquire(False)
+        if contended:
+            if not blocking or not self.__lock.acquire(True, timeout):
+                self.stats.on_failed()
+                return False
+        now = time.perf_counter()
+        me = threading.get_ident()
+        if self.reentrant and self.__owner == me:
+            self.__depth += 1
+            return True
+        self.__owner = me
+        self.__depth = 1
+        self.__acquired_at = now
+        self.__site = site
+        if not self.ownerless:
+            with _held_lock:
+                _held.setdefault(me, []).append(self)
+        self.stats.on_acquired(site, now - start, contended)
+        return True
+
+    def release(self):
+        self.__depth -= 1
+        if self.__depth == 0:
+            hold = time.perf_counter() - self.__acquired_at
+            owner, site = self.__owner, self.__site
+            self.__owner = None
+            if not self.ownerless:
+                with _held_lock:
+                    held = _held.get(owner, [])
+                    if self in held:
+                        held.remove(self)
+                    if not held:
+                        _held.pop(owner, None)
+            self.stats.on_released(site, hold)
+        self.__lock.release()
+
+    def locked(self) -> bool:
+        return self.__depth > 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def report(top: int = 10) -> list[str]:
+    # the locks waited on the longest, their busiest call sites, and the locks held across blocking I/O
+    if not _enabled:
+        return ["Lock profiling is disabled, start the server with --profile-locks"]
+    with _stats_lock:
+        all_stats = list(_stats.values())
+    lines = []
+    for stats in sorted(all_stats, key=lambda stats: stats.wait, reverse=True)[:top]:
+        lines.append(
+            f"{stats.name}: {stats.acquisitions} acquisitions, {stats.contended} contended, {stats.failed} failed, "
+            f"wait {stats.wait * 1e3:.3f}ms (max {stats.max_wait * 1e3:.3f}ms), "
+            f"hold {stats.hold * 1e3:.3f}ms (max {stats.max_hold * 1e3:.3f}ms)")
+        sites = sorted(stats.sites.items(),
+                       key=lambda item: (item[1].wait, item[1].hold), reverse=True)[:3]
+        for site, site_stats in sites:
+            lines.append(
+                f"    {site}: {site_stats.acquisitions} acquisitions, {site_stats.contended} contended, "
+                f"wait {site_stats.wait * 1e3:.3f}ms, hold {site_stats.hold * 1e3:.3f}ms")
+        for (site, operation), count in sorted(stats.blocking_io.items(), key=lambda item: -item[1]):
+            lines.append(f"    held across blocking {operation} at {site}: {count} times")
+    return lines or ["No instrumented lock was used yet"]
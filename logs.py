@@ -0,0 +1,119 @@
+import itertools
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict
+
+# structured fields a record may carry, given with `extra=`
+FIELDS = ("event", "user", "room", "game")
+TEXT_FORMAT = "%(name)s: %(message)s"
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one record out of `rate` for the high volume events (chat lines...).
+
+    Records without an event, or with an event not listed, always pass.
+    """
+
+    def __init__(self, rates: Dict[str, int]):
+        super().__init__()
+        self.rates = {event: rate for event, rate in rates.items() if rate > 1}
+        self.__counters = {event: itertools.count() for event in self.rates}
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "event", None))
+        if rate is None:
+            return True
+        # next() on a count is atomic, no lock needed
+        if next(self.__counters[record.event]) % rate == 0:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the log writer thread, drops them when its queue is full.
+
+    The logging thread only pays for building the record: formatting and
+    writing happen on the writer thread, and a slow disk or terminal never
+    makes it wait.
+    """
+
+    def __init__(self, queue_size: int):
+        # SimpleQueue is much cheaper to put to than Queue, its size is checked by hand
+        super().__init__(queue.SimpleQueue())
+        self.queue_size = queue_size
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the record stays in this process, the writer thread formats it
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # several threads may pass the check at once, the bound is approximate
+        if self.queue.qsize() >= self.queue_size:
+            self.dropped += 1
+        else:
+            self.queue.put_nowait(record)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # one compact JSON object per record
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"))
+
+
+class LogPipeline:
+    """Routes every logger of the process through a bounded queue to one writer thread."""
+
+    def __init__(self, format: str = "text", path: str | None = None, queue_size: int = 10000,
+                 sample_rates: Dict[str, int] | None = None, level: int = logging.INFO):
+        # format: "text" or "json" (JSON lines), path: None writes to stderr
+        if path is None:
+            target = logging.StreamHandler(sys.stderr)
+        else:
+            target = logging.FileHandler(path, encoding="utf-8")
+        target.setFormatter(JsonLinesFormatter() if format == "json"
+                            else logging.Formatter(TEXT_FORMAT))
+        self.level = level
+        self.handler = DroppingQueueHandler(queue_size)
+        self.sampler = SamplingFilter(sample_rates or dict())
+        self.handler.addFilter(self.sampler)
+        self.listener = QueueListener(self.handler.queue, target)
+        self.__previous_handlers: list[logging.Handler] = []
+
+    def start(self):
+        root = logging.getLogger()
+        self.__previous_handlers = root.handlers[:]
+        root.handlers = [self.handler]
+        root.setLevel(self.level)
+        self.listener.start()
+
+    def stop(self):
+        # writes what is still queued
+        root = logging.getLogger()
+        root.handlers = self.__previous_handlers
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+    def dropped(self) -> int:
+        return self.handler.dropped
+
+    def sampled_out(self) -> int:
+        return self.sampler.sampled_out
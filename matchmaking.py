@@ -0,0 +1,123 @@
+import time
+from collections import deque
+from typing import Deque, Dict
+
+from locks import new_lock
+from metrics import Histogram
+
+# rating difference accepted between two players right away
+BASE_RATING_GAP = 2
+# accepted difference grows by this much per second spent waiting
+RATING_GAP_GROWTH = 1.0
+
+
+class Ticket:
+    def __init__(self, player, rating: int):
+        self.player = player
+        self.rating = rating
+        self.enqueued_at = time.monotonic()
+
+
+class MatchmakingQueue:
+    """Players waiting for an opponent, bucketed by rating.
+
+    A newcomer is paired with the longest waiting player of the closest rating
+    when they are close enough, looked up in the few buckets around its own.
+    Players left waiting are paired by `match`, called periodically, which
+    walks the buckets in rating order and accepts a wider rating gap the
+    longer they have waited. Joining and leaving the queue never shift the
+    other players.
+    """
+
+    def __init__(self):
+        # rating -> tickets of the players waiting with it, oldest first
+        self.__buckets: Dict[int, Dict[str, Ticket]] = dict()
+        self.__by_username: Dict[str, Ticket] = dict()
+        self.__lock = new_lock("MatchmakingQueue.lock")
+        # time from joining the queue to being matched
+        self.wait_time = Histogram()
+        # (time, matches formed) of the recent calls to match
+        self.__ticks: Deque[tuple[float, int]] = deque(maxlen=64)
+        self.matches_formed = 0
+
+    def add(self, player, rating: int) -> tuple | None:
+        # queue the player, or return (opponent, player) when a close enough one is waiting
+        with self.__lock:
+            if player.getUsername() in self.__by_username:
+                return None
+            ticket = Ticket(player, rating)
+            closest = self.__closest(rating)
+            if closest is not None:
+                self.__remove(closest)
+                self.__record(time.monotonic(), [closest, ticket])
+                return closest.player, player
+            self.__buckets.setdefault(rating, dict())[player.getUsername()] = ticket
+            self.__by_username[player.getUsername()] = ticket
+            return None
+
+    def remove(self, username: str) -> bool:
+        with self.__lock:
+            ticket = self.__by_username.get(username)
+            if ticket is None:
+                return False
+            self.__remove(ticket)
+            return True
+
+    def match(self) -> list[tuple]:
+        # pair neighbours in rating whose gap is acceptable given how long they waited
+        now = time.monotonic()
+        pairs = []
+        with self.__lock:
+            tickets = [ticket for rating in sorted(self.__buckets)
+                       for ticket in self.__buckets[rating].values()]
+            index = 0
+            while index + 1 < len(tickets):
+                first = tickets[index]
+                second = tickets[index + 1]
+                waited = now - min(first.enqueued_at, second.enqueued_at)
+                if second.rating - first.rating <= BASE_RATING_GAP + RATING_GAP_GROWTH * waited:
+                    pairs.append((first, second))
+                    index += 2
+                else:
+                    index += 1
+            for first, second in pairs:
+                self.__remove(first)
+                self.__remove(second)
+            self.__record(now, [ticket for pair in pairs for ticket in pair])
+        return [(first.player, second.player) for first, second in pairs]
+
+    def __closest(self, rating: int) -> Ticket | None:
+        # longest waiting ticket of the closest rating within the accepted gap, the lower one on a tie
+        for gap in range(BASE_RATING_GAP + 1):
+            for other in (rating - gap, rating + gap):
+                bucket = self.__buckets.get(other)
+                if bucket:
+                    return next(iter(bucket.values()))
+        return None
+
+    def __remove(self, ticket: Ticket):
+        username = ticket.player.getUsername()
+        bucket = self.__buckets[ticket.rating]
+        del bucket[username]
+        if not bucket:
+            del self.__buckets[ticket.rating]
+        del self.__by_username[username]
+
+    def __record(self, now: float, tickets: list[Ticket]):
+        for ticket in tickets:
+            self.wait_time.record(now - ticket.enqueued_at)
+        self.matches_formed += len(tickets) // 2
+        self.__ticks.append((now, len(tickets) // 2))
+
+    def __contains__(self, username: str) -> bool:
+        return username in self.__by_username
+
+    def __len__(self) -> int:
+        return len(self.__by_username)
+
+    def matches_per_second(self) -> float:
+        # over the recent calls to match
+        with self.__lock:
+            ticks = list(self.__ticks)
+        elapsed = ticks[-1][0] - ticks[0][0] if len(ticks) > 1 else 0
+        return sum(count for _, count in ticks[1:]) / elapsed if elapsed else 0.0
@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict
+
+# values under 2 ** SUB_BUCKET_BITS microseconds get a bucket each, larger ones
+# 2 ** (SUB_BUCKET_BITS - 1) buckets per power of two: about 6% precision
+SUB_BUCKET_BITS = 5
+HALF_SUB_BUCKETS = 1 << (SUB_BUCKET_BITS - 1)
+# up to 2 ** 40 us, about 12 days
+NBR_OF_BUCKETS = (40 - SUB_BUCKET_BITS + 2) * HALF_SUB_BUCKETS
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+PREFIX = "chatroom_"
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        # not atomic, a rare lost update is cheaper than a lock on every hot path
+        self.value += n
+
+
+class Histogram:
+    """Latency histogram with logarithmic buckets, HDR-style.
+
+    Recording is an index computation and an increment, no allocation and no
+    lock; quantiles are read back with a walk over the buckets.
+    """
+
+    def __init__(self):
+        self.__counts = [0] * NBR_OF_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        value = int(seconds * 1e6)
+        if value < 2 * HALF_SUB_BUCKETS:
+            index = max(value, 0)
+        else:
+            shift = value.bit_length() - SUB_BUCKET_BITS
+            index = min((shift << (SUB_BUCKET_BITS - 1)) + (value >> shift), NBR_OF_BUCKETS - 1)
+        self.__counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: "Histogram"):
+        # adds the samples of another histogram, from another process for instance
+        self.__counts = [count + other_count for count, other_count in zip(self.__counts, other.__counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        # highest value of the bucket holding the quantile, in seconds
+        counts = list(self.__counts)
+        target = q * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= target:
+                return min(self.__upper_bound(index) / 1e6, self.max)
+        return 0.0
+
+    @staticmethod
+    def __upper_bound(index: int) -> int:
+        if index < 2 * HALF_SUB_BUCKETS:
+            return index
+        shift = (index >> (SUB_BUCKET_BITS - 1)) - 1
+        sub_bucket = index - (shift << (SUB_BUCKET_BITS - 1))
+        return ((sub_bucket + 1) << shift) - 1
+
+
+class Metrics:
+    """Named counters, gauges and histograms of a server.
+
+    Components keep their own counters and histograms where they are updated,
+    the registry only reads them back for the `stats` command and the
+    Prometheus endpoint.
+    """
+
+    def __init__(self):
+        # name -> (type, help, counter / histogram / callable)
+        self.__metrics: Dict[str, tuple[str, str, object]] = dict()
+        self.__lock = threading.Lock()
+        self.started_at = time.monotonic()
+        # counter values at the previous `report`, to show rates
+        self.__previous: tuple[float, Dict[str, float]] = (self.started_at, dict())
+
+    def counter(self, name: str, help: str, read: Callable[[], int] | None = None) -> Counter | None:
+        # read: the counter is kept elsewhere, only read back
+        metric = Counter() if read is None else read
+        self.__add(name, "counter", help, metric)
+        return metric if read is None else None
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]):
+        self.__add(name, "gauge", help, read)
+
+    def histogram(self, name: str, help: str, histogram: Histogram | None = None) -> Histogram:
+        histogram = histogram if histogram is not None else Histogram()
+        self.__add(name, "summary", help, histogram)
+        return histogram
+
+    def __add(self, name: str, metric_type: str, help: str, metric):
+        with self.__lock:
+            self.__metrics[name] = (metric_type, help, metric)
+
+    def values(self) -> Dict[str, float | Histogram]:
+        with self.__lock:
+            metrics = list(self.__metrics.items())
+        values = dict()
+        for name, (metric_type, _, metric) in metrics:
+            if isinstance(metric, Histogram):
+                values[name] = metric
+            elif isinstance(metric, Counter):
+                values[name] = metric.value
+            else:
+                values[name] = metric()
+        return values
+
+    def report(self) -> list[str]:
+        # human readable lines, counters with their rate since the previous report
+        now = time.monotonic()
+        previous_time, previous_values = self.__previous
+        values = self.values()
+        lines = [f"uptime: {now - self.started_at:.0f}s"]
+        for name, value in values.items():
+            metric_type = self.__metrics[name][0]
+            if isinstance(value, Histogram):
+                quantiles = ", ".join(
+                    f"p{q * 100:g} {value.quantile(q) * 1e3:.3f}ms" for q in QUANTILES)
+                lines.append(
+                    f"{name}: {value.count} samples, {quantiles}, max {value.max * 1e3:.3f}ms")
+            elif metric_type == "counter":
+                rate = (value - previous_values.get(name, 0)) / max(now - previous_time, 1e-9)
+                lines.append(f"{name}: {value} ({rate:.1f}/s)")
+            else:
+                lines.append(f"{name}: {value}")
+        self.__previous = (now, {name: value for name, value in values.items()
+                                 if not isinstance(value, Histogram)})
+        return lines
+
+    def prometheus(self) -> str:
+        # Prometheus text exposition format, histograms as summaries
+        values = self.values()
+        lines = []
+        for name, value in values.items():
+            metric_type, help, _ = self.__metrics[name]
+            full_name = PREFIX + name + ("_total" if metric_type == "counter" else "")
+            lines.append(f"# HELP {full_name} {help}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            if isinstance(value, Histogram):
+                for q in QUANTILES:
+                    lines.append(f'{full_name}{{quantile="{q}"}} {value.quantile(q):.6f}')
+                lines.append(f"{full_name}_sum {value.total:.6f}")
+                lines.append(f"{full_name}_count {value.count}")
+            else:
+                lines.append(f"{full_name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class TimedLock:
+    """Lock, or RLock, recording how long every acquisition waited."""
+
+    def __init__(self, wait_time: Histogram, lock=None):
+        self.wait_time = wait_time
+        self.__lock = lock if lock is not None else threading.Lock()
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.__lock.acquire()
+        self.wait_time.record(time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__lock.release()
+
+
+class MetricsEndpoint:
+    """Local HTTP endpoint serving the metrics in Prometheus text format on /metrics."""
+
+    def __init__(self, metrics: Metrics, port: int, host: str = "127.0.0.1"):
+        self.metrics = metrics
+        self.logger = logging.getLogger("Metrics")
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = endpoint.metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(
+            target=self.__server.serve_forever, name="Metrics", daemon=True)
+
+    def address(self) -> tuple[str, int]:
+        return self.__server.server_address
+
+    def start(self):
+        self.__thread.start()
+        self.logger.info(
+            f"Serving metrics on http://{self.address()[0]}:{self.address()[1]}/metrics")
+
+    def stop(self):
+        if self.__thread.is_alive():
+            self.__server.shutdown()
+        self.__server.server_close()
@@ -0,0 +1,317 @@
+import logging
+import os
+import selectors
+import socket
+import threading
+from collections import deque
+from enum import Enum
+from typing import Callable, Deque
+
+# send without blocking even though the socket itself stays in blocking mode,
+# the chat threads keep doing plain blocking recv on it
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+# most buffers handed to a single sendmsg
+try:
+    IOV_MAX = min(os.sysconf("SC_IOV_MAX"), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+
+class OverflowPolicy(Enum):
+    # forget the oldest queued frames to make room for the new one
+    DropOldest = "drop-oldest"
+    # the client cannot keep up, close its connection
+    Disconnect = "disconnect"
+    # merge queued frames into a single buffer, drop the oldest ones beyond the byte budget
+    Coalesce = "coalesce"
+
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be written to one client.
+
+    Frames are immutable bytes shared by every recipient of a broadcast, the
+    queue only keeps references to them.
+    """
+
+    def __init__(self, writer: "OutboundWriter", client, max_frames: int, max_bytes: int, policy: OverflowPolicy):
+        self.writer = writer
+        self.client = client
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.__frames: Deque[bytes] = deque()
+        self.__bytes = 0
+        # buffers taken by the writer thread and not written yet, only touched by that thread.
+        # The first one may be a memoryview over the rest of a partially written frame
+        self.pending: Deque[bytes | memoryview] = deque()
+        self.__lock = threading.Lock()
+        self.__drained = threading.Condition(self.__lock)
+        self.__scheduled = False
+        self.registered = False
+        self.closed = False
+        self.overflowed = False
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_watermark = 0
+
+    def depth(self) -> int:
+        return len(self.__frames) + len(self.pending)
+
+    def queued_bytes(self) -> int:
+        return self.__bytes + sum(len(buffer) for buffer in list(self.pending))
+
+    def put(self, frame: bytes) -> bool:
+        with self.__lock:
+            if self.closed or self.overflowed:
+                return False
+            if self.__frames and (len(self.__frames) >= self.max_frames or self.__bytes + len(frame) > self.max_bytes):
+                if not self.__make_room(len(frame)):
+                    self.overflowed = True
+                    schedule = not self.__scheduled
+                    self.__scheduled = True
+                    if schedule:
+                        self.writer._schedule(self)
+                    return False
+            self.__frames.append(frame)
+            self.__bytes += len(frame)
+            self.high_watermark = max(self.high_watermark, len(self.__frames))
+            schedule = not self.__scheduled
+            self.__scheduled = True
+        if schedule:
+            self.writer._schedule(self)
+        return True
+
+    def __make_room(self, size: int) -> bool:
+        if self.policy == OverflowPolicy.Disconnect:
+            return False
+        if self.policy == OverflowPolicy.Coalesce:
+            # the newest frames fitting in the byte budget with the new one are kept, only older ones are dropped
+            kept: Deque[bytes] = deque()
+            kept_bytes = 0
+            while self.__frames and kept_bytes + len(self.__frames[-1]) + size <= self.max_bytes:
+                frame = self.__frames.pop()
+                kept.appendleft(frame)
+                kept_bytes += len(frame)
+            self.dropped += len(self.__frames)
+            if len(kept) >= self.max_frames:
+                # merged in a single buffer to make room for the new frame
+                kept = deque((b"".join(kept),))
+                self.coalesced += 1
+            self.__frames = kept
+            self.__bytes = kept_bytes
+            return True
+        while self.__frames and (len(self.__frames) >= self.max_frames or self.__bytes + size > self.max_bytes):
+            self.__bytes -= len(self.__frames.popleft())
+            self.dropped += 1
+        return True
+
+    def take(self, count: int) -> list[bytes]:
+        # up to `count` of the oldest frames, handed over to the writer thread
+        with self.__lock:
+            if count >= len(self.__frames):
+                frames = list(self.__frames)
+                self.__frames.clear()
+            else:
+                frames = [self.__frames.popleft() for _ in range(count)]
+            self.__bytes -= sum(len(frame) for frame in frames)
+            return frames
+
+    def idle(self) -> bool:
+        # nothing left to write, the next put schedules the queue again
+        with self.__lock:
+            if self.__frames or self.pending:
+                return False
+            self.__scheduled = False
+            self.__drained.notify_all()
+            return True
+
+    def close(self):
+        with self.__lock:
+            self.closed = True
+            self.__frames.clear()
+            self.__bytes = 0
+            self.__drained.notify_all()
+
+    def join(self, timeout: float | None = None) -> bool:
+        # wait until every queued frame was written
+        with self.__lock:
+            return self.__drained.wait_for(
+                lambda: self.closed or (not self.__frames and not self.pending and not self.__scheduled), timeout)
+
+
+class OutboundWriter:
+    """Single thread writing every client's outbound queue with non-blocking sends.
+
+    A client that stops reading only fills its own queue, it never blocks the
+    threads broadcasting to it.
+    """
+
+    def __init__(self, on_failure: Callable[[object, str], None], max_frames: int = 1024, max_bytes: int = 1 << 20, policy: OverflowPolicy = OverflowPolicy.DropOldest):
+        self.on_failure = on_failure
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.logger = logging.getLogger("Outbound")
+        self.__selector = selectors.DefaultSelector()
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+        self.__selector.register(self.__wakeup_reader, selectors.EVENT_READ)
+        self.__ready: list[OutboundQueue] = []
+        self.__ready_lock = threading.Lock()
+        self.__wakeup_pending = False
+        self.__queues: set[OutboundQueue] = set()
+        self.__queues_lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(
+            target=self.__run, name="Outbound writer", daemon=True)
+        self.slow_consumers = 0
+        self.write_failures = 0
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        self.__wakeup()
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def register(self, client) -> OutboundQueue:
+        queue = OutboundQueue(self, client, self.max_frames,
+                              self.max_bytes, self.policy)
+        with self.__queues_lock:
+            self.__queues.add(queue)
+        client.setOutbound(queue)
+        return queue
+
+    def unregister(self, client):
+        queue = client.getOutbound()
+        if queue is None:
+            return
+        with self.__queues_lock:
+            self.__queues.discard(queue)
+        queue.close()
+        # the writer thread owns the selector, it drops the socket on its next pass
+        self._schedule(queue)
+
+    def stats(self) -> dict:
+        with self.__queues_lock:
+            queues = list(self.__queues)
+        depths = [queue.depth() for queue in queues]
+        return {
+            "queues": len(queues),
+            "queued_frames": sum(depths),
+            "queued_bytes": sum(queue.queued_bytes() for queue in queues),
+            "max_depth": max(depths, default=0),
+            "high_watermark": max((queue.high_watermark for queue in queues), default=0),
+            "dropped_frames": sum(queue.dropped for queue in queues),
+            "coalesced": sum(queue.coalesced for queue in queues),
+            "slow_consumers": self.slow_consumers,
+            "write_failures": self.write_failures,
+        }
+
+    def _schedule(self, queue: OutboundQueue):
+        with self.__ready_lock:
+            self.__ready.append(queue)
+            wakeup = not self.__wakeup_pending
+            self.__wakeup_pending = True
+        # one wakeup per batch of scheduled queues, not per frame
+        if wakeup:
+            self.__wakeup()
+
+    def __wakeup(self):
+        try:
+            self.__wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def __run(self):
+        while not self.__stop_event.is_set():
+            for key, _ in self.__selector.select():
+                if key.fileobj is self.__wakeup_reader:
+                    try:
+                        while self.__wakeup_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.__flush(key.data)
+            with self.__ready_lock:
+                ready, self.__ready = self.__ready, []
+                self.__wakeup_pending = False
+            for queue in ready:
+                if not queue.registered or queue.closed:
+                    self.__flush(queue)
+        self.__selector.close()
+        self.__wakeup_reader.close()
+        self.__wakeup_writer.close()
+
+    def __flush(self, queue: OutboundQueue):
+        sock = queue.client.getSocket()
+        if queue.closed:
+            queue.pending.clear()
+            self.__unwatch(queue, sock)
+            return
+        if queue.overflowed:
+            self.slow_consumers += 1
+            self.__fail(queue, sock, "slow consumer, outbound queue is full")
+            return
+        pending = queue.pending
+        try:
+            while True:
+                if len(pending) < IOV_MAX:
+                    pending.extend(queue.take(IOV_MAX - len(pending)))
+                    if not pending:
+                        if queue.idle():
+                            self.__unwatch(queue, sock)
+                            return
+                        continue
+                # every queued frame goes out in one scatter/gather syscall, nothing is copied
+                if len(pending) == 1:
+                    sent = sock.send(pending[0], MSG_DONTWAIT)
+                else:
+                    sent = sock.sendmsg(pending, [], MSG_DONTWAIT)
+                while sent:
+                    if sent >= len(pending[0]):
+                        sent -= len(pending.popleft())
+                    else:
+                        pending[0] = memoryview(pending[0])[sent:]
+                        sent = 0
+        except BlockingIOError:
+            # socket buffer is full, wait until the client reads
+            self.__watch(queue, sock)
+        except OSError as e:
+            self.write_failures += 1
+            self.__fail(queue, sock, str(e))
+
+    def __fail(self, queue: OutboundQueue, sock, reason: str):
+        queue.pending.clear()
+        queue.close()
+        self.__unwatch(queue, sock)
+        with self.__queues_lock:
+            self.__queues.discard(queue)
+        try:
+            self.on_failure(queue.client, reason)
+        except Exception as e:
+            self.logger.error(f"Error handling outbound failure: {e}")
+
+    def __watch(self, queue: OutboundQueue, sock):
+        if queue.registered:
+            return
+        try:
+            self.__selector.register(sock, selectors.EVENT_WRITE, queue)
+        except KeyError:
+            # a closed socket left its file descriptor behind
+            self.__selector.unregister(sock.fileno())
+            self.__selector.register(sock, selectors.EVENT_WRITE, queue)
+        queue.registered = True
+
+    def __unwatch(self, queue: OutboundQueue, sock):
+        if not queue.registered:
+            return
+        queue.registered = False
+        try:
+            self.__selector.unregister(sock)
+        except (KeyError, ValueError, OSError):
+            pass
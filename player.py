@@ -1,9 +1,7 @@
-import select
-import socket
-import sys
 import threading
 from typing import override
 from client import Client
+from protocol import FrameType, send_frame
 
 
 class Player(Client):
@@ -11,25 +9,14 @@ class Player(Client):
         super().__init__(host, port, close_event)
 
     @override
-    def receive_messages(self):
-        while not self.close_event.is_set():
-            sockets_list = [sys.stdin, self.server_socket]
-            try:
-                read_sockets, write_socket, error_socket = select.select(
-                    sockets_list, [], [])
-                for socks in read_sockets:
-                    if socks == self.server_socket:
-                        message = socks.recv(2048)
-                        decoded_message = message.decode()
-                        if (decoded_message == "close"):
-                            self._close_connection_from_server()
-                        if decoded_message.endswith("quit the game. You win :)"):
-                            self.messages_logger.info(message.decode().strip())
-                            self.server_socket.send("quit".encode())
-                        else:
-                            self.messages_logger.info(message.decode().strip())
-            except socket.error as e:
-                self.logger.error(f"Error connecting to the server: {e}")
+    def _handle_message(self, frame_type: FrameType, message: str):
+        if frame_type == FrameType.Control and message == "close":
+            self._close_connection_from_server()
+        elif message.endswith("quit the game. You win :)"):
+            self.messages_logger.info(message.strip())
+            send_frame(self.server_socket, FrameType.Control, "quit")
+        else:
+            self.messages_logger.info(message.strip())
 
 
 if __name__ == "__main__":
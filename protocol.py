@@ -0,0 +1,170 @@
+import struct
+import threading
+from enum import IntEnum
+from typing import Iterable, Iterator
+
+from locks import blocking_io
+
+# Every message on the wire is a frame:
+#   4 bytes payload length (network order) | 1 byte frame type | payload (utf-8)
+HEADER = struct.Struct("!IB")
+MAX_PAYLOAD_SIZE = 64 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class FrameType(IntEnum):
+    Chat = 1
+    Command = 2
+    Choice = 3
+    Control = 4
+
+
+COMMANDS = ("play", "accept", "cancel", "join", "leave", "rooms", "/msg", "top", "rank", "history")
+CHOICES = ("1", "2", "3")
+CONTROLS = ("close", "exit", "quit")
+
+
+def classify(message: str) -> FrameType:
+    # frame type of a line typed by a user
+    if message in CONTROLS:
+        return FrameType.Control
+    if message in CHOICES:
+        return FrameType.Choice
+    if message.split(" ", 1)[0] in COMMANDS:
+        return FrameType.Command
+    return FrameType.Chat
+
+
+def encode_frame(frame_type: FrameType, payload: str | bytes) -> bytes:
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"Frame payload too large ({len(payload)} bytes)")
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+def encode_chat_frame(prefix: bytes, payload: bytes) -> bytes:
+    # "<prefix><payload>" chat frame built from the received bytes, without decoding them
+    length = len(prefix) + len(payload)
+    if length > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"Frame payload too large ({length} bytes)")
+    return b"".join((HEADER.pack(length, FrameType.Chat), prefix, payload))
+
+
+def encode_frames(frames: Iterable[tuple[FrameType, str | bytes]]) -> bytes:
+    # several frames glued together, sent with a single syscall
+    return b"".join(encode_frame(frame_type, payload) for frame_type, payload in frames)
+
+
+def send_frame(sock, frame_type: FrameType, payload: str | bytes):
+    blocking_io("sendall")
+    sock.sendall(encode_frame(frame_type, payload))
+
+
+class FrameDecoder:
+    """Incremental frame parser for one connection.
+
+    Bytes are received straight into a reusable bytearray, so pipelined frames
+    read by one `recv_into` are handed out without further syscalls.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        self.__buffer = bytearray(capacity)
+        self.__start = 0
+        self.__end = 0
+        # a connection's socket may be read from the chat and the game threads
+        self.__lock = threading.Lock()
+
+    def __reserve(self, size: int):
+        # make room for `size` more bytes after the buffered data
+        if self.__end + size <= len(self.__buffer):
+            return
+        pending = self.__end - self.__start
+        if self.__start > 0:
+            self.__buffer[:pending] = self.__buffer[self.__start:self.__end]
+            self.__start, self.__end = 0, pending
+        if pending + size > len(self.__buffer):
+            self.__buffer.extend(bytes(pending + size - len(self.__buffer)))
+
+    def feed(self, data: bytes):
+        with self.__lock:
+            self.__reserve(len(data))
+            self.__buffer[self.__end:self.__end + len(data)] = data
+            self.__end += len(data)
+
+    def take_buffered(self) -> bytes:
+        # bytes received but not handed out yet, the decoder is left empty
+        with self.__lock:
+            data = bytes(self.__buffer[self.__start:self.__end])
+            self.__start = self.__end = 0
+            return data
+
+    def __recv_into(self, sock) -> int:
+        self.__reserve(1024)
+        blocking_io("recv")
+        received = sock.recv_into(memoryview(self.__buffer)[self.__end:])
+        self.__end += received
+        return received
+
+    def __next_frame(self) -> tuple[FrameType, bytes] | None:
+        if self.__end - self.__start < HEADER.size:
+            return None
+        length, frame_type = HEADER.unpack_from(self.__buffer, self.__start)
+        if length > MAX_PAYLOAD_SIZE:
+            raise ProtocolError(f"Frame payload too large ({length} bytes)")
+        try:
+            frame_type = FrameType(frame_type)
+        except ValueError:
+            raise ProtocolError(f"Unknown frame type {frame_type}")
+        frame_end = self.__start + HEADER.size + length
+        if frame_end > self.__end:
+            self.__reserve(frame_end - self.__end)
+            return None
+        payload = bytes(self.__buffer[self.__start + HEADER.size:frame_end])
+        self.__start = frame_end
+        if self.__start == self.__end:
+            self.__start = self.__end = 0
+        return frame_type, payload
+
+    def next_frame(self) -> tuple[FrameType, bytes] | None:
+        with self.__lock:
+            return self.__next_frame()
+
+    def has_frame(self) -> bool:
+        # a complete frame is buffered and can be read without touching the socket
+        with self.__lock:
+            if self.__end - self.__start < HEADER.size:
+                return False
+            length, _ = HEADER.unpack_from(self.__buffer, self.__start)
+            return length > MAX_PAYLOAD_SIZE or self.__start + HEADER.size + length <= self.__end
+
+    def frames(self) -> Iterator[tuple[FrameType, bytes]]:
+        # every complete frame currently buffered
+        while (frame := self.next_frame()) is not None:
+            yield frame
+
+    def recv_frames(self, sock) -> list[tuple[FrameType, bytes]] | None:
+        # frames already buffered, otherwise one recv then every frame it completed.
+        # None when the peer closed the connection
+        with self.__lock:
+            frames = []
+            while (frame := self.__next_frame()) is not None:
+                frames.append(frame)
+            if frames:
+                return frames
+            if self.__recv_into(sock) == 0:
+                return None
+            while (frame := self.__next_frame()) is not None:
+                frames.append(frame)
+            return frames
+
+    def read_frame(self, sock) -> tuple[FrameType, bytes] | None:
+        # next frame, reading from the socket only when nothing is buffered
+        with self.__lock:
+            while (frame := self.__next_frame()) is None:
+                if self.__recv_into(sock) == 0:
+                    return None
+            return frame
@@ -0,0 +1,76 @@
+import time
+from enum import Enum
+
+from protocol import MAX_PAYLOAD_SIZE
+
+
+class RateLimitPolicy(Enum):
+    # frames beyond the budget are dropped, the client is told once
+    Drop = "drop"
+    # the client's socket is not read again until its budget is refilled, TCP pushes back on it
+    Delay = "delay"
+    # the client is disconnected, as when kicked from the console
+    Kick = "kick"
+
+
+class TokenBucket:
+    """`rate` tokens per second, at most `capacity` of them saved up."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, n: float) -> float:
+        # seconds until the bucket holds n tokens
+        return max(0.0, (n - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Messages and bytes per second budgets of one connection.
+
+    Checked once per recv for every frame it returned: a client within its
+    budget costs two refills and two subtractions, however many frames it
+    pipelined.
+    """
+
+    def __init__(self, message_rate: float, byte_rate: float, burst: float = 2.0):
+        # a rate of 0 is not limited, burst: seconds of traffic at full rate a bucket saves up.
+        # Any single frame fits in the buckets
+        self.messages = TokenBucket(message_rate, max(message_rate * burst, 1)) if message_rate > 0 else None
+        self.bytes = TokenBucket(byte_rate, max(byte_rate * burst, MAX_PAYLOAD_SIZE)) if byte_rate > 0 else None
+        # frames throttled since the client connected
+        self.throttled = 0
+        # frames received but waiting for the budget to be refilled
+        self.deferred: list = []
+        # the client was told to slow down, until it gets back within its budget
+        self.warned = False
+
+    def allow(self, nbr_of_frames: int, nbr_of_bytes: int, now: float) -> bool:
+        # takes the tokens of a batch of frames, only if both budgets cover all of it
+        messages, data = self.messages, self.bytes
+        if messages is not None:
+            messages.refill(now)
+            if messages.tokens < nbr_of_frames:
+                return False
+        if data is not None:
+            data.refill(now)
+            if data.tokens < nbr_of_bytes:
+                return False
+        if messages is not None:
+            messages.tokens -= nbr_of_frames
+        if data is not None:
+            data.tokens -= nbr_of_bytes
+        return True
+
+    def wait_time(self, nbr_of_frames: int, nbr_of_bytes: int) -> float:
+        # seconds until both budgets cover a batch of frames
+        return max(self.messages.wait_time(nbr_of_frames) if self.messages is not None else 0.0,
+                   self.bytes.wait_time(nbr_of_bytes) if self.bytes is not None else 0.0)
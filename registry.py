@@ -0,0 +1,104 @@
+import threading
+from typing import Dict, Generic, Iterator, Tuple, TypeVar
+
+from locks import new_lock
+
+# server.Client or any of its subclasses
+ClientT = TypeVar("ClientT")
+
+
+class ClientRegistry(Generic[ClientT]):
+    """Connected clients indexed by username and by socket file descriptor.
+
+    Usernames are spread over independently locked shards, so joins and leaves
+    only contend with clients hashing to the same shard. Lookups are plain dict
+    reads and never take a lock. Iterating the registry walks a cached tuple
+    that is rebuilt only after a join or a leave.
+    """
+
+    def __init__(self, nbr_of_shards: int = 16):
+        self.__shards: list[Tuple[Dict[str, Tuple[ClientT, int]], threading.Lock]] = [
+            (dict(), new_lock("ClientRegistry.shard")) for _ in range(nbr_of_shards)
+        ]
+        self.__by_fd: Dict[int, ClientT] = dict()
+        self.__fd_lock = new_lock("ClientRegistry.fd_lock")
+        # cached view of every client, dropped on each join or leave
+        self.__view: Tuple[ClientT, ...] | None = ()
+        self.__version = 0
+        self.__view_lock = threading.Lock()
+
+    def __shard(self, username: str):
+        return self.__shards[hash(username) % len(self.__shards)]
+
+    def __invalidate(self):
+        with self.__view_lock:
+            self.__version += 1
+            self.__view = None
+
+    def add(self, client: ClientT) -> bool:
+        # register the client unless its username is already taken
+        username = client.getUsername()
+        clients, lock = self.__shard(username)
+        fd = client.getSocket().fileno()
+        with lock:
+            if username in clients:
+                return False
+            clients[username] = (client, fd)
+        with self.__fd_lock:
+            self.__by_fd[fd] = client
+        self.__invalidate()
+        return True
+
+    def remove(self, client) -> bool:
+        # forget the client registered under this username with this socket
+        clients, lock = self.__shard(client.getUsername())
+        with lock:
+            entry = clients.get(client.getUsername())
+            if entry is None or entry[0].getSocket() is not client.getSocket():
+                return False
+            del clients[client.getUsername()]
+        with self.__fd_lock:
+            if self.__by_fd.get(entry[1]) is entry[0]:
+                del self.__by_fd[entry[1]]
+        self.__invalidate()
+        return True
+
+    def get(self, username: str) -> ClientT | None:
+        entry = self.__shard(username)[0].get(username)
+        return entry[0] if entry is not None else None
+
+    def get_by_fd(self, fd: int) -> ClientT | None:
+        return self.__by_fd.get(fd)
+
+    def snapshot(self) -> Tuple[ClientT, ...]:
+        # immutable view of every client, safe to iterate without any lock
+        with self.__view_lock:
+            if self.__view is not None:
+                return self.__view
+            version = self.__version
+        view = []
+        for clients, lock in self.__shards:
+            with lock:
+                view.extend(entry[0] for entry in clients.values())
+        view = tuple(view)
+        with self.__view_lock:
+            if self.__version == version:
+                self.__view = view
+        return view
+
+    def clear(self):
+        for clients, lock in self.__shards:
+            with lock:
+                clients.clear()
+        with self.__fd_lock:
+            self.__by_fd.clear()
+        self.__invalidate()
+
+    def __contains__(self, username: str) -> bool:
+        return self.get(username) is not None
+
+    def __iter__(self) -> Iterator[ClientT]:
+        return iter(self.snapshot())
+
+    def __len__(self) -> int:
+        return sum(len(clients) for clients, _ in self.__shards)
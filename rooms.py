@@ -0,0 +1,124 @@
+from typing import Dict, Set, Tuple
+
+from locks import new_lock
+
+DEFAULT_ROOM = "lobby"
+MAX_ROOM_NAME_LENGTH = 32
+
+
+class InvalidRoomName(Exception):
+    pass
+
+
+class Room:
+    """Named chat channel with its own membership and its own lock.
+
+    Broadcasting to a room walks a cached tuple of its members, rebuilt only
+    after someone joins or leaves it. Chat lines skip busy members (playing a
+    game), they get their own cached tuple rebuilt when a member becomes busy
+    or available again.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.__members: Dict[str, object] = dict()
+        self.__busy: Set[str] = set()
+        self.__view: Tuple | None = ()
+        self.__chat_view: Tuple | None = ()
+        self.lock = new_lock("Room.lock")
+
+    def add(self, client):
+        with self.lock:
+            self.__members[client.getUsername()] = client
+            self.__view = self.__chat_view = None
+
+    def remove(self, client) -> bool:
+        with self.lock:
+            if self.__members.get(client.getUsername()) is not client:
+                return False
+            del self.__members[client.getUsername()]
+            self.__busy.discard(client.getUsername())
+            self.__view = self.__chat_view = None
+            return True
+
+    def set_busy(self, client, busy: bool):
+        with self.lock:
+            if busy:
+                self.__busy.add(client.getUsername())
+            else:
+                self.__busy.discard(client.getUsername())
+            self.__chat_view = None
+
+    def snapshot(self) -> Tuple:
+        view = self.__view
+        if view is None:
+            with self.lock:
+                if self.__view is None:
+                    self.__view = tuple(self.__members.values())
+                view = self.__view
+        return view
+
+    def recipients(self) -> Tuple:
+        # members a chat line is delivered to
+        view = self.__chat_view
+        if view is None:
+            with self.lock:
+                if self.__chat_view is None:
+                    self.__chat_view = tuple(
+                        client for username, client in self.__members.items() if username not in self.__busy)
+                view = self.__chat_view
+        return view
+
+    def __contains__(self, username: str) -> bool:
+        return username in self.__members
+
+    def __len__(self) -> int:
+        return len(self.__members)
+
+
+class RoomDirectory:
+    def __init__(self):
+        self.__rooms: Dict[str, Room] = {DEFAULT_ROOM: Room(DEFAULT_ROOM)}
+        # only taken to create or delete a room, never to broadcast
+        self.__lock = new_lock("RoomDirectory.lock")
+
+    def get(self, name: str) -> Room | None:
+        return self.__rooms.get(name)
+
+    def lobby(self) -> Room:
+        return self.__rooms[DEFAULT_ROOM]
+
+    def join(self, client, name: str) -> Room:
+        # move the client from its current room to `name`, creating the room if needed
+        if not name or len(name) > MAX_ROOM_NAME_LENGTH or " " in name:
+            raise InvalidRoomName(
+                f"Room names are 1 to {MAX_ROOM_NAME_LENGTH} characters long, without spaces")
+        self.leave(client)
+        while True:
+            with self.__lock:
+                room = self.__rooms.get(name)
+                if room is None:
+                    room = self.__rooms[name] = Room(name)
+            room.add(client)
+            # the room may have been deleted between the lookup and the add
+            if self.__rooms.get(name) is room:
+                break
+            room.remove(client)
+        client.setRoom(room)
+        return room
+
+    def leave(self, client) -> Room | None:
+        room = client.getRoom()
+        if room is None:
+            return None
+        room.remove(client)
+        client.setRoom(None)
+        if room.name != DEFAULT_ROOM:
+            with self.__lock:
+                with room.lock:
+                    if len(room) == 0 and self.__rooms.get(room.name) is room:
+                        del self.__rooms[room.name]
+        return room
+
+    def list(self) -> list[tuple[str, int]]:
+        return sorted((room.name, len(room)) for room in list(self.__rooms.values()))
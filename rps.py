@@ -0,0 +1,99 @@
+import logging
+from enum import Enum
+from typing import Callable, Sequence
+
+from locks import new_lock
+from protocol import FrameType, encode_frame
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class RPSEnum(Enum):
+    NoChoice = 0
+    Rock = 1
+    Paper = 2
+    Scissors = 3
+
+
+# round outcomes
+TIE = 0
+PLAYER1_WINS = 1
+PLAYER2_WINS = 2
+
+# OUTCOMES[choice1][choice2], indexed by RPSEnum values. A player who did not choose loses
+OUTCOMES = (
+    (TIE, PLAYER2_WINS, PLAYER2_WINS, PLAYER2_WINS),
+    (PLAYER1_WINS, TIE, PLAYER2_WINS, PLAYER1_WINS),
+    (PLAYER1_WINS, PLAYER1_WINS, TIE, PLAYER2_WINS),
+    (PLAYER1_WINS, PLAYER2_WINS, PLAYER1_WINS, TIE),
+)
+# same table flattened, OUTCOMES[choice1][choice2] == FLAT_OUTCOMES[4 * choice1 + choice2]
+FLAT_OUTCOMES = bytes(outcome for row in OUTCOMES for outcome in row)
+OUTCOME_ARRAY = np.array(OUTCOMES, dtype=np.int8) if np is not None else None
+# below this many rounds building the arrays costs more than the lookups
+NUMPY_MIN_BATCH = 64
+
+TIE_FRAME = encode_frame(FrameType.Chat, "Server << It's a tie!")
+WIN_FRAME = encode_frame(FrameType.Chat, "Server << You win!!")
+LOST_FRAME = encode_frame(FrameType.Chat, "Server << You lost :((")
+# RESULT_FRAMES[outcome]: (frame for player 1, frame for player 2), encoded once for every game
+RESULT_FRAMES = (
+    (TIE_FRAME, TIE_FRAME),
+    (WIN_FRAME, LOST_FRAME),
+    (LOST_FRAME, WIN_FRAME),
+)
+
+
+def resolve(choice1: RPSEnum, choice2: RPSEnum) -> int:
+    # _value_ is a plain attribute, `value` goes through a descriptor on every access
+    return OUTCOMES[choice1._value_][choice2._value_]
+
+
+def resolve_batch(choices1: Sequence[int], choices2: Sequence[int]) -> list[int]:
+    # outcomes of many rounds in one pass, choices given as RPSEnum values
+    if OUTCOME_ARRAY is not None and len(choices1) >= NUMPY_MIN_BATCH:
+        return OUTCOME_ARRAY[np.asarray(choices1, dtype=np.intp), np.asarray(choices2, dtype=np.intp)].tolist()
+    return [FLAT_OUTCOMES[4 * choice1 + choice2] for choice1, choice2 in zip(choices1, choices2)]
+
+
+class RoundResolver:
+    """Resolves the rounds finished by every game, in batches.
+
+    The first finished round schedules a flush; rounds finishing before it runs
+    join the same batch, so under load one pass resolves many games at once.
+    """
+
+    def __init__(self, submit: Callable[[Callable], bool]):
+        # submit: runs the flush later, False when it cannot
+        self.submit = submit
+        self.__pending: list[tuple[object, int, int]] = []
+        self.__lock = new_lock("RoundResolver.lock")
+        self.batches = 0
+        self.rounds = 0
+        self.logger = logging.getLogger("RoundResolver")
+
+    def add(self, game, choice1: RPSEnum, choice2: RPSEnum):
+        # game.on_resolved(outcome, frames) is called once the round is resolved
+        with self.__lock:
+            self.__pending.append((game, choice1._value_, choice2._value_))
+            schedule = len(self.__pending) == 1
+        if schedule and not self.submit(self.flush):
+            self.flush()
+
+    def flush(self):
+        with self.__lock:
+            pending, self.__pending = self.__pending, []
+        if not pending:
+            return
+        games, choices1, choices2 = zip(*pending)
+        for game, outcome in zip(games, resolve_batch(choices1, choices2)):
+            # a game failing to end its round must not leave the others of the batch unresolved
+            try:
+                game.on_resolved(outcome, RESULT_FRAMES[outcome])
+            except Exception as e:
+                self.logger.error(f"Error resolving a round: {e!r}")
+        self.batches += 1
+        self.rounds += len(pending)
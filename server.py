@@ -1,8 +1,28 @@
+import os
 import socket
 import sys
 import threading
+import time
 import logging
-from typing import List
+from typing import Iterable
+
+from commands import Command, CommandRouter
+from handshake import HandshakeStage
+from history import ChatHistory
+import locks
+from locks import blocking_io, new_lock
+from metrics import Metrics, MetricsEndpoint
+from outbound import MSG_DONTWAIT, OutboundQueue, OutboundWriter, OverflowPolicy
+from protocol import FrameDecoder, FrameType, ProtocolError, encode_chat_frame, encode_frame, encode_frames
+from ratelimit import RateLimiter, RateLimitPolicy
+from registry import ClientRegistry
+from rooms import Room, RoomDirectory
+from timers import TimerQueue, TimerWheel
+from workers import ReadinessDispatcher, WorkerPool
+
+# most past messages sent by a single history command
+MAX_HISTORY = 1000
+
 logging.basicConfig(level=logging.INFO,
                     format='%(name)s: %(message)s',
                     )
@@ -32,10 +52,19 @@ class Socket_address():
 
 
 class Client():
-    def __init__(self, socket: socket.socket, address: Socket_address, username: str):
+    def __init__(self, socket: socket.socket, address: Socket_address, username: str, decoder: FrameDecoder | None = None):
         self.__socket = socket
         self.__address = address
         self.__username = username
+        # frames already buffered during the handshake must not be lost
+        self.__decoder = decoder if decoder is not None else FrameDecoder()
+        self.__outbound: OutboundQueue | None = None
+        self.__chat_prefix: bytes | None = None
+        self.__direct_prefix: bytes | None = None
+        self.__room: Room | None = None
+        # last time anything was received from the client, for the heartbeats
+        self.__last_seen = time.monotonic()
+        self.__rate_limiter: RateLimiter | None = None
 
     def getSocket(self):
         return self.__socket
@@ -54,6 +83,58 @@ class Client():
 
     def setUsername(self, username):
         self.__username = username
+        self.__chat_prefix = None
+        self.__direct_prefix = None
+
+    def chat_frame(self, payload: bytes) -> bytes:
+        # "<username> << <payload>" frame, the prefix is encoded once per client
+        if self.__chat_prefix is None:
+            self.__chat_prefix = f"{self.__username} << ".encode()
+        return encode_chat_frame(self.__chat_prefix, payload)
+
+    def direct_frame(self, payload: bytes) -> bytes:
+        # "<username> (private) << <payload>" frame
+        if self.__direct_prefix is None:
+            self.__direct_prefix = f"{self.__username} (private) << ".encode()
+        return encode_chat_frame(self.__direct_prefix, payload)
+
+    def getRoom(self):
+        return self.__room
+
+    def setRoom(self, room: Room | None):
+        self.__room = room
+
+    def getDecoder(self):
+        return self.__decoder
+
+    def getLastSeen(self):
+        return self.__last_seen
+
+    def setLastSeen(self, last_seen: float):
+        self.__last_seen = last_seen
+
+    def getRateLimiter(self):
+        return self.__rate_limiter
+
+    def setRateLimiter(self, rate_limiter: RateLimiter | None):
+        self.__rate_limiter = rate_limiter
+
+    def getOutbound(self):
+        return self.__outbound
+
+    def setOutbound(self, outbound: OutboundQueue):
+        self.__outbound = outbound
+
+    def send_frame(self, frame: bytes):
+        # queued for the outbound writer once the client is registered
+        if self.__outbound is not None:
+            self.__outbound.put(frame)
+        else:
+            blocking_io("sendall")
+            self.__socket.sendall(frame)
+
+    def send(self, message: str | bytes, frame_type: FrameType = FrameType.Chat):
+        self.send_frame(encode_frame(frame_type, message))
 
     def __eq__(self, client):
         if isinstance(client, Client):
@@ -62,22 +143,91 @@ class Client():
 
 
 class Server:
-    def __init__(self, server_address, close_event):
+    def __init__(self, server_address, close_event, overflow_policy: OverflowPolicy = OverflowPolicy.DropOldest, max_queued_frames: int = 1024, max_queued_bytes: int = 1 << 20, backlog: int = socket.SOMAXCONN, handshake_timeout: float = 10.0, nbr_of_workers: int = 8, max_pending_tasks: int = 1024, max_clients: int = 10000, data_dir: str | None = None, replay_on_join: int = 0, metrics_port: int | None = None, reuse_port: bool = False, heartbeat_interval: float = 15.0, idle_timeout: float = 45.0, message_rate: float = 0.0, byte_rate: float = 0.0, rate_limit_burst: float = 2.0, rate_limit_policy: RateLimitPolicy = RateLimitPolicy.Drop):
 
         self.host = server_address[0]
         self.port = server_address[1]
+        self.backlog = backlog
+        self.max_clients = max_clients
+        # several processes listen on the same port, the kernel spreads the connections between them
+        self.reuse_port = reuse_port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients: List[Client] = list()
+        self.clients: ClientRegistry[Client] = ClientRegistry()
+        # chat messages only reach the members of the sender's room
+        self.rooms = RoomDirectory()
         self.close_event = close_event
-        self.lock = threading.Lock()
+        self.lock = new_lock("Server.lock")
         self.logger = logging.getLogger("Server")
         self.chat_logger = logging.getLogger("Chat")
+        # every registered client gets a bounded outbound queue drained by this writer
+        self.writer = OutboundWriter(
+            self._on_outbound_failure, max_queued_frames, max_queued_bytes, overflow_policy)
+        # new connections pick their username here, off the accept loop
+        self.handshakes = HandshakeStage(
+            self._register_client, self._start_client_handler, handshake_timeout)
+        # a fixed pool of workers handles every client, fed by a single selector thread
+        self.pool = WorkerPool(nbr_of_workers, max_pending_tasks)
+        self.dispatcher = ReadinessDispatcher(self.pool, self._on_readable, self._drop_client)
+        # delayed work (game timeouts...) without a thread or a sleep per task
+        self.timers = TimerQueue()
+        # silent clients are pinged after `heartbeat_interval` seconds, disconnected after
+        # `idle_timeout` ones; a single wheel timer per client, 0 disables them
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.heartbeats = TimerWheel(self.timers, tick=min(0.5, heartbeat_interval / 4 or 0.5))
+        # frames and bytes per second a client may send, beyond them `rate_limit_policy` applies; 0 does not limit
+        self.message_rate = message_rate
+        self.byte_rate = byte_rate
+        self.rate_limit_burst = rate_limit_burst
+        self.rate_limit_policy = rate_limit_policy
+        # persistent state goes under `data_dir`, None keeps everything in memory
+        self.data_dir = data_dir
+        # recent chat of every room, the last `replay_on_join` lines are sent to whoever joins it
+        self.history = ChatHistory(
+            os.path.join(data_dir, "history") if data_dir else None)
+        self.replay_on_join = replay_on_join
+        # counters and latency histograms, read by the `stats` command and on `metrics_port`
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_endpoint: MetricsEndpoint | None = None
+        self.frames_received = self.metrics.counter(
+            "frames_received", "Frames received from clients")
+        self.frames_queued = self.metrics.counter(
+            "frames_queued", "Frames queued to clients by broadcasts")
+        self.receive_to_deliver = self.metrics.histogram(
+            "receive_to_deliver_seconds", "Time from receiving a frame to queueing its replies and broadcasts")
+        self.broadcast_time = self.metrics.histogram(
+            "broadcast_seconds", "Time to queue a frame to every recipient of a broadcast")
+        self.clients_reaped = self.metrics.counter(
+            "clients_reaped", "Clients disconnected for not answering the heartbeats")
+        self.frames_throttled = self.metrics.counter(
+            "frames_throttled", "Frames received beyond a client's rate limit")
+        self.clients_flooding = self.metrics.counter(
+            "clients_flooding", "Clients disconnected for going beyond their rate limit")
+        self._register_metrics()
+        # command words of the Command and Control frames, and their handlers
+        self.commands = CommandRouter()
+        self._register_commands()
 
     def start(self):
+        self.writer.start()
+        self.pool.start()
+        self.dispatcher.start()
+        self.timers.start()
+        if self.heartbeat_interval > 0:
+            self.heartbeats.start()
+        self.history.start()
+        if self.metrics_port is not None:
+            self.metrics_endpoint = MetricsEndpoint(self.metrics, self.metrics_port)
+            self.metrics_endpoint.start()
+        self.handshakes.start()
         self.server_socket.setsockopt(
             socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.backlog)
         self.logger.info(f"Listening on {self.host}:{self.port}")
 
         while not self.close_event.is_set():
@@ -85,14 +235,14 @@ class Server:
                 client_socket, client_address = self.server_socket.accept()
                 self.logger.info(
                     f"Connection from client {client_address[0]}:{client_address[1]}")
-
-                username = self._request_client_username(
-                    client_socket, client_address, "Server << Enter your username:", 0)
-                if username:
-                    # assign a thread for each new subscribed client
-                    client_handler = threading.Thread(
-                        target=self._handle_client, args=(Client(socket=client_socket, address=client_address, username=username),))
-                    client_handler.start()
+                error_message = self._admission_error()
+                if error_message is not None:
+                    self.logger.warning(
+                        f"Refusing {client_address[0]}:{client_address[1]}: {error_message}")
+                    self._refuse_connection(client_socket, error_message)
+                    continue
+                # the accept loop never waits for a client to answer
+                self.handshakes.add(client_socket, client_address)
             except KeyboardInterrupt:
                 self._close_server()
             except socket.error as e:
@@ -103,96 +253,312 @@ class Server:
                     self.logger.error(
                         f"Error accepting or handling new connections: {e}")
 
-    # handle incoming messages for each client
-    def _handle_client(self, client: Client):
+    # handle the frames a client sent, called by a worker once its socket is readable
+    def _on_readable(self, client: Client) -> bool:
         try:
-            while not self.close_event.is_set():
-                data = client.getSocket().recv(2048)
-                if not data:
-                    break
+            limiter = client.getRateLimiter()
+            resumed = limiter is not None and bool(limiter.deferred)
+            if resumed:
+                # frames held back by the rate limit, the socket was not read meanwhile
+                frames, limiter.deferred = limiter.deferred, []
+                if self.clients.get(client.getUsername()) is not client:
+                    frames = []
+            else:
+                # every frame pipelined in one recv is handled before reading again
+                frames = client.getDecoder().recv_frames(client.getSocket())
+            if frames is None:
+                # connection dropped without a "close"
+                if self.clients.get(client.getUsername()) is client:
+                    self._disconnect_client(client)
+                self.writer.unregister(client)
+                return False
+            received = time.perf_counter()
+            now = time.monotonic()
+            if not resumed:
+                client.setLastSeen(now)
+                self.frames_received.inc(len(frames))
+            pause = 0.0
+            if limiter is not None:
+                # the whole batch is checked at once, frame by frame only beyond the budget
+                if limiter.allow(len(frames), sum(len(payload) for _, payload in frames), now):
+                    limiter.warned = False
                 else:
-                    message = data.decode().strip()
-                    if message == "close":
-                        self._disconnect_client(client)
-                    else:
-                        client_username = client.getUsername()
-                        self.chat_logger.info(
-                            f"{client_username} << {message}")
-                        with self.lock:
-                            self._broadcast(
-                                f"{client_username} << {message}".encode(),
-                                [client_obj for client_obj in self.clients if client_obj.getUsername(
-                                ) != client_username]
-                            )
-        except KeyboardInterrupt:
-            self._close_server()
-        except socket.error as e:
-            # send a close signal to client's socket when ERROR
+                    frames, pause = self._throttle(client, limiter, frames, now, resumed)
+            for frame_type, payload in frames:
+                if frame_type == FrameType.Control and payload == b"pong":
+                    # heartbeat answer, receiving it was all that mattered
+                    continue
+                self._handle_frame(client, frame_type, payload)
+                self.receive_to_deliver.record(time.perf_counter() - received)
+                if self.clients.get(client.getUsername()) is not client:
+                    # the frame closed the client, the ones pipelined behind it are not handled
+                    break
+            if pause > 0:
+                # served again once its budget is refilled, meanwhile TCP pushes back on the client
+                self.timers.call_later(pause, self.dispatcher.watch, client, True)
+                return False
+            return not self.close_event.is_set()
+        except (socket.error, ProtocolError, UnicodeDecodeError) as e:
             self.logger.warning(f"Error handling client: {e}")
             # close connection with client on ERROR
-            with self.lock:
-                self.clients.remove(client)
+            self._drop_client(client)
+            return False
 
-    def _broadcast(self, message, clients: list[Client]):
-        for client in clients:
+    def _drop_client(self, client: Client):
+        # tears down a client whose frames cannot be handled, its handler is not called again
+        if self.clients.get(client.getUsername()) is client:
+            self._disconnect_client(client)
+        else:
+            self.rooms.leave(client)
+        limiter = client.getRateLimiter()
+        if limiter is not None:
+            limiter.deferred = []
+        self.writer.unregister(client)
+        # the client sees the connection drop, its heartbeat timer finds it unregistered
+        try:
+            client.getSocket().shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _throttle(self, client: Client, limiter: RateLimiter, frames: list, now: float, resumed: bool) -> tuple[list, float]:
+        # frames of a client beyond its budget to handle now, and how long to wait before serving it again
+        if self.rate_limit_policy == RateLimitPolicy.Delay:
+            # handled in order while the budget allows, the others wait for it to be refilled
+            for i, (_, payload) in enumerate(frames):
+                if not limiter.allow(1, len(payload), now):
+                    limiter.deferred = frames[i:]
+                    if not resumed:
+                        limiter.throttled += len(frames) - i
+                        self.frames_throttled.inc(len(frames) - i)
+                    return frames[:i], limiter.wait_time(1, len(payload))
+            return frames, 0.0
+        if self.rate_limit_policy == RateLimitPolicy.Kick:
+            limiter.throttled += len(frames)
+            self.frames_throttled.inc(len(frames))
+            self.clients_flooding.inc()
+            self.logger.warning(f"Disconnecting {client.getUsername()}: sending too fast",
+                                extra={"event": "flood", "user": client.getUsername()})
+            self._kick_client(client)
+            # its handler sees the connection drop and forgets about it
             try:
-                client.getSocket().send(message)
-            except Exception as e:
-                self.logger.error(f"Error broadcasting to client: {e}")
-                # close connection with client on ERROR
-                with self.lock:
-                    self.clients.remove(client)
-
-    def _request_client_username(self, client_socket, client_address, message, nbr_of_attempts):
-        max_nbr_of_attempts = 3
-        if nbr_of_attempts >= max_nbr_of_attempts:
-            # close client's connection
-            client_socket.send(
-                "close".encode())
+                client.getSocket().shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return [], 0.0
+        # control frames (close, pong...) are never dropped
+        allowed = [(frame_type, payload) for frame_type, payload in frames
+                   if frame_type == FrameType.Control or limiter.allow(1, len(payload), now)]
+        dropped = len(frames) - len(allowed)
+        limiter.throttled += dropped
+        self.frames_throttled.inc(dropped)
+        if dropped and not limiter.warned:
+            limiter.warned = True
+            client.send("Server << You are sending too fast, some of your messages were dropped")
+        return allowed, 0.0
+
+    def _throttled_clients(self) -> list[tuple[str, int]]:
+        # usernames and throttled frames of the clients that went beyond their rate limit, most throttled first
+        throttled = [(client.getUsername(), client.getRateLimiter().throttled) for client in self.clients.snapshot()
+                     if client.getRateLimiter() is not None and client.getRateLimiter().throttled]
+        return sorted(throttled, key=lambda item: item[1], reverse=True)
+
+    def _handle_frame(self, client: Client, frame_type: FrameType, payload: bytes):
+        payload = payload.strip()
+        # chat lines skip the command lookup, unknown commands are chat too
+        if frame_type != FrameType.Chat and self.commands.dispatch(client, payload):
+            return
+        self._handle_chat(client, payload)
+
+    def _register_commands(self):
+        self.commands.register("close", self._handle_close_command)
+        self.commands.register("history", self._handle_history_command)
+
+    def _handle_chat(self, client: Client, payload: bytes):
+        # checked before anyone receives it, invalid UTF-8 is a protocol error
+        message = payload.decode()
+        # the received bytes are framed as they are, never re-encoded
+        room = client.getRoom()
+        if room is None:
+            # left the chatroom earlier in the same batch of frames
+            return
+        self._broadcast_chat(client, room, client.chat_frame(payload))
+        # logged once delivered, the log writer thread formats the line
+        self.chat_logger.info("%s << %s", client.getUsername(), message,
+                              extra={"event": "chat", "user": client.getUsername(), "room": room.name})
+
+    def _handle_close_command(self, client: Client, command: Command):
+        # client requesting closing connection
+        self._disconnect_client(client)
+
+    def _broadcast_chat(self, client: Client, room: Room, frame: bytes):
+        # a chat line reaches the room's members and its history
+        self._broadcast_frame(frame, room.recipients(), exclude=client)
+        self.history.append(room.name, frame)
+
+    def _broadcast(self, message: str | bytes, clients: Iterable[Client], exclude: Client | None = None):
+        self._broadcast_frame(encode_frame(
+            FrameType.Chat, message), clients, exclude)
+
+    def _broadcast_frame(self, frame: bytes, clients: Iterable[Client], exclude: Client | None = None):
+        # the same immutable frame is queued for every recipient, a slow client never blocks the others
+        start = time.perf_counter()
+        queued = 0
+        for client in clients:
+            if client is not exclude:
+                client.send_frame(frame)
+                queued += 1
+        self.broadcast_time.record(time.perf_counter() - start)
+        self.frames_queued.inc(queued)
+
+    def _register_metrics(self):
+        # counters and gauges kept by the server's components
+        metrics = self.metrics
+        metrics.histogram("handshake_seconds", "Time from accept to username registration",
+                          self.handshakes.latency)
+        metrics.counter("handshakes_completed", "Connections that picked a username",
+                        lambda: self.handshakes.completed)
+        metrics.counter("handshakes_timed_out", "Connections closed before picking a username",
+                        lambda: self.handshakes.timed_out)
+        metrics.counter("handshakes_rejected", "Connections closed after too many invalid usernames",
+                        lambda: self.handshakes.rejected)
+        metrics.gauge("handshakes_pending", "Connections picking a username",
+                      self.handshakes.pending)
+        metrics.gauge("clients", "Registered clients", lambda: len(self.clients))
+        metrics.gauge("rooms", "Chat rooms", lambda: len(self.rooms.list()))
+        metrics.gauge("clients_throttled", "Registered clients that went beyond their rate limit",
+                      lambda: len(self._throttled_clients()))
+        metrics.histogram("worker_queue_wait_seconds", "Time tasks wait for a worker",
+                          self.pool.wait_time)
+        metrics.counter("worker_tasks_completed", "Tasks run by the worker pool",
+                        lambda: self.pool.completed)
+        metrics.counter("worker_tasks_rejected", "Tasks refused by a saturated worker pool",
+                        lambda: self.pool.rejected)
+        metrics.gauge("worker_tasks_pending", "Tasks waiting for a worker",
+                      lambda: self.pool.stats()["pending_tasks"])
+        metrics.gauge("outbound_queued_frames", "Frames waiting in the outbound queues",
+                      lambda: self.writer.stats()["queued_frames"])
+        metrics.gauge("outbound_queued_bytes", "Bytes waiting in the outbound queues",
+                      lambda: self.writer.stats()["queued_bytes"])
+        metrics.counter("outbound_dropped_frames", "Frames dropped by full outbound queues",
+                        lambda: self.writer.stats()["dropped_frames"])
+        metrics.counter("outbound_slow_consumers", "Clients disconnected for not reading",
+                        lambda: self.writer.slow_consumers)
+        metrics.gauge("history_backlog", "Chat frames not written to the history log yet",
+                      self.history.backlog)
+
+    def _on_outbound_failure(self, client: Client, reason: str):
+        # called from the writer thread, the client's handler sees the connection drop and disconnects it
+        self.logger.warning(
+            f"Closing connection with {client.getUsername()}: {reason}")
+        try:
+            client.getSocket().shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _register_client(self, client_socket, client_address, username: str, decoder: FrameDecoder) -> Client | None:
+        # called by the handshake stage once a username was received, None if it is already taken
+        new_client = Client(
+            socket=client_socket,
+            address=Socket_address(
+                ip=client_address[0],
+                port=client_address[1]
+            ),
+            username=username,
+            decoder=decoder
+        )
+        self.writer.register(new_client)
+        # username accepted if not already taken, checked and inserted atomically
+        if not self.clients.add(new_client):
+            self.writer.unregister(new_client)
+            return None
+        new_client.send(f"Server << Welcome {username} :)")
+        self.logger.info(f"{username} joined the chatroom",
+                         extra={"event": "connect", "user": username})
+        # every client starts in the lobby, inform its members
+        lobby = self.rooms.join(new_client, self.rooms.lobby().name)
+        self._broadcast(
+            f"{username} joined the chatroom", lobby.snapshot(), exclude=new_client)
+        self._replay_history(new_client, lobby)
+        return new_client
+
+    def _handle_history_command(self, client: Client, command: Command):
+        try:
+            n = int(command.args) if command.args else 20
+        except ValueError:
+            client.send("Server << Usage: history [n]")
+            return
+        room = client.getRoom()
+        if not self._send_history(client, room, min(n, MAX_HISTORY)):
+            client.send(f"Server << No messages in <{room.name}> yet")
+
+    def _send_history(self, client: Client, room: Room, n: int) -> bool:
+        frames = self.history.recent(room.name, n)
+        if not frames:
+            return False
+        client.send(f"Server << Last messages in <{room.name}>:")
+        # stored frames are queued as they are, runs of them read from the log in one buffer
+        for frame in frames:
+            client.send_frame(frame)
+        return True
+
+    def _replay_history(self, client: Client, room: Room):
+        if self.replay_on_join > 0:
+            self._send_history(client, room, self.replay_on_join)
+
+    def _start_client_handler(self, client: Client):
+        if self.message_rate > 0 or self.byte_rate > 0:
+            client.setRateLimiter(RateLimiter(self.message_rate, self.byte_rate, self.rate_limit_burst))
+        # frames pipelined behind the username are already buffered, the socket may stay silent
+        self.dispatcher.watch(client, ready=client.getDecoder().has_frame())
+        if self.heartbeat_interval > 0:
+            self.heartbeats.call_later(self.heartbeat_interval, self.__check_heartbeat, client)
+
+    def __check_heartbeat(self, client: Client):
+        # called from the timer thread, pings a silent client or reaps it once idle for too long
+        if self.clients.get(client.getUsername()) is not client:
+            # disconnected or handed over since, its timer is dropped
+            return
+        idle = time.monotonic() - client.getLastSeen()
+        if idle >= self.idle_timeout:
+            self._reap_client(client, idle)
+            return
+        if idle >= self.heartbeat_interval:
+            client.send("ping", FrameType.Control)
+            delay = min(self.heartbeat_interval, self.idle_timeout - idle)
         else:
-            # request username
-            client_socket.send(message.encode())
-            # wait for client's response
-            username = client_socket.recv(2048).decode().strip()
-
-            if len(username) > 0:
-                # block access to self.clients variable
-                self.lock.acquire()
-                # check if username is not already taken
-                if username not in [client.getUsername() for client in self.clients]:
-                    # username accepted
-                    self.clients.append(
-                        Client(
-                            socket=client_socket,
-                            address=Socket_address(
-                                ip=client_address[0],
-                                port=client_address[1]
-                            ),
-                            username=username
-                        )
-                    )
-                    # permet access to self.clients variable
-                    self.lock.release()
-                    client_socket.send(
-                        f"Server << Welcome {username} :)".encode())
-                    self.logger.info(f"{username} joined the chatroom")
-                    # inform other clients
-                    with self.lock:
-                        self._broadcast(
-                            f"{username} joined the chatroom".encode(), [client for client in self.clients if client.getUsername() != username])
-                    return username
-                else:
-                    # permet access to self.clients variable if first condition not satisfied.
-                    # Preventing undefinete block of access to self.clients
-                    self.lock.release()
+            delay = self.heartbeat_interval - idle
+        self.heartbeats.call_later(delay, self.__check_heartbeat, client)
 
-                    # request another username
-                    self._request_client_username(
-                        client_socket, client_address, f"Server << Username is already taken. Connection will be closed on no attempts left. {3 - nbr_of_attempts - 1} attempts left. Enter a different username:", nbr_of_attempts + 1)
-            else:
-                # invalide username format
-                self._request_client_username(
-                    client_socket, client_address, f"Server << Invalid username. Connection will be closed on no attempts left. {3 - nbr_of_attempts - 1} attempts left. Enter a different username:", nbr_of_attempts + 1)
+    def _reap_client(self, client: Client, idle: float):
+        # a half-open connection never reads nor answers, it is disconnected as any other client
+        self.logger.warning(
+            f"Disconnecting {client.getUsername()}: nothing received for {idle:.0f}s",
+            extra={"event": "reap", "user": client.getUsername()})
+        self.clients_reaped.inc()
+        self._disconnect_client(client)
+        # its handler sees the connection drop and forgets about it
+        try:
+            client.getSocket().shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _admission_error(self) -> str | None:
+        # why a new connection is refused, None when it is welcome
+        if len(self.clients) + self.handshakes.pending() >= self.max_clients:
+            return "Server is full, try again later"
+        if self.pool.saturated():
+            return "Server is busy, try again later"
+        return None
+
+    def _refuse_connection(self, client_socket, reason: str):
+        try:
+            client_socket.send(encode_frames([
+                (FrameType.Chat, f"Server << {reason}"),
+                (FrameType.Control, "close"),
+            ]), MSG_DONTWAIT)
+        except OSError:
+            pass
+        client_socket.close()
 
     def delete_client_from_clients_list(self, client_to_delete: Client):
         return [client for client in self.clients if client.getUsername() != client_to_delete.getUsername()]
@@ -200,26 +566,43 @@ class Server:
     def _disconnect_client(self, client: Client):
         client_username = client.getUsername()
         # close connection with client
-        with self.lock:
-            self.clients.remove(client)
-            self.logger.info(
-                f"{client_username} has disconnected")
-        with self.lock:
-            self._broadcast(f"Server << {client_username} has disconnected".encode(),
-                            [client_obj for client_obj in self.clients if client_obj != client])
+        if self.clients.remove(client):
+            self._client_removed(client)
+        room = self.rooms.leave(client)
+        self.logger.info(
+            f"{client_username} has disconnected", extra={"event": "disconnect", "user": client_username})
+        if room is not None:
+            self._broadcast(f"Server << {client_username} has disconnected",
+                            room.snapshot())
+
+    def _client_removed(self, client: Client):
+        # the client's username is free again
+        pass
+
+    def _kick_client(self, client: Client):
+        # close connection from client side, then forget about it
+        client.send("close", FrameType.Control)
+        self._disconnect_client(client)
 
     def _close_server(self):
         self.logger.warning(
             f"Server is shutting down. Informing clients...")
+        clients = self.clients.snapshot()
         # send closing message to all subscribed clients
-        for client in self.clients:
+        for client in clients:
+            self.logger.warning(
+                f"Informing client {client.getUsername()}...")
+            # close connection from client side
+            client.send("close", FrameType.Control)
+        deadline = time.monotonic() + 2
+        for client in clients:
             client_username = client.getUsername()
             try:
-                self.logger.warning(
-                    f"Informing client {client_username}...")
-                # close connection from client side
+                # let the writer flush the closing message
+                outbound = client.getOutbound()
+                if outbound is not None:
+                    outbound.join(max(0, deadline - time.monotonic()))
                 client_socket = client.getSocket()
-                client_socket.send("close".encode())
                 # close connection from server side
                 client_socket.shutdown(socket.SHUT_RDWR)
                 client_socket.close()
@@ -228,8 +611,15 @@ class Server:
                     f"Error sending shutdown message to {client_username}: {e}")
 
         # clear clients list
-        with self.lock:
-            self.clients.clear()
+        self.clients.clear()
+        self.handshakes.stop()
+        self.dispatcher.stop()
+        self.pool.stop()
+        self.timers.stop()
+        self.writer.stop()
+        self.history.stop()
+        if self.metrics_endpoint is not None:
+            self.metrics_endpoint.stop()
 
         try:
             # Close the server socket
@@ -253,7 +643,7 @@ class UserInputHandler:
         try:
             while not self.close_event.is_set():
                 self.logger.info(
-                    "Enter message (to close connection, type 'close .' to shut down the server, or 'close /username/' to disconnect a user):")
+                    "Enter message (to close connection, type 'close .' to shut down the server, or 'close /username/' to disconnect a user, 'stats' to show the server's metrics, 'locks' the most contended locks, 'throttled' the clients going beyond their rate limit):")
                 message = sys.stdin.readline().strip()
                 if message.split(" ")[0] == "close":
                     message_array = message.split(" ")
@@ -271,22 +661,40 @@ class UserInputHandler:
                             # close the client's socket
                             client_username = target_to_close
                             # if client_username != "":
-                            found = False
-                            for client in self.server.clients:
-                                if client_username == client.getUsername():
-                                    found = True
-                                    client.getSocket().send("close".encode())
-                                    self.server._disconnect_client(client)
-                            if not found:
+                            client = self.server.clients.get(client_username)
+                            if client is not None:
+                                self.server._kick_client(client)
+                            else:
                                 self.logger.warning(
                                     "Username does not exist. Type 'close .' to shut down the server, or 'close /username/' to disconnect a user")
                             # else:
                                 # self.logger.warning(
                                 # "Invalid argument. Type 'close .' to shut down the server, or 'close /username/' to disconnect a user")
+                elif message == "throttled":
+                    throttled_clients = getattr(self.server, "_throttled_clients", None)
+                    if throttled_clients is None:
+                        self.logger.warning(
+                            "Throttled clients are only listed by a single process threaded server")
+                    elif not throttled_clients():
+                        self.logger.info("No client went beyond its rate limit")
+                    else:
+                        for username, throttled in throttled_clients():
+                            self.logger.info(f"{username}: {throttled} frames throttled")
+                elif message == "locks":
+                    for line in locks.report():
+                        self.logger.info(line)
+                elif message == "stats":
+                    metrics = getattr(self.server, "metrics", None)
+                    if metrics is None:
+                        self.logger.warning(
+                            "Metrics are only collected by the threaded engine")
+                    else:
+                        for line in metrics.report():
+                            self.logger.info(line)
                 else:
                     # broadcast a message to all subscribed clients
                     self.server._broadcast(
-                        f"Server << {message}".encode(), self.server.clients)
+                        f"Server << {message}", self.server.clients.snapshot())
         except Exception as e:
             if 'I/O operation on closed file.' in {e}:
                 pass
@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+from challenges import ChallengeStore
+from timers import TimerQueue
+
+
+class Player:
+    def __init__(self, username):
+        self.username = username
+
+    def getUsername(self):
+        return self.username
+
+
+@pytest.fixture
+def timers():
+    timers = TimerQueue()
+    timers.start()
+    yield timers
+    timers.stop()
+
+
+def test_request_expires_after_ttl(timers):
+    expired = []
+    done = threading.Event()
+
+    def on_expire(challenge):
+        expired.append(challenge)
+        done.set()
+
+    store = ChallengeStore(timers, on_expire, ttl=0.05)
+    alice, bob = Player("alice"), Player("bob")
+    assert store.add(alice, bob) is None
+    challenge = store.get("bob")
+    assert challenge.target is bob
+    assert done.wait(2)
+    assert expired == [challenge]
+    assert store.expired == 1
+    assert store.get("bob") is None
+    assert len(store) == 0
+
+
+def test_accepted_request_never_expires(timers):
+    expired = []
+    store = ChallengeStore(timers, expired.append, ttl=0.05)
+    alice, bob = Player("alice"), Player("bob")
+    store.add(alice, bob)
+    challenge = store.pop("bob")
+    assert challenge.challenger is alice
+    assert challenge.timer.cancelled
+    assert store.pop("bob") is None
+    # a timer due after the request's one, so the request had its chance to expire
+    fired = threading.Event()
+    timers.call_later(0.1, fired.set)
+    assert fired.wait(2)
+    assert expired == []
+    assert store.expired == 0
+
+
+def test_new_request_replaces_the_previous_one(timers):
+    expired = []
+    store = ChallengeStore(timers, expired.append, ttl=60)
+    alice, bob, carol = Player("alice"), Player("bob"), Player("carol")
+    store.add(alice, bob)
+    first = store.get("bob")
+    replaced = store.add(alice, carol)
+    assert replaced is first
+    assert first.timer.cancelled
+    assert store.get("bob") is None
+    assert store.get("carol").challenger is alice
+    assert len(store) == 1
+
+
+def test_cancel_drops_sent_and_received_requests(timers):
+    store = ChallengeStore(timers, lambda challenge: None, ttl=60)
+    alice, bob, carol = Player("alice"), Player("bob"), Player("carol")
+    store.add(alice, bob)
+    store.add(carol, alice)
+    cancelled = store.cancel("alice")
+    assert {challenge.challenger.getUsername() for challenge in cancelled} == {"alice", "carol"}
+    assert all(challenge.timer.cancelled for challenge in cancelled)
+    assert len(store) == 0
+    assert store.cancel("alice") == []
+
+
+def test_oldest_request_is_popped_first(timers):
+    store = ChallengeStore(timers, lambda challenge: None, ttl=60)
+    alice, bob, carol = Player("alice"), Player("bob"), Player("carol")
+    store.add(alice, carol)
+    store.add(bob, carol)
+    assert store.pop("carol").challenger is alice
+    assert store.pop("carol").challenger is bob
+    assert store.pop("carol") is None
@@ -0,0 +1,120 @@
+import json
+import random
+
+from leaderboard import Leaderboard, ScoreTree
+
+
+def reference_top(scores, n):
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+
+def reference_rank(scores, username):
+    return sum(1 for score in scores.values() if score > scores[username]) + 1
+
+
+def test_score_tree_counts_and_finds():
+    tree = ScoreTree(size=4)
+    for score in [0, 3, 3, 10, 200]:
+        tree.add(score, 1)
+    assert tree.count_at_most(2) == 1
+    assert tree.count_at_most(3) == 3
+    assert tree.count_at_most(199) == 4
+    assert tree.count_at_most(10 ** 6) == 5
+    assert [tree.find(k) for k in range(1, 6)] == [0, 3, 3, 10, 200]
+    tree.add(3, -1)
+    assert tree.count_at_most(3) == 2
+
+
+def test_ties_share_a_rank_and_are_ordered_by_username():
+    leaderboard = Leaderboard()
+    leaderboard.record("carol", 5)
+    leaderboard.record("bob", 7)
+    leaderboard.record("alice", 5)
+    leaderboard.record("dave", 1)
+    assert leaderboard.top(3) == [("bob", 7), ("alice", 5), ("carol", 5)]
+    assert leaderboard.rank("bob") == (1, 7)
+    assert leaderboard.rank("alice") == (2, 5)
+    assert leaderboard.rank("carol") == (2, 5)
+    assert leaderboard.rank("dave") == (4, 1)
+    assert leaderboard.rank("eve") is None
+
+
+def test_updates_move_players():
+    leaderboard = Leaderboard()
+    leaderboard.record("alice", 3)
+    leaderboard.record("bob", 2)
+    leaderboard.record("bob", 4)
+    assert leaderboard.top(10) == [("bob", 4), ("alice", 3)]
+    assert leaderboard.rank("alice") == (2, 3)
+    assert len(leaderboard) == 2
+
+
+def test_ranking_matches_a_sorted_reference():
+    generator = random.Random(7)
+    leaderboard = Leaderboard()
+    scores = dict()
+    for _ in range(2000):
+        username = f"player{generator.randrange(300)}"
+        scores[username] = generator.randrange(500)
+        leaderboard.record(username, scores[username])
+    for n in [0, 1, 10, 299, 400]:
+        assert leaderboard.top(n) == reference_top(scores, n)
+    for username in scores:
+        assert leaderboard.rank(username) == (reference_rank(scores, username), scores[username])
+    assert len(leaderboard) == len(scores)
+
+
+def test_scores_are_replayed_after_a_restart(tmp_path):
+    path = str(tmp_path / "scores" / "leaderboard")
+    leaderboard = Leaderboard(path, fsync_interval=0.01)
+    leaderboard.start()
+    leaderboard.record("alice", 1)
+    leaderboard.record("bob", 2)
+    leaderboard.record("alice", 3)
+    leaderboard.stop()
+
+    restarted = Leaderboard(path)
+    restarted.start()
+    try:
+        assert len(restarted) == 2
+        assert restarted.top(2) == [("alice", 3), ("bob", 2)]
+        # the log was compacted into the snapshot at start up
+        with open(f"{path}.snapshot", encoding="utf-8") as snapshot:
+            assert json.load(snapshot) == {"alice": 3, "bob": 2}
+        with open(f"{path}.log", encoding="utf-8") as log:
+            assert log.read() == ""
+    finally:
+        restarted.stop()
+
+
+def test_replay_skips_a_cut_log_line(tmp_path):
+    path = str(tmp_path / "leaderboard")
+    with open(f"{path}.snapshot", "w", encoding="utf-8") as snapshot:
+        json.dump({"alice": 1, "bob": 4}, snapshot)
+    with open(f"{path}.log", "w", encoding="utf-8") as log:
+        log.write('["alice", 5]\n["carol", 2]\n["bob", 9')
+    leaderboard = Leaderboard(path)
+    leaderboard.start()
+    try:
+        assert [leaderboard.score(username) for username in ["alice", "bob", "carol"]] == [5, 4, 2]
+        assert leaderboard.rank("bob") == (2, 4)
+    finally:
+        leaderboard.stop()
+
+
+def test_log_is_compacted_after_enough_updates(tmp_path):
+    path = str(tmp_path / "leaderboard")
+    # a single batch, written when stopping
+    leaderboard = Leaderboard(path, fsync_interval=60, compact_after=3)
+    leaderboard.start()
+    for score in range(5):
+        leaderboard.record("alice", score)
+    leaderboard.stop()
+    with open(f"{path}.snapshot", encoding="utf-8") as snapshot:
+        assert json.load(snapshot) == {"alice": 4}
+    restarted = Leaderboard(path)
+    restarted.start()
+    try:
+        assert restarted.score("alice") == 4
+    finally:
+        restarted.stop()
@@ -0,0 +1,89 @@
+import socket
+
+import pytest
+
+from protocol import HEADER, MAX_PAYLOAD_SIZE, FrameDecoder, FrameType, ProtocolError, encode_frame, encode_frames
+
+
+def test_frame_round_trip():
+    decoder = FrameDecoder()
+    decoder.feed(encode_frame(FrameType.Chat, "héllo"))
+    assert list(decoder.frames()) == [(FrameType.Chat, "héllo".encode())]
+
+
+def test_partial_reads_byte_by_byte():
+    data = encode_frames([(FrameType.Command, "play bob"), (FrameType.Choice, "2")])
+    decoder = FrameDecoder(capacity=4)
+    frames = []
+    for i in range(len(data)):
+        decoder.feed(data[i:i + 1])
+        frames.extend(decoder.frames())
+    assert frames == [(FrameType.Command, b"play bob"), (FrameType.Choice, b"2")]
+    assert decoder.next_frame() is None
+
+
+def test_incomplete_frame_stays_buffered():
+    data = encode_frame(FrameType.Chat, "x" * 100)
+    decoder = FrameDecoder()
+    decoder.feed(data[:50])
+    assert decoder.next_frame() is None
+    decoder.feed(data[50:])
+    assert decoder.next_frame() == (FrameType.Chat, b"x" * 100)
+
+
+def test_empty_payload():
+    decoder = FrameDecoder()
+    decoder.feed(encode_frame(FrameType.Chat, b""))
+    assert decoder.next_frame() == (FrameType.Chat, b"")
+
+
+def test_largest_payload_is_accepted():
+    decoder = FrameDecoder()
+    decoder.feed(encode_frame(FrameType.Chat, b"x" * MAX_PAYLOAD_SIZE))
+    assert len(decoder.next_frame()[1]) == MAX_PAYLOAD_SIZE
+
+
+def test_oversized_frame_is_refused():
+    with pytest.raises(ProtocolError):
+        encode_frame(FrameType.Chat, b"x" * (MAX_PAYLOAD_SIZE + 1))
+    decoder = FrameDecoder()
+    # only the header was received, the length alone is enough to refuse it
+    decoder.feed(HEADER.pack(MAX_PAYLOAD_SIZE + 1, FrameType.Chat))
+    with pytest.raises(ProtocolError):
+        decoder.next_frame()
+
+
+def test_unknown_frame_type_is_refused():
+    decoder = FrameDecoder()
+    decoder.feed(HEADER.pack(1, 99) + b"x")
+    with pytest.raises(ProtocolError):
+        decoder.next_frame()
+
+
+def test_recv_frames_from_a_socket():
+    reader, writer = socket.socketpair()
+    with reader, writer:
+        decoder = FrameDecoder()
+        data = encode_frames([(FrameType.Chat, "a"), (FrameType.Chat, "b" * 5000)])
+        # the second frame arrives in two reads
+        writer.sendall(data[:20])
+        assert decoder.recv_frames(reader) == [(FrameType.Chat, b"a")]
+        writer.sendall(data[20:])
+        frames = []
+        while not frames:
+            frames = decoder.recv_frames(reader)
+        assert frames == [(FrameType.Chat, b"b" * 5000)]
+        writer.close()
+        assert decoder.recv_frames(reader) is None
+
+
+def test_read_frame_waits_for_a_whole_frame():
+    reader, writer = socket.socketpair()
+    with reader, writer:
+        decoder = FrameDecoder()
+        data = encode_frames([(FrameType.Control, "close"), (FrameType.Chat, "after")])
+        writer.sendall(data)
+        assert decoder.read_frame(reader) == (FrameType.Control, b"close")
+        # the second frame was read along with the first one
+        writer.close()
+        assert decoder.read_frame(reader) == (FrameType.Chat, b"after")
@@ -0,0 +1,144 @@
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+from typing import Callable
+
+
+class Timer:
+    def __init__(self, deadline: float, callback: Callable, args: tuple):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerQueue:
+    """One thread firing every delayed callback of the server.
+
+    Callbacks run on the timer thread, they must be short and never block.
+    A cancelled timer stays in the heap until its deadline and is skipped.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("Timers")
+        self.__timers: list[tuple[float, int, Timer]] = []
+        self.__sequence = itertools.count()
+        self.__condition = threading.Condition()
+        self.__stopped = False
+        self.__thread = threading.Thread(
+            target=self.__run, name="Timers", daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self.__condition:
+            heapq.heappush(self.__timers,
+                           (timer.deadline, next(self.__sequence), timer))
+            # only wake the thread up when the new timer is the next one due
+            if self.__timers[0][2] is timer:
+                self.__condition.notify()
+        return timer
+
+    def __len__(self) -> int:
+        return len(self.__timers)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__stopped:
+                    if not self.__timers:
+                        self.__condition.wait()
+                        continue
+                    delay = self.__timers[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.__condition.wait(delay)
+                if self.__stopped:
+                    return
+                _, _, timer = heapq.heappop(self.__timers)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self.logger.error(
+                    f"Error running timer {timer.callback.__name__}: {e}")
+
+
+class TimerWheel:
+    """Hashed timer wheel for many coarse timers, one per connection for instance.
+
+    Timers are hashed by their deadline tick into a ring of slots: adding or
+    cancelling one is O(1) however many are pending, and every tick only
+    visits the timers of one slot. Deadlines are rounded up to the next tick,
+    longer delays than one turn of the wheel stay in their slot for several
+    turns. The wheel is turned by a TimerQueue, callbacks run on its thread.
+    """
+
+    def __init__(self, timers: TimerQueue, tick: float = 0.5, nbr_of_slots: int = 512):
+        self.logger = logging.getLogger("Timers")
+        self.timers = timers
+        self.tick = tick
+        # (deadline tick, timer) pairs, hashed by deadline tick
+        self.__slots: list[list[tuple[int, Timer]]] = [[] for _ in range(nbr_of_slots)]
+        self.__lock = threading.Lock()
+        self.__started_at = time.monotonic()
+        # ticks already handled since the wheel started
+        self.__current = 0
+        self.__count = 0
+
+    def start(self):
+        self.timers.call_later(self.tick, self.__turn)
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self.__lock:
+            tick = max(math.ceil((timer.deadline - self.__started_at) / self.tick), self.__current + 1)
+            self.__slots[tick % len(self.__slots)].append((tick, timer))
+            self.__count += 1
+        return timer
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def __turn(self):
+        # handles every tick elapsed since the previous turn, then waits for the next one
+        now = time.monotonic()
+        due: list[Timer] = []
+        with self.__lock:
+            target = int((now - self.__started_at) / self.tick)
+            while self.__current < target:
+                self.__current += 1
+                slot = self.__slots[self.__current % len(self.__slots)]
+                if not slot:
+                    continue
+                # timers of a later turn stay in the slot
+                pending = [entry for entry in slot if entry[0] > self.__current]
+                due += [timer for tick, timer in slot if tick <= self.__current]
+                self.__count -= len(slot) - len(pending)
+                slot[:] = pending
+        self.timers.call_later(
+            self.__started_at + (self.__current + 1) * self.tick - now, self.__turn)
+        for timer in due:
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self.logger.error(
+                    f"Error running timer {timer.callback.__name__}: {e}")
@@ -0,0 +1,237 @@
+import logging
+import queue
+import selectors
+import socket
+import threading
+import time
+from typing import Callable
+
+from metrics import Histogram
+
+
+class WorkerPool:
+    """Fixed set of threads running tasks taken from a bounded queue.
+
+    `submit` never blocks: when every worker is busy and the queue is full the
+    task is refused and the caller decides what to do with it.
+    """
+
+    def __init__(self, nbr_of_workers: int = 8, max_pending: int = 4096):
+        self.logger = logging.getLogger("Workers")
+        self.__tasks: queue.Queue = queue.Queue(max_pending)
+        self.__stop_event = threading.Event()
+        self.__threads = [
+            threading.Thread(target=self.__run,
+                             name=f"Worker {i}", daemon=True)
+            for i in range(nbr_of_workers)
+        ]
+        # time tasks spent in the queue before a worker took them
+        self.wait_time = Histogram()
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self):
+        for thread in self.__threads:
+            thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        for _ in self.__threads:
+            try:
+                self.__tasks.put_nowait(None)
+            except queue.Full:
+                break
+        for thread in self.__threads:
+            if thread.is_alive() and thread is not threading.current_thread():
+                thread.join()
+
+    def submit(self, task: Callable, *args) -> bool:
+        try:
+            self.__tasks.put_nowait((task, args, time.perf_counter()))
+            return True
+        except queue.Full:
+            self.rejected += 1
+            return False
+
+    def saturated(self) -> bool:
+        return self.__tasks.full()
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self.__threads),
+            "pending_tasks": self.__tasks.qsize(),
+            "completed_tasks": self.completed,
+            "rejected_tasks": self.rejected,
+        }
+
+    def __run(self):
+        while not self.__stop_event.is_set():
+            item = self.__tasks.get()
+            if item is None:
+                break
+            task, args, submitted_at = item
+            self.wait_time.record(time.perf_counter() - submitted_at)
+            try:
+                task(*args)
+            except Exception as e:
+                self.logger.error(f"Error running task {task.__name__}: {e}")
+            self.completed += 1
+
+
+class ReadinessDispatcher:
+    """Selector thread turning readable client sockets into worker pool tasks.
+
+    A socket is not watched while its task runs and is watched again once the
+    task is done, so a client is only ever read by one worker at a time and its
+    frames are handled in order.
+    """
+
+    def __init__(self, pool: WorkerPool, on_readable: Callable[[object], bool],
+                 on_error: Callable[[object], None] | None = None):
+        # on_readable: False once the client is gone and must not be watched anymore,
+        # on_error: tears down a client whose handler raised, it is not watched anymore either
+        self.pool = pool
+        self.on_readable = on_readable
+        self.on_error = on_error
+        self.logger = logging.getLogger("Dispatcher")
+        self.__selector = selectors.DefaultSelector()
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+        self.__selector.register(self.__wakeup_reader, selectors.EVENT_READ)
+        # clients to watch again, handed over by the workers
+        self.__arming: list = []
+        # readable clients refused by a saturated pool, retried on the next pass
+        self.__deferred: list = []
+        # id(client) -> (client, callback) of the clients to stop serving
+        self.__releasing: dict = dict()
+        self.__lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(
+            target=self.__run, name="Dispatcher", daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        self.__wakeup()
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def watch(self, client, ready: bool = False):
+        # ready: the client already has buffered frames, serve it without waiting for the socket
+        if self.__released(client):
+            return
+        if ready:
+            self.__submit(client)
+            return
+        with self.__lock:
+            self.__arming.append(client)
+            wakeup = len(self.__arming) == 1
+        if wakeup:
+            self.__wakeup()
+
+    def release(self, client, on_released: Callable[[object], None]):
+        # stop serving the client, on_released(client) runs once no worker reads it and its socket is not watched
+        with self.__lock:
+            self.__releasing[id(client)] = (client, on_released)
+        self.__wakeup()
+
+    def forget(self, client):
+        # a client torn down before it was released, its on_released callback runs now rather than never
+        self.__released(client)
+
+    def __released(self, client) -> bool:
+        with self.__lock:
+            _, on_released = self.__releasing.pop(id(client), (None, None))
+        if on_released is None:
+            return False
+        try:
+            on_released(client)
+        except Exception as e:
+            self.logger.error(f"Error releasing {client.getUsername()}: {e}")
+        return True
+
+    def watched(self) -> int:
+        return len(self.__selector.get_map()) - 1
+
+    def __wakeup(self):
+        try:
+            self.__wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def __submit(self, client):
+        if not self.pool.submit(self.__serve, client):
+            with self.__lock:
+                self.__deferred.append(client)
+
+    def __serve(self, client):
+        if self.__released(client):
+            return
+        try:
+            watch = self.on_readable(client)
+        except Exception as e:
+            self.logger.error(f"Error handling {client.getUsername()}: {e!r}")
+            watch = False
+            if self.on_error is not None:
+                try:
+                    self.on_error(client)
+                except Exception as e:
+                    self.logger.error(f"Error dropping {client.getUsername()}: {e!r}")
+        if watch:
+            self.watch(client)
+
+    def __run(self):
+        while not self.__stop_event.is_set():
+            # poll while the pool is saturated, otherwise sleep until something happens
+            timeout = 0.05 if self.__deferred else None
+            for key, _ in self.__selector.select(timeout):
+                if key.fileobj is self.__wakeup_reader:
+                    try:
+                        while self.__wakeup_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.__selector.unregister(key.fileobj)
+                    self.__submit(key.data)
+            with self.__lock:
+                arming, self.__arming = self.__arming, []
+                deferred, self.__deferred = self.__deferred, []
+            for client in arming:
+                self.__arm(client)
+            for client in deferred:
+                self.__submit(client)
+            if self.__releasing:
+                self.__wake_released()
+        self.__selector.close()
+        self.__wakeup_reader.close()
+        self.__wakeup_writer.close()
+
+    def __wake_released(self):
+        # watched clients to release are served once more, the worker releases them instead
+        with self.__lock:
+            releasing = [client for client, _ in self.__releasing.values()]
+        for client in releasing:
+            try:
+                key = self.__selector.get_key(client.getSocket())
+            except (KeyError, ValueError):
+                # being served, the worker releases it when done
+                continue
+            if key.data is client:
+                self.__selector.unregister(key.fileobj)
+                self.__submit(client)
+
+    def __arm(self, client):
+        sock = client.getSocket()
+        try:
+            self.__selector.register(sock, selectors.EVENT_READ, client)
+        except KeyError:
+            # a closed socket left its file descriptor behind
+            self.__selector.unregister(sock.fileno())
+            self.__selector.register(sock, selectors.EVENT_READ, client)
+        except (ValueError, OSError):
+            # the socket is already closed, let the handler clean the client up
+            self.__submit(client)